@@ -229,6 +229,15 @@ make-zips() {
   echo
 }
 
+# Local benchmark of upload throughput and memory.  Save the output and diff it
+# between commits, e.g.
+#
+#   ./run.sh bench > _tmp/bench-$(git rev-parse --short HEAD).tsv
+#   ./run.sh bench --sizes 10K,1M --modes cgi
+bench() {
+  python2 wwup_bench.py "$@"
+}
+
 local-test() {
   CONTENT_LENGTH=0 ./wwup.cgi
   CONTENT_LENGTH=0 REQUEST_METHOD=POST ./wwup.cgi < /dev/null
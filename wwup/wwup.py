@@ -15,10 +15,11 @@ Features:
 - Control resource usage
   - Total size of each file
   - Number of entires in the .wwz file
-- TODO: Delete old files automatically
+  - Uncompressed size and compression ratio of the .wwz file
+- Delete old job dirs automatically, according to a retention policy
 
+- Concatenate TSV files for easier analysis, as they're uploaded
 - Run hooks
-  - Concatenate TSV files for easier analysis
   - Generate HTML with trusted binaries
 
 ## Soil CI
@@ -38,41 +39,60 @@ The uploaded structure we want:
           oils-for-unix.tar
 """
 
+import array
 import cgi
 import cgitb
+import copy
 import cStringIO
 import errno
+import fcntl
+import fnmatch
+import hashlib
+import json
+import marshal
 import os
 import pwd
+import Queue
+import re
+import shutil
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+import traceback
+import urlparse
 import zipfile
+import zlib
 
 
-def PrintStatusOk():
-  print('Status: 200 OK')
-  print('Content-Type: text/plain; charset=utf-8')
-  print('')
+# Handlers return (status, headers, body_chunks).  WriteCgi() and App turn
+# that into a CGI or WSGI response.
 
+TEXT_HEADERS = [('Content-Type', 'text/plain; charset=utf-8')]
+JSON_HEADERS = [('Content-Type', 'application/json')]
 
-def PrintError400():
+
+def TextResponse(lines, status='200 OK'):
+  return status, list(TEXT_HEADERS), [''.join(line + '\n' for line in lines)]
+
+
+def JsonResponse(obj):
+  return '200 OK', list(JSON_HEADERS), [json.dumps(obj, indent=2, sort_keys=True) + '\n']
+
+
+def Error400(message):
   """Client error"""
-  print('Status: 400 Bad Request')
-  print('Content-Type: text/plain; charset=utf-8')
-  print('')
+  return TextResponse(['Bad request: %s' % message], status='400 Bad Request')
 
 
-def PrintError500():
+def Error500(lines):
   """Server error"""
-  print('Status: 500 Internal Server Error')
-  print('Content-Type: text/plain; charset=utf-8')
-  print('')
+  return TextResponse(lines, status='500 Internal Server Error')
 
 
-# Debug before main()
-if 0:
-  PrintStatusOk()
+class Conflict(RuntimeError):
+  """A client error that's answered with 409, e.g. a second commit."""
 
 
 def log(msg, *args):
@@ -81,6 +101,180 @@ def log(msg, *args):
   print(msg, file=sys.stderr)
 
 
+def _TmpSuffix():
+  """For temp file names.  Requests may be handled by threads of one process,
+  so the PID alone isn't unique."""
+  return '%d-%d' % (os.getpid(), threading.current_thread().ident)
+
+
+#
+# Request log
+#
+# One row per request, with the time spent in each phase.  Same schema
+# approach as wwz.py.
+
+UPLOAD_LOG_PATH = '.wwup/requests.tsv'  # relative to $HOME
+
+# Phases are timed in milliseconds, and written in this order
+PHASES = ['parse', 'validate', 'copy', 'repack', 'index', 'rename',
+          'aggregate', 'hook']
+
+UPLOAD_LOG_SCHEMA = [
+    ('timestamp', 'double'),
+    ('pid', 'integer'),
+    ('action', 'string'),  # upload, run-hook, upload-session/commit, ...
+    ('payload_type', 'string'),
+    ('status', 'integer'),  # HTTP status
+    ('content_length', 'integer'),
+    ('num_files', 'integer'),
+    ('num_bytes', 'integer'),  # size of files written
+    ('num_wwz_entries', 'integer'),
+] + [('%s_ms' % phase, 'double') for phase in PHASES] + [
+    ('total_ms', 'double'),
+]
+
+
+class PhaseTimer(object):
+  """Accumulates the time spent in each phase of a request."""
+
+  def __init__(self):
+    self.start_time = time.time()
+    self.phase = None
+    self.phase_start = 0.0
+    self.millis = {}
+    self.counts = {}
+    self.fields = {}  # action, payload_type
+    self.status = 200
+
+  def Begin(self, phase):
+    """Start a phase, ending the current one."""
+    self.End()
+    self.phase = phase
+    self.phase_start = time.time()
+
+  def End(self):
+    if self.phase is not None:
+      elapsed = (time.time() - self.phase_start) * 1000
+      self.millis[self.phase] = self.millis.get(self.phase, 0.0) + elapsed
+      self.phase = None
+
+  def Add(self, name, n):
+    self.counts[name] = self.counts.get(name, 0) + n
+
+  def Merge(self, other):
+    """Add the phase times and counts of another timer, e.g. of a thread."""
+    for phase, millis in other.millis.iteritems():
+      self.millis[phase] = self.millis.get(phase, 0.0) + millis
+    for name, n in other.counts.iteritems():
+      self.Add(name, n)
+
+  def Row(self):
+    total_ms = (time.time() - self.start_time) * 1000
+    row = [
+        '%.3f' % self.start_time,
+        os.getpid(),
+        self.fields.get('action', '-'),
+        self.fields.get('payload_type', '-'),
+        self.status,
+        self.counts.get('content_length', 0),
+        self.counts.get('num_files', 0),
+        self.counts.get('num_bytes', 0),
+        self.counts.get('num_wwz_entries', 0),
+    ]
+    for phase in PHASES:
+      row.append('%.1f' % self.millis.get(phase, 0.0))
+    row.append('%.1f' % total_ms)
+    return row
+
+
+class AppendLogFile(object):
+  """Writes the format of wwz.TabularLogFile: a header of schema names, then
+  one line of tab-separated cells per row.
+
+  wwz.py keeps its log open in a long-lived process, but each wwup CGI process
+  writes one row, so this one appends, and writes the header when the file is
+  empty.  wwup.py is deployed without wwz.py, so it can't import it;
+  wwup_test.py checks that the two write the same thing.
+
+  Rows are written with a single write(), and are less than 4096 bytes, so
+  concurrent appends don't interleave.
+  """
+  def __init__(self, schema, path):
+    self.schema = schema
+    self.path = path
+
+  def Append(self, row):
+    assert len(row) == len(self.schema), row
+    # Strings come from the client
+    cells = [str(cell).replace('\t', ' ').replace('\n', ' ')[:200]
+             for cell in row]
+    line = '\t'.join(cells) + '\n'
+
+    fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+      if os.fstat(fd).st_size == 0:
+        line = '\t'.join(name for name, _ in self.schema) + '\n' + line
+      os.write(fd, line)
+    finally:
+      os.close(fd)
+
+
+def AppendUploadLog(home_dir, timer):
+  path = os.path.join(home_dir, UPLOAD_LOG_PATH)
+  try:
+    _MakeDirs(os.path.dirname(path))
+    AppendLogFile(UPLOAD_LOG_SCHEMA, path).Append(timer.Row())
+  except (IOError, OSError) as e:
+    log('wwup: error writing request log: %s', e)
+
+
+def _Percentile(sorted_values, p):
+  if not sorted_values:
+    return 0.0
+  i = min(int(len(sorted_values) * p), len(sorted_values) - 1)
+  return sorted_values[i]
+
+
+def ReportUploadLog(path, out_f, num_slowest=10):
+  """Summarize the request log: which phases take the most time?"""
+  with open(path) as f:
+    header = f.readline().rstrip('\n').split('\t')
+    rows = []
+    for line in f:
+      cells = line.rstrip('\n').split('\t')
+      if len(cells) == len(header):
+        rows.append(dict(zip(header, cells)))
+
+  out_f.write('%d requests in %s\n\n' % (len(rows), path))
+
+  out_f.write('%-10s %6s %12s %10s %10s %10s\n' %
+              ('phase', 'count', 'total_ms', 'mean_ms', 'p95_ms', 'max_ms'))
+  stats = []
+  for phase in PHASES + ['total']:
+    values = sorted(float(row['%s_ms' % phase]) for row in rows
+                    if float(row['%s_ms' % phase]) > 0)
+    total = sum(values)
+    stats.append((total, phase, values))
+  # Slowest phases first, but total last
+  stats.sort(key=lambda t: (t[1] == 'total', -t[0]))
+  for total, phase, values in stats:
+    n = len(values)
+    out_f.write('%-10s %6d %12.1f %10.1f %10.1f %10.1f\n' % (
+        phase, n, total, total / n if n else 0.0, _Percentile(values, 0.95),
+        values[-1] if values else 0.0))
+  out_f.write('\n')
+
+  out_f.write('Slowest requests:\n')
+  rows.sort(key=lambda row: -float(row['total_ms']))
+  for row in rows[:num_slowest]:
+    slowest_phase = max(PHASES, key=lambda phase: float(row['%s_ms' % phase]))
+    out_f.write('%10.1f ms  %s %s %s status=%s bytes=%s  slowest: %s %.1f ms\n' % (
+        float(row['total_ms']),
+        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(float(row['timestamp']))),
+        row['action'], row['payload_type'], row['status'], row['num_bytes'],
+        slowest_phase, float(row['%s_ms' % slowest_phase])))
+
+
 # Hard-coded payload validation:
 
 # definitely no .js .css .html
@@ -115,12 +309,18 @@ PAYLOADS = {
     # - Each pattern matches some file?
     # - The patterns cover ALL data uploaded - probably too strict, since we
     #   have other files
+    #
+    # For now, members that match no pattern, and patterns that match no
+    # member, are reported in the upload summary.  See CheckWwzNames().
     'globs': [
       'osh-runtime/*.tsv',  # times, provenance, gc-stats
       'shell-id/*-*/*.txt',
       'host-id/*-*/*.txt',
     ],
 
+    # Append rows of these files to merged TSV files.  See AggregateTsv().
+    'aggregate_tsv': ['osh-runtime/*.tsv'],
+
     # loose sanity check on .wwz
     'max_wwz_entries': 1000,
     # total size of .wwz is 5 MB max, to prevent people from filling up too
@@ -135,6 +335,13 @@ PAYLOADS = {
     'max_wwz_entries': 22000,
     # wild.wwz is 23 MB
     'max_bytes': 30 * 1000 * 1000,
+    # Checked against the central directory, without decompressing
+    'max_uncompressed_bytes': 300 * 1000 * 1000,
+    'max_member_bytes': 50 * 1000 * 1000,
+    'max_compression_ratio': 100,
+
+    # file1= ... file50=.  The default is 3.
+    'max_files': 50,
 
     # subdir=github-jobs/1234
     'subdir_depth': 1,
@@ -160,8 +367,11 @@ PAYLOADS = {
   },
 }
 
-# Copy this policy for now
-PAYLOADS['sourcehut-jobs'] = PAYLOADS['github-jobs']
+# Copy this policy for now.  A copy, so changing one doesn't change the other.
+PAYLOADS['sourcehut-jobs'] = copy.deepcopy(PAYLOADS['github-jobs'])
+
+# Before we know the payload type, the body can't be bigger than this
+MAX_POST_BYTES = max(p.get('max_bytes', 10000) for p in PAYLOADS.values())
 
 HOOKS = {
     'local-test': {
@@ -179,6 +389,9 @@ HOOKS = {
       'argv0': 'soil-web/soil/web.sh',
       # the user can pass arbitrary args as URL params
       'argv_prefix': ['event-job-done'],
+      # Regenerating the site in parallel is wasted work.  (This is the
+      # default.)
+      'max_concurrent': 1,
     },
 
     'soil-cleanup-status-api': {
@@ -206,19 +419,266 @@ def ValidateSubdir(subdir, expected_depth):
 # Notes on streaming / temp files
 # 
 # cgi.py uses a temp file for the entire POST body.  But each file in the
-# multipart form payload is buffered into a StringIO object.
+# multipart form payload is buffered into a StringIO object, and then we had
+# to copy it a third time.
 # 
-# So we
+# So we parse multipart/form-data ourselves.  Each file part is
 # 
-# 1. write that in-memory file to another temporary directory
-# 2. make it read-only
-# 3. atomically rename it onto the destination.  If this fails, the file was
+# 1. written in fixed-size chunks to a temp file in .wwup/tmp under the
+#    destination dir, so it's on the same file system.  max_bytes is enforced
+#    as bytes arrive.
+# 2. validated, and made read-only
+# 3. atomically renamed onto the destination.  If this fails, the file was
 #    already uploaded.
-# 
-# We could use something like 'python-multipart' to stream the upload.
-# 
-# But for now we can just reject files with CONTENT_LENGTH greater than a
-# certain amount.
+#
+# So memory use is constant, and each file is written to disk once.
+
+# Read and write this many bytes at a time
+CHUNK_SIZE = 64 * 1024
+
+# Limit on non-file fields like payload-type
+MAX_FIELD_BYTES = 64 * 1024
+MAX_HEADER_BYTES = 16 * 1024
+# and on all of them together
+MAX_FIELDS = 100
+MAX_TOTAL_FIELD_BYTES = 256 * 1024
+
+# Temp files for uploads, relative to the destination dir
+UPLOAD_TMP_DIR = '.wwup/tmp'
+# Older temp files were left by a request that was killed
+TMP_MAX_AGE_SECS = 24 * 3600
+
+
+def UploadTmpDir(dest_base_dir, now):
+  """Return the dir for temp files, after removing stale ones."""
+  tmp_dir = os.path.join(dest_base_dir, UPLOAD_TMP_DIR)
+  _MakeDirs(tmp_dir)
+  for name in os.listdir(tmp_dir):
+    path = os.path.join(tmp_dir, name)
+    try:
+      if now - os.path.getmtime(path) > TMP_MAX_AGE_SECS:
+        os.unlink(path)
+    except OSError:
+      pass  # removed by another request
+  return tmp_dir
+
+
+class FormValue(object):
+  """A form field.  Like the items of cgi.FieldStorage, it has .value for
+  strings, or .filename and .file for uploaded files."""
+
+  def __init__(self, name, value=None, filename=None, tmp_path=None):
+    self.name = name
+    self.value = value
+    self.filename = filename
+    self.tmp_path = tmp_path  # where the streaming parser wrote the file
+    self.file = None
+    if tmp_path is not None:
+      self.file = open(tmp_path, 'rb')
+
+
+def _MaxPostBytes(form):
+  """The limit on file bytes, which depends on the payload type."""
+  payload_val = form.get('payload-type')
+  if payload_val is not None:
+    policy = PAYLOADS.get(payload_val.value)
+    if policy is not None:
+      # Low limit of 10_000 by default
+      return policy.get('max_bytes', 10000)
+  return MAX_POST_BYTES
+
+
+class _MultipartParser(object):
+  """Streaming parser for multipart/form-data bodies."""
+
+  def __init__(self, fp, boundary, content_length, tmp_dir, max_bytes_func):
+    self.fp = fp
+    self.num_unread = content_length
+    self.tmp_dir = tmp_dir
+    self.max_bytes_func = max_bytes_func
+
+    self.delim = '--' + boundary
+    self.sep = '\r\n' + self.delim  # precedes every delimiter but the first
+    self.buf = ''
+    self.num_file_bytes = 0
+    self.num_fields = 0
+    self.num_field_bytes = 0
+    self.form = None
+
+  def _Fill(self):
+    """Read more of the body.  Returns False at the end."""
+    if self.num_unread <= 0:
+      return False
+    chunk = self.fp.read(min(CHUNK_SIZE, self.num_unread))
+    if not chunk:
+      return False
+    self.num_unread -= len(chunk)
+    self.buf += chunk
+    return True
+
+  def _ReadUntil(self, s, max_bytes):
+    """Return the bytes before s, and consume s."""
+    while True:
+      i = self.buf.find(s)
+      if i != -1:
+        result = self.buf[:i]
+        self.buf = self.buf[i + len(s):]
+        return result
+      if len(self.buf) > max_bytes:
+        raise RuntimeError('Multipart header too long')
+      if not self._Fill():
+        raise RuntimeError('Truncated multipart body')
+
+  def _Need(self, n):
+    while len(self.buf) < n:
+      if not self._Fill():
+        raise RuntimeError('Truncated multipart body')
+
+  def _CopyPart(self, write_func):
+    """Pass the part body to write_func, up to the next delimiter."""
+    n = len(self.sep)
+    while True:
+      i = self.buf.find(self.sep)
+      if i != -1:
+        write_func(self.buf[:i])
+        self.buf = self.buf[i + n:]
+        return
+      # Keep a tail that could be the start of a delimiter
+      if len(self.buf) >= n:
+        write_func(self.buf[:-(n-1)])
+        self.buf = self.buf[-(n-1):]
+      if not self._Fill():
+        raise RuntimeError('Truncated multipart body')
+
+  def Parse(self, form):
+    """Parse the body into the form dict."""
+    self.form = form  # the limit on file bytes depends on earlier fields
+
+    # Skip the preamble.  The first delimiter isn't preceded by CRLF.
+    self._ReadUntil(self.delim, MAX_HEADER_BYTES)
+
+    while True:
+      self._Need(2)
+      if self.buf.startswith('--'):
+        break  # final delimiter
+      if not self.buf.startswith('\r\n'):
+        raise RuntimeError('Invalid multipart delimiter')
+      self.buf = self.buf[2:]
+
+      header_text = self._ReadUntil('\r\n\r\n', MAX_HEADER_BYTES)
+      headers = {}
+      for line in header_text.split('\r\n'):
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+      _, params = cgi.parse_header(headers.get('content-disposition', ''))
+      name = params.get('name')
+      if name is None:
+        raise RuntimeError('Multipart part without a name')
+      # Otherwise the temp file of an earlier part would be lost
+      if name in form:
+        raise RuntimeError('Multipart part %r appears more than once' % name)
+
+      filename = params.get('filename')
+      if filename is None:
+        self.num_fields += 1
+        if self.num_fields > MAX_FIELDS:
+          raise RuntimeError('More than %d form fields' % MAX_FIELDS)
+        form[name] = FormValue(name, value=self._ReadField())
+      else:
+        tmp_path = self._ReadFile()
+        form[name] = FormValue(name, filename=filename, tmp_path=tmp_path)
+
+  def _ReadField(self):
+    parts = []
+    num_bytes = [0]
+
+    def Write(chunk):
+      num_bytes[0] += len(chunk)
+      if num_bytes[0] > MAX_FIELD_BYTES:
+        raise RuntimeError('Form field is too long')
+      self.num_field_bytes += len(chunk)
+      if self.num_field_bytes > MAX_TOTAL_FIELD_BYTES:
+        raise RuntimeError('Form fields are more than %d bytes' %
+                           MAX_TOTAL_FIELD_BYTES)
+      parts.append(chunk)
+
+    self._CopyPart(Write)
+    return ''.join(parts)
+
+  def _ReadFile(self):
+    fd, tmp_path = tempfile.mkstemp(prefix='.wwup-', dir=self.tmp_dir)
+    try:
+      with os.fdopen(fd, 'wb') as out_f:
+
+        def Write(chunk):
+          self.num_file_bytes += len(chunk)
+          max_bytes = self.max_bytes_func(self.form)
+          if self.num_file_bytes > max_bytes:
+            raise RuntimeError('Files are more than %d bytes, which is the limit' %
+                               max_bytes)
+          out_f.write(chunk)
+
+        self._CopyPart(Write)
+    except:
+      os.unlink(tmp_path)
+      raise
+    return tmp_path
+
+
+def ParseForm(environ, fp, tmp_dir, max_bytes_func=_MaxPostBytes):
+  """Parse the request into a dict of name -> FormValue.
+
+  Files are streamed to temp files in tmp_dir.  Call CleanupForm() when done.
+  """
+  form = {}
+  method = environ.get('REQUEST_METHOD', 'GET')
+  if method != 'POST':
+    return form
+
+  content_type, params = cgi.parse_header(environ.get('CONTENT_TYPE', ''))
+  try:
+    content_length = int(environ.get('CONTENT_LENGTH') or '0')
+  except ValueError:
+    raise RuntimeError('Invalid CONTENT_LENGTH')
+
+  if content_type == 'multipart/form-data':
+    boundary = params.get('boundary')
+    if not boundary:
+      raise RuntimeError('Expected multipart boundary')
+    parser = _MultipartParser(fp, boundary, content_length, tmp_dir,
+                              max_bytes_func)
+    try:
+      parser.Parse(form)
+    except:
+      CleanupForm(form)
+      raise
+
+  elif content_type == 'application/x-www-form-urlencoded':
+    if content_length > MAX_FIELD_BYTES:
+      raise RuntimeError('Form is too long')
+    body = fp.read(content_length)
+    fields = urlparse.parse_qs(body)
+    if len(fields) > MAX_FIELDS:
+      raise RuntimeError('More than %d form fields' % MAX_FIELDS)
+    for name, values in fields.iteritems():
+      form[name] = FormValue(name, value=values[0])
+
+  return form
+
+
+def CleanupForm(form):
+  """Remove temp files that weren't renamed to their destination."""
+  for form_val in form.values():
+    if form_val.file is not None:
+      form_val.file.close()
+    if form_val.tmp_path is not None:
+      try:
+        os.unlink(form_val.tmp_path)
+      except OSError:
+        pass
+      form_val.tmp_path = None
+
 
 def CopyFile(input_f, out_path):
   # Fail if the file already exists
@@ -241,56 +701,401 @@ def CopyFile(input_f, out_path):
   input_f.close()
 
 
-def DoOneFile(param_name, policy, environ, form_val, out_dir):
-  # The cgi module stores file uploads in a temp directory (like PHP).  So we
-  # read it and write it to a new location 1 MB at a time.
+def _GlobToRegex(glob):
+  """Like fnmatch.translate(), but * and ? don't match /."""
+  out = []
+  i = 0
+  n = len(glob)
+  while i < n:
+    c = glob[i]
+    i += 1
+    if c == '*':
+      out.append('[^/]*')
+    elif c == '?':
+      out.append('[^/]')
+    elif c == '[':
+      j = i
+      if j < n and glob[j] in '!^':
+        j += 1
+      if j < n and glob[j] == ']':
+        j += 1
+      j = glob.find(']', j)
+      if j == -1:
+        out.append(r'\[')
+      else:
+        chars = glob[i:j].replace('\\', r'\\')
+        if chars[0] in '!^':
+          chars = '^/' + chars[1:]
+        out.append('[%s]' % chars)
+        i = j + 1
+    else:
+      out.append(re.escape(c))
+  return ''.join(out)
+
+
+_GLOB_MATCHERS = {}  # tuple of globs -> compiled regex
+
+
+def CompileGlobs(globs):
+  """Compile globs into one regex, with a named group for each glob.
+
+  A name is matched against all of them in one pass, and m.lastgroup says
+  which glob matched first.
+  """
+  key = tuple(globs)
+  pat = _GLOB_MATCHERS.get(key)
+  if pat is None:
+    alts = ['(?P<g%d>%s)' % (i, _GlobToRegex(g)) for i, g in enumerate(globs)]
+    pat = re.compile(r'(?:%s)\Z' % '|'.join(alts))
+    _GLOB_MATCHERS[key] = pat
+  return pat
+
+
+def MatchGlobs(globs, names):
+  """Match names against globs in a single pass.
+
+  Returns:
+    (names that match no glob, globs that match no name)
+
+  Directory entries are skipped.  A name counts only toward the first glob it
+  matches.
+  """
+  match = CompileGlobs(globs).match
+  unmatched_names = []
+  matched = set()
+  for name in names:
+    if name.endswith('/'):
+      continue
+    m = match(name)
+    if m:
+      matched.add(m.lastgroup)
+    else:
+      unmatched_names.append(name)
+
+  unmatched_globs = [
+      g for i, g in enumerate(globs) if 'g%d' % i not in matched]
+  return unmatched_names, unmatched_globs
+
+
+# Show this many members that match no glob in the summary
+MAX_UNMATCHED_SHOWN = 5
+
+
+def CheckWwzNames(policy, names):
+  """Check the number of entries in a .wwz, and their paths.
+
+  Returns (members that match none of the policy's globs, globs that match no
+  member).  They're reported, not rejected.
+  """
+
+  # Low limit of 10 by default
+  max_wwz_entries = policy.get('max_wwz_entries', 10)
+  if len(names) > max_wwz_entries:
+      raise RuntimeError('wwz has %d files, but only %d are allowed' %
+          (len(names), max_wwz_entries))
+
+  for rel_path in names:
+    # Can't have absolute paths
+    if rel_path.startswith('/'):
+      raise RuntimeError('Invalid path %r' % rel_path)
+
+    # Path traversal check
+    # normpath turns foo/bar/../../.. into '..'
+    norm_path = os.path.normpath(rel_path)
+    if norm_path.startswith('.'):
+      raise RuntimeError('Invalid path %r' % rel_path)
+
+    if policy.get('check_wwz_names', True):
+      # Executable content check, e.g. disallow .html .css .jss
+      if not rel_path.endswith('/'):
+        _, ext = os.path.splitext(rel_path)
+        if ext not in ALLOWED_EXTENSIONS:
+          raise RuntimeError('Archive file %r has an invalid extension' % rel_path)
+
+  globs = policy.get('globs')
+  if not globs:
+    return [], []
+  return MatchGlobs(globs, names)
+
+
+# Members smaller than this aren't subject to max_compression_ratio, since a
+# small file of repeated bytes can legitimately compress very well.
+RATIO_MIN_MEMBER_BYTES = 1000 * 1000
+
+
+def CheckWwzSizes(policy, infolist):
+  """Check how much a .wwz expands to, without decompressing anything.
+
+  The sizes come from the central directory.  wwz.py never inflates a member
+  past its declared size, so an archive that lies about them doesn't get
+  around these limits.
+  """
+  # Defaults are relative to the upload size, which is itself limited
+  max_bytes = policy.get('max_bytes', 10000)
+  max_uncompressed_bytes = policy.get('max_uncompressed_bytes', 10 * max_bytes)
+  max_member_bytes = policy.get('max_member_bytes', max_uncompressed_bytes)
+  max_ratio = policy.get('max_compression_ratio', 100)
+
+  total_uncompressed = 0
+  total_compressed = 0
+  for info in infolist:
+    if info.file_size > max_member_bytes:
+      raise RuntimeError('Archive file %r is %d bytes, but only %d are allowed' %
+          (info.filename, info.file_size, max_member_bytes))
+
+    if info.file_size >= RATIO_MIN_MEMBER_BYTES:
+      ratio = float(info.file_size) / max(info.compress_size, 1)
+      if ratio > max_ratio:
+        raise RuntimeError(
+            'Archive file %r has compression ratio %.1f, but only %d is allowed' %
+            (info.filename, ratio, max_ratio))
+
+    total_uncompressed += info.file_size
+    total_compressed += info.compress_size
+
+  if total_uncompressed > max_uncompressed_bytes:
+    raise RuntimeError('wwz expands to %d bytes, but only %d are allowed' %
+        (total_uncompressed, max_uncompressed_bytes))
+
+  if total_uncompressed >= RATIO_MIN_MEMBER_BYTES:
+    ratio = float(total_uncompressed) / max(total_compressed, 1)
+    if ratio > max_ratio:
+      raise RuntimeError('wwz has compression ratio %.1f, but only %d is allowed' %
+          (ratio, max_ratio))
+
+
+# Repacking: the compression method of each member is chosen by its type and
+# size, instead of whatever the CI job's zip command did.
+
+# Deflating these again doesn't help, and wwz.py would have to inflate them
+REPACK_STORED_EXTENSIONS = [
+    '.png', '.jpg', '.jpeg', '.gif', '.webp', '.woff', '.woff2',
+    '.gz', '.tgz', '.bz2', '.xz', '.zst', '.zip', '.wwz',
+    # wwz.py serves files inside a STORED .tar
+    '.tar',
+]
+# Below this size, we keep the smaller of stored and deflated
+REPACK_TRIAL_BYTES = 4096
+
+
+def _RepackMethod(name, data, compressed_size=None):
+  """
+  Args:
+    compressed_size: the member's deflated size, if it's already known from
+      the original entry.  Otherwise a small member is compressed once to
+      find out, and zipfile compresses it again when it's written.
+  """
+  if name.endswith('/'):
+    return zipfile.ZIP_STORED
+  _, ext = os.path.splitext(name)
+  if ext.lower() in REPACK_STORED_EXTENSIONS:
+    return zipfile.ZIP_STORED
+  if len(data) < REPACK_TRIAL_BYTES:
+    if compressed_size is None:
+      # Raw deflate, like zipfile writes
+      c = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+      compressed_size = len(c.compress(data)) + len(c.flush())
+    if compressed_size >= len(data):
+      return zipfile.ZIP_STORED
+  return zipfile.ZIP_DEFLATED
+
+
+def _RepackOrder(info):
+  """Group members by directory, so files in a dir are next to each other."""
+  name = info.filename
+  d, base = os.path.split(name.rstrip('/'))
+  return (d, name.endswith('/'), base)
+
+
+def RepackWwz(in_path, out_path):
+  """Rewrite a .wwz with a compression method chosen per member.
+
+  Returns a dict of stats.
+  """
+  num_stored = 0
+  num_deflated = 0
+  in_z = zipfile.ZipFile(in_path)
+  out_z = zipfile.ZipFile(out_path, 'w', allowZip64=True)
+  try:
+    for info in sorted(in_z.infolist(), key=_RepackOrder):
+      try:
+        data = in_z.read(info)  # checks the CRC
+      except (zipfile.BadZipfile, zlib.error) as e:
+        raise RuntimeError('Error reading %r from zip: %s' % (info.filename, e))
+
+      new_info = zipfile.ZipInfo(info.filename, info.date_time)
+      new_info.external_attr = info.external_attr
+      compressed_size = None
+      if info.compress_type == zipfile.ZIP_DEFLATED:
+        compressed_size = info.compress_size
+      new_info.compress_type = _RepackMethod(info.filename, data,
+                                             compressed_size=compressed_size)
+      out_z.writestr(new_info, data)
+
+      if new_info.compress_type == zipfile.ZIP_STORED:
+        num_stored += 1
+      else:
+        num_deflated += 1
+  finally:
+    out_z.close()
+    in_z.close()
+
+  return {
+      'num_stored': num_stored,
+      'num_deflated': num_deflated,
+      'original_bytes': os.path.getsize(in_path),
+      'repacked_bytes': os.path.getsize(out_path),
+  }
+
+
+# The serving index lets wwz.py skip parsing the central directory of a .wwz
+# file.  Keep this in sync with ZipIndex.LoadServingIndex() in wwz.py.
+SERVING_INDEX_FORMAT = 'wwz-serving-index-1'
+
+
+def ServingIndexPath(wwz_path):
+  """foo.wwz -> .foo.wwz.index, which is hidden from directory listings."""
+  d, name = os.path.split(wwz_path)
+  return os.path.join(d, '.%s.index' % name)
+
+
+def MakeServingIndex(infolist, archive_path):
+  """Return a marshal-able dict for the archive, or None.
+
+  The members are sorted by name, and stored as parallel arrays of 32-bit
+  little-endian integers.  Since every directory is a contiguous range of
+  sorted names, wwz.py can list directories with bisection.
+
+  Args:
+    infolist: from zipfile.ZipFile.infolist()
+    archive_path: the file we stat(), which wwz.py compares against
+  """
+  entries = []
+  for info in infolist:
+    name = info.filename
+    if isinstance(name, unicode):
+      name = name.encode('utf-8')
+    entries.append((name, info.header_offset, info.compress_size,
+                    info.file_size, info.CRC, info.compress_type))
+  entries.sort()
+
+  columns = [array.array(typecode) for typecode in 'IIIIIB']
+  name_starts, header_offsets, compressed_sizes, sizes, crcs, methods = columns
+
+  parts = []
+  n = 0
+  try:
+    for name, header_offset, compressed_size, size, crc, method in entries:
+      name_starts.append(n)
+      parts.append(name)
+      n += len(name)
+
+      header_offsets.append(header_offset)
+      compressed_sizes.append(compressed_size)
+      sizes.append(size)
+      crcs.append(crc)
+      methods.append(method)
+    name_starts.append(n)  # sentinel
+  except OverflowError:
+    return None  # zip64 isn't supported by wwz.py; it will fall back
+
+  if sys.byteorder == 'big':
+    for a in columns:
+      a.byteswap()
+
+  st = os.stat(archive_path)
+  return {
+      'format': SERVING_INDEX_FORMAT,
+      'archive_size': st.st_size,
+      'archive_mtime': st.st_mtime,
+      'names': ''.join(parts),
+      'name_starts': name_starts.tostring(),
+      'header_offsets': header_offsets.tostring(),
+      'compressed_sizes': compressed_sizes.tostring(),
+      'sizes': sizes.tostring(),
+      'crcs': crcs.tostring(),
+      'methods': methods.tostring(),
+  }
+
+
+def WriteServingIndex(index, tmp_index_path):
+  with open(tmp_index_path, 'wb') as f:
+    marshal.dump(index, f)
+  os.chmod(tmp_index_path, 0o444)
+
+
+def _FileSize(path):
+  try:
+    return os.path.getsize(path)
+  except OSError:
+    return 0
+
+
+class PreparedFile(object):
+  """A validated upload in temp files, ready to be renamed into place."""
+
+  def __init__(self, param_name, filename, out_path):
+    self.param_name = param_name
+    self.filename = filename
+    self.out_path = out_path
+    self.tmp_out_path = None  # owned by us, once set
+    self.tmp_index_path = None
+
+    self.num_wwz_entries = -1
+    self.repack_stats = None
+    self.unmatched_names = []
+    self.unmatched_globs = []
+
+  def Abort(self):
+    """Remove the temp files.
+
+    This is called while handling exceptions, so it doesn't use try/except,
+    which would clobber the exception we re-raise in Python 2.
+    """
+    for path in (self.tmp_out_path, self.tmp_index_path):
+      if path is not None and os.path.exists(path):
+        os.unlink(path)
+    self.tmp_out_path = None
+    self.tmp_index_path = None
+
+
+def PrepareFile(param_name, policy, form_val, out_dir, timer=None):
+  """Validate an uploaded file, and write it and its index to temp files.
+
+  Nothing is visible at the destination until CommitFile().
+  """
+  # ParseForm() streams file uploads to a temp file on the destination's file
+  # system, so we validate it and rename it.  Other file objects are copied 1 MB at a time.
 
   if form_val.filename is None:
     raise RuntimeError('Expected %r param to be a file, not a string' % param_name)
 
+  if timer is None:
+    timer = PhaseTimer()
+  timer.Begin('validate')
+
   input_f = form_val.file  # get the file handle
 
   os.path.splitext
   _, outer_ext = os.path.splitext(form_val.filename)
 
-  num_wwz_entries = -1
-
-  maybe_trailing_slash = ''  # no trailing slash for regular files
+  out_path = os.path.join(out_dir, form_val.filename)
+  prepared = PreparedFile(param_name, form_val.filename, out_path)
+  infolist = None
 
   if outer_ext == '.wwz':
-    maybe_trailing_slash = '/'  # for printing URL
-
     try:
       z = zipfile.ZipFile(input_f)
     except zipfile.BadZipfile as e:
       raise RuntimeError('Error opening zip: %s' % e)
 
-    names = z.namelist()
-    num_wwz_entries = len(names)
-
-    # Low limit of 10 by default
-    max_wwz_entries = policy.get('max_wwz_entries', 10)
-    if num_wwz_entries > max_wwz_entries:
-        raise RuntimeError('wwz has %d files, but only %d are allowed' %
-            (num_wwz_entries, max_wwz_entries))
-
-    for rel_path in names:
-      # Can't have absolute paths
-      if rel_path.startswith('/'):
-        raise RuntimeError('Invalid path %r' % rel_path)
-
-      # Path traversal check
-      # normpath turns foo/bar/../../.. into '..'
-      norm_path = os.path.normpath(rel_path)
-      if norm_path.startswith('.'):
-        raise RuntimeError('Invalid path %r' % rel_path)
-
-      if policy.get('check_wwz_names', True):
-        # Executable content check, e.g. disallow .html .css .jss
-        if not rel_path.endswith('/'):
-          _, ext = os.path.splitext(rel_path)
-          if ext not in ALLOWED_EXTENSIONS:
-            raise RuntimeError('Archive file %r has an invalid extension' % rel_path)
+    infolist = z.infolist()
+    names = [info.filename for info in infolist]
+    prepared.num_wwz_entries = len(names)
+
+    prepared.unmatched_names, prepared.unmatched_globs = CheckWwzNames(
+        policy, names)
+    CheckWwzSizes(policy, infolist)
 
     # Important: seek back to the beginning, because ZipFile read it!
     input_f.seek(0)
@@ -300,58 +1105,230 @@ def DoOneFile(param_name, policy, environ, form_val, out_dir):
     # check_wwz_names.
     raise RuntimeError('File %r has an invalid extension' % form_val.filename)
 
-  out_path = os.path.join(out_dir, form_val.filename)
-
   # Note: this check may be racy, but it protects against some accidents
   allow_overwrite = policy.get('allow_overwrite', False)
   if not allow_overwrite and os.path.exists(out_path):
     raise RuntimeError('File already exists: %r' % out_path)
 
-  # The PID is unique at a given point in time.  The worst case is that a
-  # script is interrupted and the file is left there.
-  tmp_out_path = '%s.wwup-%d' % (out_path, os.getpid())
+  tmp_path = getattr(form_val, 'tmp_path', None)
+  if tmp_path is not None:
+    # Already on disk
+    input_f.close()
+    prepared.tmp_out_path = tmp_path
+    form_val.tmp_path = None  # so CleanupForm() doesn't remove it
+  else:
+    # The PID and thread are unique at a given point in time.  The worst case
+    # is that a script is interrupted and the file is left there.
+    prepared.tmp_out_path = '%s.wwup-%s' % (out_path, _TmpSuffix())
+
+    timer.Begin('copy')
+    try:
+      CopyFile(input_f, prepared.tmp_out_path)
+    except Exception:
+      prepared.Abort()
+      raise
+
+  try:
+    _FinishPrepare(prepared, policy, infolist, timer)
+  except Exception:
+    prepared.Abort()
+    raise
+  timer.End()
+  return prepared
+
+
+def _FinishPrepare(prepared, policy, infolist, timer):
+  tmp_out_path = prepared.tmp_out_path
+  out_path = prepared.out_path
+
+  # Upload() checks the size of the POST body, but files can also be
+  # assembled on the server, e.g. by DoDedup().
+  num_bytes = _FileSize(tmp_out_path)
+  max_bytes = policy.get('max_bytes', 10000)
+  if num_bytes > max_bytes:
+    raise RuntimeError('File %r is %d bytes, but only %d are allowed' %
+                       (prepared.filename, num_bytes, max_bytes))
 
-  CopyFile(input_f, tmp_out_path)
+  if infolist is not None and policy.get('repack_wwz', False):
+    timer.Begin('repack')
+    repacked_path = '%s.wwup-repack-%s' % (out_path, _TmpSuffix())
+    try:
+      prepared.repack_stats = RepackWwz(tmp_out_path, repacked_path)
+      os.rename(repacked_path, tmp_out_path)
+    except Exception:
+      # PrepareFile() removes tmp_out_path
+      if os.path.exists(repacked_path):
+        os.unlink(repacked_path)
+      raise
+    infolist = zipfile.ZipFile(tmp_out_path).infolist()
 
   # Make it read-only, just in case.  It still can be replaced by os.rename() or mv.
   os.chmod(tmp_out_path, 0o444)
-  os.rename(tmp_out_path, out_path)
+
+  # The index records the size and mtime of the archive, which rename()
+  # preserves.  Until the index is renamed too, wwz.py sees a stale index and
+  # ignores it.
+  timer.Begin('index')
+  if infolist is not None:
+    index = MakeServingIndex(infolist, tmp_out_path)
+    if index is not None:
+      prepared.tmp_index_path = '%s.wwup-%s' % (ServingIndexPath(out_path),
+                                                 _TmpSuffix())
+      WriteServingIndex(index, prepared.tmp_index_path)
+
+
+def CommitFile(prepared, environ, timer=None):
+  """Rename a prepared file into place, and return a summary of it."""
+  if timer is None:
+    timer = PhaseTimer()
+  out_path = prepared.out_path
+
+  # For the retention catalog
+  old_bytes = _FileSize(out_path) + _FileSize(ServingIndexPath(out_path))
+
+  timer.Begin('rename')
+  os.rename(prepared.tmp_out_path, out_path)
+  prepared.tmp_out_path = None
+  if prepared.tmp_index_path is not None:
+    os.rename(prepared.tmp_index_path, ServingIndexPath(out_path))
+    prepared.tmp_index_path = None
+  timer.End()
+
+  new_bytes = _FileSize(out_path) + _FileSize(ServingIndexPath(out_path))
 
   doc_root = environ['DOCUMENT_ROOT']
   rel_path = out_path[len(doc_root)+1 : ]
   http_host = environ['HTTP_HOST']
 
   # Trailing slash for .wwz
+  maybe_trailing_slash = '/' if prepared.num_wwz_entries != -1 else ''
   url = 'https://%s/%s%s' % (http_host, rel_path, maybe_trailing_slash)
 
-  return {
-      'filename': form_val.filename,
-      'num_wwz_entries': num_wwz_entries,
+  summary = {
+      'param': prepared.param_name,
+      'filename': prepared.filename,
+      'num_wwz_entries': prepared.num_wwz_entries,
+      'num_bytes': _FileSize(out_path),
       'out_path': out_path,
       'url': url,
+      'bytes_delta': new_bytes - old_bytes,
       }
-
-
-def GetFileValues(form):
-  # FieldStorage only supports 'in'
-  # - it doesn't support .get()
-  # - getvalue() gives a string
-
+  if prepared.repack_stats:
+    summary['repack'] = prepared.repack_stats
+  if prepared.unmatched_names:
+    summary['num_unmatched_names'] = len(prepared.unmatched_names)
+    summary['unmatched_names'] = (
+        prepared.unmatched_names[:MAX_UNMATCHED_SHOWN])
+  if prepared.unmatched_globs:
+    summary['unmatched_globs'] = prepared.unmatched_globs
+
+  timer.Add('num_files', 1)
+  timer.Add('num_bytes', _FileSize(out_path))
+  timer.Add('num_wwz_entries', max(prepared.num_wwz_entries, 0))
+  return summary
+
+
+def DoOneFile(param_name, policy, environ, form_val, out_dir, timer=None):
+  prepared = PrepareFile(param_name, policy, form_val, out_dir, timer=timer)
+  return CommitFile(prepared, environ, timer=timer)
+
+
+# Files of one upload are validated and copied on this many threads.
+# Checksums, zlib, and file I/O release the GIL.
+MAX_PREPARE_THREADS = 4
+
+
+def _MapThreads(func, args_list, num_threads):
+  """Call func(*args) for each args, on up to num_threads threads.
+
+  Returns a list of (result, exc_info) pairs, in the same order.
+  """
+  results = [None] * len(args_list)
+  work = Queue.Queue()
+  for i, args in enumerate(args_list):
+    work.put((i, args))
+
+  def Worker():
+    while True:
+      try:
+        i, args = work.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        results[i] = (func(*args), None)
+      except Exception:
+        results[i] = (None, sys.exc_info())
+
+  if len(args_list) <= 1:
+    Worker()  # no threads needed
+  else:
+    threads = [threading.Thread(target=Worker)
+               for _ in xrange(min(num_threads, len(args_list)))]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+  return results
+
+
+def PrepareFiles(policy, file_vals, out_dir, timer):
+  """Prepare all files concurrently.  If any of them fails, none are kept.
+
+  Each thread has its own PhaseTimer, so the phase times in the request log
+  are summed over threads.
+  """
+  args_list = [(param_name, policy, file_val, out_dir, PhaseTimer())
+               for param_name, file_val in file_vals]
+  results = _MapThreads(PrepareFile, args_list, MAX_PREPARE_THREADS)
+  for args in args_list:
+    timer.Merge(args[-1])
+
+  failed = [(args[0], args[2], exc_info)
+            for args, (_, exc_info) in zip(args_list, results)
+            if exc_info is not None]
+  if not failed:
+    return [prepared for prepared, _ in results]
+
+  for prepared, _ in results:
+    if prepared is not None:
+      prepared.Abort()
+
+  # Report the first failure
+  param_name, file_val, exc_info = failed[0]
+  if isinstance(exc_info[1], RuntimeError):
+    raise RuntimeError('%s %r: %s (%d of %d files failed, none were saved)' % (
+        param_name, file_val.filename, exc_info[1], len(failed),
+        len(file_vals)))
+  raise exc_info[0], exc_info[1], exc_info[2]
+
+
+_FILE_PARAM_RE = re.compile(r'^file([1-9][0-9]*)$')
+
+
+def GetFileValues(form, max_files):
+  """Return (param name, value) for file1= file2= ..., in order."""
   pairs = []
-  for k in ['file1', 'file2', 'file3']:
-    if k not in form:
-      break
-    pairs.append((k, form[k]))
-  return pairs
+  for k, form_val in form.iteritems():
+    m = _FILE_PARAM_RE.match(k)
+    if m:
+      pairs.append((int(m.group(1)), k, form_val))
+  pairs.sort()
 
+  if len(pairs) > max_files:
+    raise RuntimeError('Got %d files, but only %d are allowed' %
+                       (len(pairs), max_files))
 
-def Upload(environ, form, dest_base_dir):
+  filenames = set()
+  for _, k, form_val in pairs:
+    if form_val.filename in filenames:
+      raise RuntimeError('File %r was sent twice' % form_val.filename)
+    filenames.add(form_val.filename)
 
-  # Form field examples:
-  #   payload-type=osh-runtime
-  #   subdir=git-1ab435d
-  #   file1=@foo.wwz
+  return [(k, form_val) for _, k, form_val in pairs]
 
+
+def GetPolicy(form):
+  """Returns (payload type, policy)."""
   if 'payload-type' not in form:
     raise RuntimeError('Expected payload type')
   payload_type = form['payload-type'].value
@@ -359,14 +1336,10 @@ def Upload(environ, form, dest_base_dir):
   policy = PAYLOADS.get(payload_type)
   if policy is None:
     raise RuntimeError('Invalid payload type %r' % payload_type)
+  return payload_type, policy
 
-  num_bytes = int(environ['CONTENT_LENGTH'])
-  # Low limit of 10_000 by default
-  max_bytes = policy.get('max_bytes', 10000)
-  if num_bytes > max_bytes:
-      raise RuntimeError('POST body is %s bytes, but only %s are allowed' %
-          (num_bytes, max_bytes))
 
+def GetSubdir(form, policy):
   if 'subdir' not in form:
     raise RuntimeError('Expected subdir')
   subdir = form['subdir'].value
@@ -374,8 +1347,28 @@ def Upload(environ, form, dest_base_dir):
   error_str = ValidateSubdir(subdir, policy.get('subdir_depth', 1))
   if error_str:
     raise RuntimeError('Invalid subdir %r: %s' % (subdir, error_str))
+  return subdir
+
+
+def Upload(environ, form, dest_base_dir, timer=None):
+
+  # Form field examples:
+  #   payload-type=osh-runtime
+  #   subdir=git-1ab435d
+  #   file1=@foo.wwz
+
+  payload_type, policy = GetPolicy(form)
+
+  num_bytes = int(environ['CONTENT_LENGTH'])
+  # Low limit of 10_000 by default
+  max_bytes = policy.get('max_bytes', 10000)
+  if num_bytes > max_bytes:
+      raise RuntimeError('POST body is %s bytes, but only %s are allowed' %
+          (num_bytes, max_bytes))
+
+  subdir = GetSubdir(form, policy)
 
-  # Now process up to 3 files: file1=  file2=  file3=
+  # Now process file1=  file2=  ... up to the policy's max_files.
   # If the extension is .wwz, then open up the contents and validate it
 
   out_dir = os.path.join(dest_base_dir, payload_type, subdir)
@@ -385,24 +1378,1054 @@ def Upload(environ, form, dest_base_dir):
     if e.errno != errno.EEXIST:
       raise
 
+  if timer is None:
+    timer = PhaseTimer()
+
+  # Validate everything before any file is renamed into place
+  file_vals = GetFileValues(form, policy.get('max_files', 3))
+  prepared = PrepareFiles(policy, file_vals, out_dir, timer)
   summaries = []
+  try:
+    for p in prepared:
+      summaries.append(CommitFile(p, environ, timer=timer))
+  except Exception:
+    # Renames rarely fail, but don't leave the rest of the temp files behind
+    log('wwup: committed %d of %d files before an error', len(summaries),
+        len(prepared))
+    for p in prepared[len(summaries):]:
+      p.Abort()
+    raise
+
+  lines = [
+      '--- wwup.cgi Upload ---',
+      '',
+      'payload type = %s' % payload_type,
+      'subdir = %r' % subdir,
+      'num bytes = %r' % num_bytes,
+      '',
+  ]
+  for summary in summaries:
+    lines.append('summary = %r' % summary)
+  lines.append('')
+
+  lines.extend(AfterUpload(dest_base_dir, payload_type, policy, subdir,
+                           summaries, timer=timer))
+  return TextResponse(lines)
+
+
+#
+# Retention
+#
+# Each payload dir has an append-only catalog of its job dirs:
+#
+#   github-jobs/.wwup-catalog.tsv
+#     add  1718000000  7783  2400000    # upload time, subdir, bytes
+#     del  1728000000  7783  0
+#
+# so a cleanup pass doesn't have to walk and stat the whole tree.  It's
+# seeded by walking the tree once, and compacted when most lines are stale.
+#
+# After an upload, a background process deletes the oldest dirs that exceed
+# the policy, a few at a time.
+
+CATALOG_NAME = '.wwup-catalog.tsv'
+
+# Dirs this new may still be receiving uploads, so they're never deleted
+RETENTION_MIN_AGE_SECS = 3600
+# Delete this many dirs, then sleep, to limit the I/O load
+RETENTION_BATCH_SIZE = 10
+RETENTION_BATCH_SLEEP_SECS = 1.0
+# The rest waits for the next upload
+RETENTION_MAX_DELETES = 200
+# Uploads within this long of the last pass don't start another one
+RETENTION_INTERVAL_SECS = 600
+
+
+def _CatalogLock(payload_dir, op):
+  """Appends take a shared lock; compaction takes an exclusive one."""
+  lock_f = open(os.path.join(payload_dir, '.wwup-catalog.lock'), 'a')
+  fcntl.flock(lock_f, op)
+  return lock_f
+
+
+def _AppendCatalog(payload_dir, lines):
+  lock_f = _CatalogLock(payload_dir, fcntl.LOCK_SH)
+  try:
+    # O_APPEND writes of a few lines don't interleave
+    fd = os.open(os.path.join(payload_dir, CATALOG_NAME),
+                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+      os.write(fd, ''.join(lines))
+    finally:
+      os.close(fd)
+  finally:
+    lock_f.close()
+
+
+def _CatalogLine(op, timestamp, subdir, num_bytes):
+  return '%s\t%d\t%s\t%d\n' % (op, timestamp, subdir, num_bytes)
+
+
+def RecordUpload(payload_dir, depth, subdir, num_bytes, now):
+  if '\t' in subdir or '\n' in subdir:
+    return  # can't be represented, so it's never cleaned up
+  # The first upload seeds the catalog.  The walk skips this subdir, which is
+  # recorded by the line we append.
+  _EnsureCatalog(payload_dir, depth, exclude=subdir)
+  _AppendCatalog(payload_dir, [_CatalogLine('add', now, subdir, num_bytes)])
+
+
+def _DirBytes(path):
+  total = 0
+  for dir_path, _, names in os.walk(path):
+    for name in names:
+      try:
+        total += os.lstat(os.path.join(dir_path, name)).st_size
+      except OSError:
+        pass
+  return total
+
+
+def _SeedCatalog(payload_dir, depth, exclude=None):
+  """Walk the tree once, when there's no catalog yet.  Returns lines."""
+  lines = []
+  level = ['']
+  for _ in xrange(depth):
+    next_level = []
+    for prefix in level:
+      try:
+        names = sorted(os.listdir(os.path.join(payload_dir, prefix)))
+      except OSError:
+        continue
+      for name in names:
+        if name.startswith('.') or '\t' in name or '\n' in name:
+          continue
+        rel = os.path.join(prefix, name) if prefix else name
+        if os.path.isdir(os.path.join(payload_dir, rel)):
+          next_level.append(rel)
+    level = next_level
+
+  for subdir in level:
+    if subdir == exclude:
+      continue
+    path = os.path.join(payload_dir, subdir)
+    lines.append(_CatalogLine('add', os.path.getmtime(path), subdir,
+                              _DirBytes(path)))
+  return lines
+
+
+def _EnsureCatalog(payload_dir, depth, exclude=None):
+  """Seed the catalog if it doesn't exist.
+
+  This is done under the exclusive lock, so no upload appends a line before
+  the dirs that already exist are recorded.
+  """
+  path = os.path.join(payload_dir, CATALOG_NAME)
+  if os.path.exists(path):
+    return
+  lock_f = _CatalogLock(payload_dir, fcntl.LOCK_EX)
+  try:
+    if os.path.exists(path):
+      return  # another process seeded it
+    tmp_path = '%s.wwup-%s' % (path, _TmpSuffix())
+    with open(tmp_path, 'w') as f:
+      f.write(''.join(_SeedCatalog(payload_dir, depth, exclude=exclude)))
+    os.rename(tmp_path, path)
+  finally:
+    lock_f.close()
+
+
+def LoadCatalog(payload_dir, depth):
+  """Returns ({subdir: [first upload time, bytes]}, number of lines)."""
+  _EnsureCatalog(payload_dir, depth)
+  return _ReadCatalog(payload_dir)
+
+
+def _ReadCatalog(payload_dir):
+  path = os.path.join(payload_dir, CATALOG_NAME)
+  live = {}
+  num_lines = 0
+  with open(path) as f:
+    for line in f:
+      num_lines += 1
+      parts = line.rstrip('\n').split('\t')
+      if len(parts) != 4:
+        continue  # truncated
+      op, timestamp, subdir, num_bytes = parts
+      if op == 'add':
+        entry = live.get(subdir)
+        if entry is None:
+          live[subdir] = [int(timestamp), int(num_bytes)]
+        else:
+          entry[1] += int(num_bytes)
+      elif op == 'del':
+        live.pop(subdir, None)
+  return live, num_lines
+
+
+def _CompactCatalog(payload_dir):
+  """Rewrite the catalog with one line per live dir."""
+  path = os.path.join(payload_dir, CATALOG_NAME)
+  tmp_path = '%s.wwup-%s' % (path, _TmpSuffix())
+  lock_f = _CatalogLock(payload_dir, fcntl.LOCK_EX)
+  try:
+    # Read it again under the lock, since uploads may have appended lines
+    live, _ = _ReadCatalog(payload_dir)
+    with open(tmp_path, 'w') as f:
+      for subdir, (timestamp, num_bytes) in sorted(live.iteritems()):
+        f.write(_CatalogLine('add', timestamp, subdir, num_bytes))
+    os.rename(tmp_path, path)
+  finally:
+    lock_f.close()
+
+
+def PlanRetention(live, retention, now):
+  """Returns the subdirs to delete, oldest first."""
+  # Oldest first
+  by_age = sorted(live.iteritems(), key=lambda item: item[1][0])
+
+  max_age_days = retention.get('max_age_days')
+  max_jobs = retention.get('max_jobs')
+  max_total_bytes = retention.get('max_total_bytes')
+
+  num_jobs = len(by_age)
+  total_bytes = sum(num_bytes for _, (_, num_bytes) in by_age)
+
+  to_delete = []
+  for subdir, (timestamp, num_bytes) in by_age:
+    age = now - timestamp
+    if age < RETENTION_MIN_AGE_SECS:
+      break  # everything after this is newer
+
+    too_old = max_age_days is not None and age > max_age_days * 86400
+    too_many = max_jobs is not None and num_jobs > max_jobs
+    too_big = max_total_bytes is not None and total_bytes > max_total_bytes
+    if not (too_old or too_many or too_big):
+      break
 
-  file_vals = GetFileValues(form)
-  for param_name, file_val in file_vals:
-    summaries.append(DoOneFile(param_name, policy, environ, file_val, out_dir))
+    to_delete.append(subdir)
+    num_jobs -= 1
+    total_bytes -= num_bytes
+  return to_delete
 
-  PrintStatusOk()
 
-  print('--- wwup.cgi Upload ---')
-  print('')
-  print('payload type = %s' % payload_type)
-  print('subdir = %r' % subdir)
-  print('num bytes = %r' % num_bytes)
-  print('')
+def RunRetention(dest_base_dir, payload_type, now=None, sleep=time.sleep):
+  """Delete old job dirs of a payload type.  Returns the ones deleted."""
+  policy = PAYLOADS[payload_type]
+  retention = policy.get('retention')
+  if retention is None:
+    return []
+
+  payload_dir = os.path.join(dest_base_dir, payload_type)
+  if now is None:
+    now = time.time()
+
+  # Only one pass per payload dir at a time
+  lock_f = open(os.path.join(payload_dir, '.wwup-retention.lock'), 'a')
+  try:
+    try:
+      fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+      return []
+
+    live, num_lines = LoadCatalog(payload_dir, policy.get('subdir_depth', 1))
+    to_delete = PlanRetention(live, retention, now)[:RETENTION_MAX_DELETES]
+
+    real_payload_dir = os.path.realpath(payload_dir)
+    deleted = []
+    for i, subdir in enumerate(to_delete):
+      if i and i % RETENTION_BATCH_SIZE == 0:
+        sleep(RETENTION_BATCH_SLEEP_SECS)
+
+      path = os.path.join(payload_dir, subdir)
+      # Paranoia, since the catalog is a file on disk
+      if (ValidateSubdir(subdir, policy.get('subdir_depth', 1)) or
+          not os.path.realpath(path).startswith(real_payload_dir + '/')):
+        log('wwup: invalid subdir in catalog: %r', subdir)
+        continue
+
+      shutil.rmtree(path, ignore_errors=True)
+      _AppendCatalog(payload_dir, [_CatalogLine('del', now, subdir, 0)])
+      deleted.append(subdir)
+
+    # Most lines are dead
+    if num_lines > 2 * (len(live) - len(deleted)) + 1000:
+      _CompactCatalog(payload_dir)
+  finally:
+    lock_f.close()
+
+  return deleted
+
+
+def _RetentionDue(payload_dir, now):
+  """Touch the stamp file if a pass is due, and return whether it was."""
+  stamp_path = os.path.join(payload_dir, '.wwup-retention.stamp')
+  try:
+    if now - os.path.getmtime(stamp_path) < RETENTION_INTERVAL_SECS:
+      return False
+  except OSError:
+    pass  # no pass yet
+  with open(stamp_path, 'a'):
+    pass
+  os.utime(stamp_path, (now, now))
+  return True
+
+
+def SpawnRetention(dest_base_dir, payload_type):
+  """Run a cleanup pass in a process that outlives this CGI request.
+
+  At most one is started every RETENTION_INTERVAL_SECS per payload type.
+  """
+  if not _RetentionDue(os.path.join(dest_base_dir, payload_type), time.time()):
+    return
+  argv = [sys.executable, os.path.abspath(__file__), 'cleanup', dest_base_dir,
+          payload_type]
+  with open(os.devnull, 'r+') as null_f:
+    subprocess.Popen(argv, stdin=null_f, stdout=null_f, stderr=null_f,
+                     close_fds=True, preexec_fn=os.setsid)
+
+
+#
+# TSV aggregation
+#
+# Rows of TSV files matching the 'aggregate_tsv' globs are appended to one
+# merged file per source path, with a leading subdir column:
+#
+#   osh-runtime/
+#     .wwup-aggregate/
+#       manifest.tsv                    # subdir, source path, rows, crc32
+#       merged/osh-runtime/times.tsv    # subdir, then the columns of times.tsv
+#
+# The manifest records what's been merged, so a retried upload isn't merged
+# twice.  Each upload costs time proportional to its own size.
+
+AGGREGATE_DIR = '.wwup-aggregate'
+
+
+def _ReadManifest(agg_dir):
+  merged = set()
+  try:
+    f = open(os.path.join(agg_dir, 'manifest.tsv'))
+  except IOError:
+    return merged
+  with f:
+    for line in f:
+      parts = line.rstrip('\n').split('\t')
+      if len(parts) == 4:
+        merged.add((parts[0], parts[1]))
+  return merged
+
+
+def _AppendFile(path, s):
+  fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+  try:
+    os.write(fd, s)
+  finally:
+    os.close(fd)
+
+
+def _MergeTsv(agg_dir, subdir, source, contents):
+  """Append rows of one TSV file.  Returns the number of rows.
+
+  Raises RuntimeError if the header doesn't match.
+  """
+  lines = contents.splitlines()
+  if not lines:
+    raise RuntimeError('%s is empty' % source)
+  header = lines[0].split('\t')
+  for i, line in enumerate(lines[1:]):
+    if line.count('\t') != len(header) - 1:
+      raise RuntimeError('%s line %d has %d columns, expected %d' %
+                         (source, i + 2, line.count('\t') + 1, len(header)))
+
+  out_path = os.path.join(agg_dir, 'merged', source)
+  new_header = '\t'.join(['subdir'] + header)
+  if os.path.exists(out_path):
+    with open(out_path) as f:
+      existing = f.readline().rstrip('\n')
+    if existing != new_header:
+      raise RuntimeError('%s has header %r, but the merged file has %r' %
+                         (source, new_header, existing))
+    parts = []
+  else:
+    _MakeDirs(os.path.dirname(out_path))
+    parts = [new_header, '\n']
+
+  for line in lines[1:]:
+    parts.extend([subdir, '\t', line, '\n'])
+  _AppendFile(out_path, ''.join(parts))
+  return len(lines) - 1
+
+
+def _TsvSources(summaries, globs):
+  """Yield (source path, contents) for uploaded files matching the globs."""
+  def Matches(name):
+    return any(fnmatch.fnmatchcase(name, g) for g in globs)
 
   for summary in summaries:
-    print('summary = %r' % summary)
-  print('')
+    filename = summary['filename']
+    if filename.endswith('.wwz'):
+      with open(summary['out_path'], 'rb') as f:
+        z = zipfile.ZipFile(f)
+        for name in z.namelist():
+          if Matches(name):
+            yield name, z.read(name)
+    elif Matches(filename):
+      with open(summary['out_path']) as f:
+        yield filename, f.read()
+
+
+def AggregateTsv(payload_dir, subdir, globs, summaries):
+  """Merge TSV files of an upload.  Returns a list of messages."""
+  agg_dir = os.path.join(payload_dir, AGGREGATE_DIR)
+  _MakeDirs(agg_dir)
+
+  messages = []
+  lock_f = open(os.path.join(agg_dir, 'lock'), 'a')
+  fcntl.flock(lock_f, fcntl.LOCK_EX)  # serialize concurrent uploads
+  try:
+    merged = _ReadManifest(agg_dir)
+    manifest_lines = []
+    for source, contents in _TsvSources(summaries, globs):
+      if '..' in source.split('/') or source.startswith('/'):
+        continue  # DoOneFile already rejected these
+      if (subdir, source) in merged:
+        messages.append('aggregate: %s of %s was already merged' %
+                        (source, subdir))
+        continue
+      try:
+        num_rows = _MergeTsv(agg_dir, subdir, source, contents)
+      except RuntimeError as e:
+        messages.append('aggregate: skipped %s' % e)
+        continue
+      manifest_lines.append('%s\t%s\t%d\t%08x\n' %
+          (subdir, source, num_rows, zlib.crc32(contents) & 0xFFFFFFFF))
+      messages.append('aggregate: merged %d rows of %s' % (num_rows, source))
+
+    if manifest_lines:
+      _AppendFile(os.path.join(agg_dir, 'manifest.tsv'), ''.join(manifest_lines))
+  finally:
+    lock_f.close()
+  return messages
+
+
+def AfterUpload(dest_base_dir, payload_type, policy, subdir, summaries,
+                timer=None):
+  """Returns lines for the response."""
+  payload_dir = os.path.join(dest_base_dir, payload_type)
+  lines = []
+
+  globs = policy.get('aggregate_tsv')
+  if globs:
+    if timer:
+      timer.Begin('aggregate')
+    lines.extend(AggregateTsv(payload_dir, subdir, globs, summaries))
+    lines.append('')
+    if timer:
+      timer.End()
+
+  if 'retention' in policy:
+    num_bytes = sum(summary['bytes_delta'] for summary in summaries)
+    RecordUpload(payload_dir, policy.get('subdir_depth', 1), subdir,
+                 num_bytes, time.time())
+    SpawnRetention(dest_base_dir, payload_type)
+
+  return lines
+
+
+#
+# Resumable uploads
+#
+# A client uploads a big file in numbered chunks, and can resume after a
+# failure by asking which chunks the server has:
+#
+#   upload-session=open    payload-type= subdir= filename= size= sha256=
+#                          [chunk-size=]  -> session ID
+#   upload-session=chunk   session= index= chunk=@FILE
+#   upload-session=status  session=       -> JSON with the chunks we have
+#   upload-session=commit  session=       -> like a normal upload
+#
+# Chunks are stored in $dest_base_dir/.wwup-sessions/$ID/.  On commit, they're
+# concatenated, the SHA-256 is checked, and the file goes through DoOneFile()
+# like any other upload.
+
+SESSIONS_DIR = '.wwup-sessions'
+DEFAULT_SESSION_CHUNK_BYTES = 1024 * 1024
+MAX_SESSION_CHUNKS = 10000
+# Abandoned sessions are removed when a new one is opened
+SESSION_MAX_AGE_SECS = 24 * 3600
+
+_SESSION_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+class UploadSession(object):
+
+  def __init__(self, session_dir, meta):
+    self.session_dir = session_dir
+    self.meta = meta  # dict that's saved in session.json
+
+  @staticmethod
+  def Open(sessions_dir, session_id):
+    if not _SESSION_ID_RE.match(session_id):
+      raise RuntimeError('Invalid session %r' % session_id)
+    session_dir = os.path.join(sessions_dir, session_id)
+    try:
+      with open(os.path.join(session_dir, 'session.json')) as f:
+        meta = json.load(f)
+    except (IOError, ValueError):
+      raise RuntimeError('No upload session %r' % session_id)
+    return UploadSession(session_dir, meta)
+
+  def NumChunks(self):
+    size = self.meta['size']
+    chunk_size = self.meta['chunk_size']
+    return max((size + chunk_size - 1) // chunk_size, 1)
+
+  def ChunkBytes(self, index):
+    """The expected size of a chunk; the last one may be short."""
+    if index < self.NumChunks() - 1:
+      return self.meta['chunk_size']
+    return self.meta['size'] - index * self.meta['chunk_size']
+
+  def ChunkPath(self, index):
+    return os.path.join(self.session_dir, 'chunk-%06d' % index)
+
+  def HaveChunks(self):
+    have = []
+    for i in xrange(self.NumChunks()):
+      try:
+        size = os.path.getsize(self.ChunkPath(i))
+      except OSError:
+        continue
+      if size == self.ChunkBytes(i):
+        have.append(i)
+    return have
+
+  def PutChunk(self, index, form_val):
+    if not (0 <= index < self.NumChunks()):
+      raise RuntimeError('Chunk index %d out of range' % index)
+
+    tmp_path = getattr(form_val, 'tmp_path', None)
+    if tmp_path is None:
+      tmp_path = '%s.wwup-%s' % (self.ChunkPath(index), _TmpSuffix())
+      CopyFile(form_val.file, tmp_path)
+    else:
+      form_val.file.close()
+      form_val.tmp_path = None  # so CleanupForm() doesn't remove it
+
+    size = os.path.getsize(tmp_path)
+    expected = self.ChunkBytes(index)
+    if size != expected:
+      os.unlink(tmp_path)
+      raise RuntimeError('Chunk %d is %d bytes, expected %d' %
+                         (index, size, expected))
+
+    # A chunk that's sent again replaces the old one
+    os.rename(tmp_path, self.ChunkPath(index))
+    return size
+
+  def Assemble(self):
+    """Concatenate the chunks and check the hash.
+
+    Returns the path of the whole file, inside the session dir.
+    """
+    have = self.HaveChunks()
+    if len(have) != self.NumChunks():
+      missing = sorted(set(xrange(self.NumChunks())) - set(have))
+      raise RuntimeError('Missing chunks %s' % missing[:20])
+
+    out_path = os.path.join(self.session_dir, 'assembled')
+    h = hashlib.sha256()
+    with open(out_path, 'wb') as out_f:
+      for i in xrange(self.NumChunks()):
+        with open(self.ChunkPath(i), 'rb') as in_f:
+          while True:
+            chunk = in_f.read(CHUNK_SIZE)
+            if not chunk:
+              break
+            h.update(chunk)
+            out_f.write(chunk)
+
+    if h.hexdigest() != self.meta['sha256']:
+      os.unlink(out_path)
+      raise RuntimeError('SHA-256 mismatch: got %s, expected %s' %
+                         (h.hexdigest(), self.meta['sha256']))
+    return out_path
+
+  def LockCommit(self):
+    """Take an exclusive lock on the session, or raise Conflict.
+
+    Returns a file to close when the commit is done.
+    """
+    try:
+      lock_f = open(os.path.join(self.session_dir, 'commit.lock'), 'a')
+    except IOError:
+      raise RuntimeError('No upload session %r' % self.meta['session_id'])
+    try:
+      fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+      lock_f.close()
+      raise Conflict('Upload session %r is already being committed' %
+                     self.meta['session_id'])
+
+    # The commit that held the lock may have removed the session
+    if not os.path.exists(os.path.join(self.session_dir, 'session.json')):
+      lock_f.close()
+      raise RuntimeError('No upload session %r' % self.meta['session_id'])
+    return lock_f
+
+  def Remove(self):
+    shutil.rmtree(self.session_dir, ignore_errors=True)
+
+
+def _PruneSessions(sessions_dir, now):
+  for name in os.listdir(sessions_dir):
+    path = os.path.join(sessions_dir, name)
+    try:
+      if now - os.path.getmtime(path) > SESSION_MAX_AGE_SECS:
+        shutil.rmtree(path, ignore_errors=True)
+    except OSError:
+      pass
+
+
+def _IntField(form, name):
+  if name not in form:
+    raise RuntimeError('Expected %s' % name)
+  try:
+    return int(form[name].value)
+  except ValueError:
+    raise RuntimeError('Expected %s to be an integer' % name)
+
+
+def _OpenSession(form, sessions_dir):
+  payload_type, policy = GetPolicy(form)
+  subdir = GetSubdir(form, policy)
+
+  if 'filename' not in form:
+    raise RuntimeError('Expected filename')
+  filename = form['filename'].value
+  # It's joined to out_dir, like an uploaded file name
+  if '/' in filename or filename.startswith('.'):
+    raise RuntimeError('Invalid filename %r' % filename)
+
+  size = _IntField(form, 'size')
+  max_bytes = policy.get('max_bytes', 10000)
+  if not (0 <= size <= max_bytes):
+    raise RuntimeError('File is %d bytes, but only %d are allowed' %
+                       (size, max_bytes))
+
+  if 'sha256' not in form:
+    raise RuntimeError('Expected sha256')
+  sha256 = form['sha256'].value.lower()
+  if not re.match(r'^[0-9a-f]{64}$', sha256):
+    raise RuntimeError('Invalid sha256 %r' % sha256)
+
+  if 'chunk-size' in form:
+    chunk_size = _IntField(form, 'chunk-size')
+  else:
+    chunk_size = DEFAULT_SESSION_CHUNK_BYTES
+  if not (0 < chunk_size <= MAX_POST_BYTES):
+    raise RuntimeError('Invalid chunk size %d' % chunk_size)
+  if (size + chunk_size - 1) // chunk_size > MAX_SESSION_CHUNKS:
+    raise RuntimeError('Too many chunks; use a bigger chunk size')
+
+  _MakeDirs(sessions_dir)
+  _PruneSessions(sessions_dir, time.time())
+
+  session_id = os.urandom(16).encode('hex')
+  session_dir = os.path.join(sessions_dir, session_id)
+  os.mkdir(session_dir, 0o700)
+
+  meta = {
+      'session_id': session_id,
+      'payload_type': payload_type,
+      'subdir': subdir,
+      'filename': filename,
+      'size': size,
+      'sha256': sha256,
+      'chunk_size': chunk_size,
+      'created': time.time(),
+  }
+  with open(os.path.join(session_dir, 'session.json'), 'w') as f:
+    json.dump(meta, f, indent=2, sort_keys=True)
+  return UploadSession(session_dir, meta)
+
+
+def _SessionStatus(session):
+  status = dict(session.meta)
+  status['num_chunks'] = session.NumChunks()
+  status['have_chunks'] = session.HaveChunks()
+  return JsonResponse(status)
+
+
+def DoUploadSession(environ, form, dest_base_dir, timer=None):
+  sessions_dir = os.path.join(dest_base_dir, SESSIONS_DIR)
+  action = form['upload-session'].value
+
+  if action == 'open':
+    session = _OpenSession(form, sessions_dir)
+    return _SessionStatus(session)
+
+  if 'session' not in form:
+    raise RuntimeError('Expected session')
+  session = UploadSession.Open(sessions_dir, form['session'].value)
+
+  if action == 'status':
+    return _SessionStatus(session)
+
+  elif action == 'chunk':
+    index = _IntField(form, 'index')
+    if 'chunk' not in form or form['chunk'].filename is None:
+      raise RuntimeError('Expected chunk to be a file')
+    size = session.PutChunk(index, form['chunk'])
+    return TextResponse(['chunk %d: %d bytes' % (index, size)])
+
+  elif action == 'commit':
+    meta = session.meta
+    policy = PAYLOADS[meta['payload_type']]
+    out_dir = os.path.join(dest_base_dir, meta['payload_type'], meta['subdir'])
+    _MakeDirs(out_dir)
+
+    lock_f = session.LockCommit()
+    try:
+      if timer:
+        timer.fields['payload_type'] = meta['payload_type']
+        timer.Begin('copy')
+      path = session.Assemble()
+      form_val = FormValue('file1', filename=meta['filename'], tmp_path=path)
+      try:
+        summary = DoOneFile('file1', policy, environ, form_val, out_dir,
+                            timer=timer)
+      finally:
+        CleanupForm({'file1': form_val})
+      session.Remove()
+    finally:
+      lock_f.close()
+
+    lines = [
+        '--- wwup.cgi Upload ---',
+        '',
+        'payload type = %s' % meta['payload_type'],
+        'subdir = %r' % meta['subdir'],
+        'num bytes = %r' % meta['size'],
+        '',
+        'summary = %r' % summary,
+        '',
+    ]
+    lines.extend(AfterUpload(dest_base_dir, meta['payload_type'], policy,
+                             meta['subdir'], [summary], timer=timer))
+    return TextResponse(lines)
+
+  else:
+    raise RuntimeError('Invalid upload-session action %r' % action)
+
+
+#
+# Deduplicating uploads
+#
+# Successive CI jobs upload archives that are mostly the same, member for
+# member.  So a client can send a manifest first, and then only the members
+# the server doesn't have:
+#
+#   dedup=manifest  payload-type= subdir= filename=foo.wwz manifest=@FILE
+#                   -> session ID, and the SHA-256 of each missing member
+#   dedup=blobs     session= blob1=@FILE blob2=@FILE ...
+#   dedup=commit    session=   -> like a normal upload
+#
+# The manifest has one line per member: name, size, CRC-32 (hex), SHA-256,
+# and the time in the zip as YYYYmmddHHMMSS.
+# Members are stored by SHA-256 in $dest_base_dir/.wwup-blobs/, shared by all
+# payload types.  On commit, the .wwz is assembled from the store and goes
+# through DoOneFile() like any other upload, since wwz.py serves zip files.
+
+BLOBS_DIR = '.wwup-blobs'
+# Blobs that no manifest has referred to for this long are removed
+BLOB_MAX_AGE_SECS = 30 * 24 * 3600
+BLOB_PRUNE_INTERVAL_SECS = 24 * 3600
+
+_SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+def MakeDedupManifest(z):
+  """Return the manifest of a zipfile.ZipFile, as a client would send it."""
+  lines = []
+  for info in z.infolist():
+    data = z.read(info)
+    lines.append('%s\t%d\t%08x\t%s\t%04d%02d%02d%02d%02d%02d\n' % (
+        (info.filename, len(data), zlib.crc32(data) & 0xFFFFFFFF,
+         hashlib.sha256(data).hexdigest()) + info.date_time))
+  return ''.join(lines)
+
+
+def ParseDedupManifest(text):
+  """Returns a list of [name, size, crc32, sha256, date_time]."""
+  entries = []
+  for i, line in enumerate(text.splitlines()):
+    parts = line.split('\t')
+    if len(parts) != 5:
+      raise RuntimeError('Manifest line %d should have 5 fields' % (i + 1))
+    name, size, crc, sha256, date_time = parts
+    try:
+      size = int(size)
+      crc = int(crc, 16)
+      # The member's time in the zip, like 20240131235958
+      date_time = list(time.strptime(date_time, '%Y%m%d%H%M%S')[:6])
+    except ValueError:
+      raise RuntimeError('Manifest line %d has an invalid size, CRC, or time' %
+                         (i + 1))
+    if size < 0 or not _SHA256_RE.match(sha256) or date_time[0] < 1980:
+      raise RuntimeError('Manifest line %d is invalid' % (i + 1))
+    entries.append([name, size, crc, sha256, date_time])
+  return entries
+
+
+class BlobStore(object):
+  """Files named by the SHA-256 of their contents."""
+
+  def __init__(self, blob_dir):
+    self.blob_dir = blob_dir
+
+  def Path(self, sha256):
+    return os.path.join(self.blob_dir, sha256[:2], sha256)
+
+  def Touch(self, sha256):
+    """Returns whether we have the blob, and marks it as used."""
+    try:
+      os.utime(self.Path(sha256), None)
+      return True
+    except OSError:
+      return False
+
+  def Put(self, sha256, tmp_path):
+    path = self.Path(sha256)
+    _MakeDirs(os.path.dirname(path))
+    os.chmod(tmp_path, 0o444)
+    os.rename(tmp_path, path)  # the same contents may already be there
+
+  def Read(self, sha256):
+    """Returns the contents, or None if the blob was pruned."""
+    try:
+      f = open(self.Path(sha256), 'rb')
+    except IOError as e:
+      if e.errno != errno.ENOENT:
+        raise
+      return None
+    with f:
+      return f.read()
+
+  def Prune(self, now):
+    """Remove unused blobs.  This walks the store, so only do it daily."""
+    marker = os.path.join(self.blob_dir, '.pruned')
+    try:
+      if now - os.path.getmtime(marker) < BLOB_PRUNE_INTERVAL_SECS:
+        return 0
+    except OSError:
+      pass
+    with open(marker, 'w'):
+      pass
+
+    num_removed = 0
+    for prefix in os.listdir(self.blob_dir):
+      d = os.path.join(self.blob_dir, prefix)
+      if not os.path.isdir(d):
+        continue
+      for name in os.listdir(d):
+        path = os.path.join(d, name)
+        try:
+          if now - os.path.getmtime(path) > BLOB_MAX_AGE_SECS:
+            os.unlink(path)
+            num_removed += 1
+        except OSError:
+          pass
+    return num_removed
+
+
+def _FileSha256(path):
+  h = hashlib.sha256()
+  with open(path, 'rb') as f:
+    while True:
+      chunk = f.read(CHUNK_SIZE)
+      if not chunk:
+        break
+      h.update(chunk)
+  return h.hexdigest()
+
+
+def _DedupSessionPath(sessions_dir, session_id):
+  if not _SESSION_ID_RE.match(session_id):
+    raise RuntimeError('Invalid session %r' % session_id)
+  return os.path.join(sessions_dir, session_id, 'dedup.json')
+
+
+def _ReadDedupSession(sessions_dir, form):
+  if 'session' not in form:
+    raise RuntimeError('Expected session')
+  path = _DedupSessionPath(sessions_dir, form['session'].value)
+  try:
+    with open(path) as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    raise RuntimeError('No dedup session %r' % form['session'].value)
+
+
+def _MissingBlobs(store, entries):
+  missing = set()
+  for _, size, _, sha256, _ in entries:
+    if size and not store.Touch(sha256):
+      missing.add(sha256)
+  return sorted(missing)
+
+
+def _DedupStatus(meta, missing):
+  return JsonResponse({'session_id': meta['session_id'], 'missing': missing})
+
+
+def AssembleWwz(store, entries, out_path):
+  """Write a .wwz from blobs, checking the CRC-32 of each member.
+
+  Members are ordered and compressed like RepackWwz() does, so the archive
+  isn't repacked again.
+  """
+  rows = []
+  for name, size, crc, sha256, date_time in entries:
+    info = zipfile.ZipInfo(name, tuple(date_time))
+    info.external_attr = 0o644 << 16
+    rows.append((info, size, crc, sha256))
+  rows.sort(key=lambda row: _RepackOrder(row[0]))
+
+  z = zipfile.ZipFile(out_path, 'w', allowZip64=True)
+  try:
+    for info, size, crc, sha256 in rows:
+      data = store.Read(sha256) if size else ''
+      if data is None:
+        # Pruned after the client was told what's missing
+        raise RuntimeError('Missing %d blobs' %
+                           len(_MissingBlobs(store, entries)))
+      if len(data) != size or zlib.crc32(data) & 0xFFFFFFFF != crc:
+        raise RuntimeError('Member %r doesn\'t match its size and CRC' %
+                           info.filename)
+      info.compress_type = _RepackMethod(info.filename, data)
+      z.writestr(info, data)
+  finally:
+    z.close()
+
+
+def DoDedup(environ, form, dest_base_dir, timer=None):
+  sessions_dir = os.path.join(dest_base_dir, SESSIONS_DIR)
+  store = BlobStore(os.path.join(dest_base_dir, BLOBS_DIR))
+  action = form['dedup'].value
+
+  if action == 'manifest':
+    payload_type, policy = GetPolicy(form)
+    subdir = GetSubdir(form, policy)
+
+    if 'filename' not in form:
+      raise RuntimeError('Expected filename')
+    filename = form['filename'].value
+    if ('/' in filename or filename.startswith('.') or
+        not filename.endswith('.wwz')):
+      raise RuntimeError('Invalid filename %r' % filename)
+
+    if 'manifest' not in form:
+      raise RuntimeError('Expected manifest')
+    manifest_val = form['manifest']
+    if manifest_val.file is not None:
+      text = manifest_val.file.read()
+    else:
+      text = manifest_val.value
+
+    entries = ParseDedupManifest(text)
+    # Check what we can before the members are uploaded.  DoOneFile() checks
+    # everything again on commit.
+    CheckWwzNames(policy, [name for name, _, _, _, _ in entries])
+    total = sum(size for _, size, _, _, _ in entries)
+    max_uncompressed_bytes = policy.get('max_uncompressed_bytes',
+                                        10 * policy.get('max_bytes', 10000))
+    if total > max_uncompressed_bytes:
+      raise RuntimeError('wwz expands to %d bytes, but only %d are allowed' %
+                         (total, max_uncompressed_bytes))
+
+    _MakeDirs(sessions_dir)
+    _PruneSessions(sessions_dir, time.time())
+    session_id = os.urandom(16).encode('hex')
+    os.mkdir(os.path.join(sessions_dir, session_id), 0o700)
+    meta = {
+        'session_id': session_id,
+        'payload_type': payload_type,
+        'subdir': subdir,
+        'filename': filename,
+        'entries': entries,
+        'created': time.time(),
+    }
+    with open(_DedupSessionPath(sessions_dir, session_id), 'w') as f:
+      json.dump(meta, f)
+
+    return _DedupStatus(meta, _MissingBlobs(store, entries))
+
+  elif action == 'blobs':
+    meta = _ReadDedupSession(sessions_dir, form)
+    wanted = dict((sha256, size) for _, size, _, sha256, _ in meta['entries'])
+
+    num_blobs = 0
+    for name, form_val in sorted(form.iteritems()):
+      if not name.startswith('blob') or form_val.filename is None:
+        continue
+      tmp_path = form_val.tmp_path
+      form_val.file.close()
+      sha256 = _FileSha256(tmp_path)
+      if wanted.get(sha256) != os.path.getsize(tmp_path):
+        raise RuntimeError('%s isn\'t a member in the manifest' % name)
+      store.Put(sha256, tmp_path)
+      form_val.tmp_path = None  # so CleanupForm() doesn't remove it
+      num_blobs += 1
+
+    if not num_blobs:
+      raise RuntimeError('Expected blob1=, blob2=, ...')
+    return _DedupStatus(meta, _MissingBlobs(store, meta['entries']))
+
+  elif action == 'commit':
+    meta = _ReadDedupSession(sessions_dir, form)
+    missing = _MissingBlobs(store, meta['entries'])
+    if missing:
+      raise RuntimeError('Missing %d blobs' % len(missing))
+
+    policy = PAYLOADS[meta['payload_type']]
+    out_dir = os.path.join(dest_base_dir, meta['payload_type'], meta['subdir'])
+    _MakeDirs(out_dir)
+    if timer:
+      timer.fields['payload_type'] = meta['payload_type']
+      timer.Begin('copy')
+
+    session_dir = os.path.dirname(_DedupSessionPath(sessions_dir,
+                                                    meta['session_id']))
+    path = os.path.join(session_dir, 'assembled')
+    AssembleWwz(store, meta['entries'], path)
+
+    # AssembleWwz() already chose the compression of each member
+    policy = dict(policy, repack_wwz=False)
+    form_val = FormValue('file1', filename=meta['filename'], tmp_path=path)
+    try:
+      summary = DoOneFile('file1', policy, environ, form_val, out_dir,
+                          timer=timer)
+    finally:
+      CleanupForm({'file1': form_val})
+    shutil.rmtree(session_dir, ignore_errors=True)
+
+    lines = [
+        '--- wwup.cgi Upload ---',
+        '',
+        'payload type = %s' % meta['payload_type'],
+        'subdir = %r' % meta['subdir'],
+        '',
+        'summary = %r' % summary,
+        '',
+    ]
+    lines.extend(AfterUpload(dest_base_dir, meta['payload_type'], policy,
+                             meta['subdir'], [summary], timer=timer))
+    return TextResponse(lines)
+
+  else:
+    raise RuntimeError('Invalid dedup action %r' % action)
 
 
 def GetMoreArgv(form):
@@ -415,44 +2438,481 @@ def GetMoreArgv(form):
   return argv
 
 
-def RunHook(environ, home_dir, hook_config, form):
+class _QueueWriter(object):
+  """A file for RunHookProcess(echo_f=), read by another thread."""
+
+  def __init__(self):
+    self.q = Queue.Queue()
+
+  def write(self, s):
+    self.q.put(s)
+
+  def flush(self):
+    pass
+
+
+def _EchoHook(argv, log_path, max_log_bytes, header, finish):
+  """Yield the output of a hook as it's produced."""
+  yield header
+
+  echo_f = _QueueWriter()
+  results = []
+  def Run():
+    try:
+      results.append(RunHookProcess(argv, log_path, max_log_bytes,
+                                    echo_f=echo_f))
+    finally:
+      echo_f.q.put(None)
+
+  t = threading.Thread(target=Run)
+  t.start()
+  try:
+    while True:
+      chunk = echo_f.q.get()
+      if chunk is None:
+        break
+      yield chunk
+  finally:
+    t.join()  # even if the client went away, so the job is recorded
+
+  if not results:
+    raise RuntimeError('Hook %r failed to run' % argv)
+  yield finish(results[0])
+
+
+def RunHook(environ, home_dir, hook_config, form, hook_name=None, echo=False,
+            timer=None):
+  """Run a hook synchronously, in the request.  See QueueHook().
+
+  Its output goes to a log in the hook queue dir, and is then returned.  With
+  echo=True, the body yields it as it's produced, but the HTTP status must be
+  sent before we know the exit status.
+  """
+  argv = HookArgv(home_dir, hook_config, form)
+
+  queue = HookQueue(os.path.join(home_dir, HOOK_QUEUE_DIR))
+  queue.Init()
+  job = queue.NewJob(hook_name or hook_config['argv0'], argv)
+  job.update(state='running', started=time.time(), sync=True,
+             pid=os.getpid())
+  queue.WriteJob(job)
+  log_path = queue.JobPath(job['job_id'], '.log')
+
+  header = ''.join(line + '\n' for line in [
+      '--- wwup.cgi run-hook ---',
+      'hook %r' % hook_config,
+      'argv %r' % argv,
+      'job_id %s' % job['job_id'],
+      '',
+      '--- OUTPUT:',
+      '',
+  ])
+
+  def Finish(result):
+    """Record the job, and return the end of the response."""
+    job.update(result)
+    job.update(state='done', finished=time.time())
+    queue.WriteJob(job)
+    if timer:
+      timer.End()
+      if result['status'] != 0:
+        timer.status = 500
+
+    return ''.join(line + '\n' for line in [
+        '',
+        '--- STATUS: %d' % result['status'],
+        'wall %(wall_secs).3f s, user %(user_secs).3f s, sys %(sys_secs).3f s, '
+        'log %(log_bytes)d bytes' % result,
+        '',
+    ])
+
+  if timer:
+    timer.Begin('hook')
+  max_log_bytes = hook_config.get('max_log_bytes', HOOK_MAX_LOG_BYTES)
+  if echo:
+    return '200 OK', list(TEXT_HEADERS), _EchoHook(
+        argv, log_path, max_log_bytes, header, Finish)
+
+  result = RunHookProcess(argv, log_path, max_log_bytes)
+  chunks = [header]
+  with open(log_path) as f:
+    while True:
+      chunk = f.read(CHUNK_SIZE)
+      if not chunk:
+        break
+      chunks.append(chunk)
+  chunks.append(Finish(result))
+
+  if result['status'] == 0:
+    status = '200 OK'
+  else:
+    status = '500 Internal Server Error'
+  return status, list(TEXT_HEADERS), chunks
+
+
+#
+# Hook queue
+#
+# Hooks run in a background process, so the HTTP request returns immediately.
+#
+#   ~/.wwup/hook-queue/
+#     runner.lock         # flock() held by the single runner
+#     runner.log
+#     jobs/
+#       $JOB_ID.json      # state, argv, times, exit status
+#       $JOB_ID.log       # stdout and stderr of the hook
+#     pending/
+#       $KEY              # hard link to jobs/$JOB_ID.json, where KEY is a
+#                         # hash of the argv
+#
+# Creating the link in pending/ is atomic, so two identical submissions
+# coalesce into one job.  The runner removes the link before it starts the
+# job, so a submission after that runs it again.
+
+HOOK_QUEUE_DIR = '.wwup/hook-queue'  # relative to $HOME
+
+# Hook output is copied to the log as it's produced, up to this many bytes.
+# The rest is read and dropped, so the hook doesn't block.
+HOOK_MAX_LOG_BYTES = 10 * 1000 * 1000
+HOOK_CHUNK_SIZE = 4096
+
+RUNNER_POLL_SECS = 0.1
+# Wait this long for more jobs before exiting
+RUNNER_IDLE_SECS = 5.0
+# Remove records of finished jobs after a week
+JOB_RETENTION_SECS = 7 * 24 * 3600
+
+_JOB_ID_RE = re.compile(r'^[0-9]+-[0-9]+-[0-9a-f]+$')
+
+
+def _MakeDirs(path):
+  try:
+    os.makedirs(path)
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+
+
+class HookQueue(object):
+  """Jobs stored as JSON files on disk."""
+
+  def __init__(self, queue_dir):
+    self.queue_dir = queue_dir
+    self.jobs_dir = os.path.join(queue_dir, 'jobs')
+    self.pending_dir = os.path.join(queue_dir, 'pending')
+
+  def Init(self):
+    _MakeDirs(self.jobs_dir)
+    _MakeDirs(self.pending_dir)
+
+  def JobPath(self, job_id, ext='.json'):
+    return os.path.join(self.jobs_dir, job_id + ext)
+
+  def ReadJob(self, job_id):
+    """Returns a dict, or None if the job doesn't exist."""
+    if not _JOB_ID_RE.match(job_id):
+      return None
+    try:
+      with open(self.JobPath(job_id)) as f:
+        return json.load(f)
+    except (IOError, ValueError):
+      return None
+
+  def WriteJob(self, job):
+    """Atomically replace the job record.
+
+    This breaks the hard link in pending/, so remove that first.
+    """
+    path = self.JobPath(job['job_id'])
+    tmp_path = '%s.wwup-%s' % (path, _TmpSuffix())
+    with open(tmp_path, 'w') as f:
+      json.dump(job, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
+
+  def NewJob(self, hook_name, argv):
+    job_id = '%s-%d-%s' % (time.strftime('%Y%m%d%H%M%S'), os.getpid(),
+                           os.urandom(4).encode('hex'))
+    return {
+        'job_id': job_id,
+        'hook': hook_name,
+        'argv': argv,
+        'key': hashlib.sha1(json.dumps([hook_name, argv])).hexdigest(),
+        'state': 'pending',
+        'submitted': time.time(),
+    }
+
+  def Submit(self, hook_name, argv):
+    """Returns (job ID, whether it was coalesced with a pending job)."""
+    job = self.NewJob(hook_name, argv)
+    job_id = job['job_id']
+    key = job['key']
+    self.WriteJob(job)
+
+    pending_path = os.path.join(self.pending_dir, key)
+    try:
+      os.link(self.JobPath(job_id), pending_path)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+      # Identical job is pending
+      try:
+        with open(pending_path) as f:
+          existing = json.load(f)
+      except IOError:
+        # Runner just started it; retry so we run again afterward
+        os.unlink(self.JobPath(job_id))
+        return self.Submit(hook_name, argv)
+      os.unlink(self.JobPath(job_id))
+      return existing['job_id'], True
+
+    return job_id, False
+
+  def Pending(self):
+    """Returns pending jobs, oldest first."""
+    jobs = []
+    for key in os.listdir(self.pending_dir):
+      try:
+        with open(os.path.join(self.pending_dir, key)) as f:
+          jobs.append(json.load(f))
+      except (IOError, ValueError):
+        continue
+    jobs.sort(key=lambda job: job['submitted'])
+    return jobs
+
+  def Prune(self, now):
+    for name in os.listdir(self.jobs_dir):
+      path = os.path.join(self.jobs_dir, name)
+      try:
+        if now - os.path.getmtime(path) > JOB_RETENTION_SECS:
+          os.unlink(path)
+      except OSError:
+        pass
+
+
+def RunHookProcess(argv, log_path, max_log_bytes, echo_f=None):
+  """Run a hook, streaming its stdout and stderr to a log file.
+
+  Args:
+    echo_f: if set, output is also written here as it's produced
+
+  Returns:
+    A dict of the exit status, wall and CPU time, and log size.
+  """
+  def Write(log_f, s):
+    log_f.write(s)
+    log_f.flush()  # so hook-status pollers see progress
+    if echo_f:
+      echo_f.write(s)
+      echo_f.flush()
+
+  result = {'log_bytes': 0, 'log_dropped_bytes': 0}
+  start_time = time.time()
+
+  with open(log_path, 'w') as log_f:
+    try:
+      p = subprocess.Popen(argv, stdout=subprocess.PIPE,
+                           stderr=subprocess.STDOUT, close_fds=True)
+    except OSError as e:
+      Write(log_f, 'wwup: error starting hook: %s\n' % e)
+      result.update(status=127, wall_secs=0.0, user_secs=0.0, sys_secs=0.0,
+                    max_rss_kb=0)
+      return result
+
+    fd = p.stdout.fileno()
+    while True:
+      chunk = os.read(fd, HOOK_CHUNK_SIZE)
+      if not chunk:
+        break
+      room = max_log_bytes - result['log_bytes']
+      if room > 0:
+        kept = chunk[:room]
+        Write(log_f, kept)
+        result['log_bytes'] += len(kept)
+      result['log_dropped_bytes'] += len(chunk) - min(max(room, 0), len(chunk))
+    p.stdout.close()
+
+    # wait4() gives the CPU time of the hook and the children it waited for
+    _, wait_status, rusage = os.wait4(p.pid, 0)
+    if os.WIFSIGNALED(wait_status):
+      status = -os.WTERMSIG(wait_status)
+    else:
+      status = os.WEXITSTATUS(wait_status)
+    p.returncode = status  # so Popen doesn't wait again
+
+    if result['log_dropped_bytes']:
+      Write(log_f, '\n[wwup: dropped %d bytes of output after the first %d]\n' %
+            (result['log_dropped_bytes'], max_log_bytes))
+
+  result.update(
+      status=status,
+      wall_secs=round(time.time() - start_time, 3),
+      user_secs=round(rusage.ru_utime, 3),
+      sys_secs=round(rusage.ru_stime, 3),
+      max_rss_kb=rusage.ru_maxrss)
+  return result
+
+
+class HookRunner(object):
+  """Runs pending jobs, respecting max_concurrent of each hook."""
+
+  def __init__(self, queue, idle_secs=RUNNER_IDLE_SECS):
+    self.queue = queue
+    self.idle_secs = idle_secs
+    self.running = {}  # job_id -> (thread, job)
+
+  def _RunJob(self, job):
+    hook_config = HOOKS.get(job['hook'], {})
+    max_log_bytes = hook_config.get('max_log_bytes', HOOK_MAX_LOG_BYTES)
+    log_path = self.queue.JobPath(job['job_id'], '.log')
+    job.update(RunHookProcess(job['argv'], log_path, max_log_bytes))
+
+  def _Start(self, job):
+    # Remove the pending link first, so identical submissions from now on
+    # create a new job
+    try:
+      os.unlink(os.path.join(self.queue.pending_dir, job['key']))
+    except OSError:
+      return
+
+    job.update(state='running', started=time.time(), pid=os.getpid())
+    self.queue.WriteJob(job)
+
+    # A thread per job copies its output to the log
+    t = threading.Thread(target=self._RunJob, args=(job,))
+    t.daemon = True
+    t.start()
+    self.running[job['job_id']] = (t, job)
+
+  def _Reap(self):
+    for job_id, (t, job) in self.running.items():
+      if t.is_alive():
+        continue
+      job.update(state='done', finished=time.time())
+      self.queue.WriteJob(job)
+      del self.running[job_id]
+
+  def Run(self):
+    """Run until there's been nothing to do for idle_secs."""
+    last_busy = time.time()
+    while True:
+      self._Reap()
+
+      num_running = {}
+      for _, job in self.running.itervalues():
+        num_running[job['hook']] = num_running.get(job['hook'], 0) + 1
+
+      pending = self.queue.Pending()
+      for job in pending:
+        hook_config = HOOKS.get(job['hook'], {})
+        max_concurrent = hook_config.get('max_concurrent', 1)
+        if num_running.get(job['hook'], 0) < max_concurrent:
+          self._Start(job)
+          num_running[job['hook']] = num_running.get(job['hook'], 0) + 1
+
+      now = time.time()
+      if self.running or pending:
+        last_busy = now
+      elif now - last_busy >= self.idle_secs:
+        break
+
+      time.sleep(RUNNER_POLL_SECS)
+
+
+def _PidAlive(pid):
+  try:
+    os.kill(pid, 0)
+  except OSError as e:
+    return e.errno == errno.EPERM  # it exists, but isn't ours
+  return True
+
+
+def RunHookQueue(queue_dir, idle_secs=RUNNER_IDLE_SECS):
+  """Entry point for the background runner.  Only one runs at a time."""
+  queue = HookQueue(queue_dir)
+  queue.Init()
+
+  lock_f = open(os.path.join(queue_dir, 'runner.lock'), 'w')
+  try:
+    while True:
+      try:
+        fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except IOError:
+        return  # another runner will see our job
+
+      now = time.time()
+      queue.Prune(now)
+
+      # The process running a job was killed, e.g. a previous runner, or a
+      # request with sync=1.  We don't know what happened to the job.  Jobs
+      # whose process is alive, like a sync hook in a FastCGI process, are
+      # left alone.
+      for name in os.listdir(queue.jobs_dir):
+        if name.endswith('.json'):
+          job = queue.ReadJob(name[:-len('.json')])
+          if (job and job['state'] == 'running' and 'pid' in job and
+              not _PidAlive(job['pid'])):
+            job.update(state='interrupted', finished=now)
+            queue.WriteJob(job)
+
+      HookRunner(queue, idle_secs=idle_secs).Run()
+      fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+      # A job may have been submitted after our last check, while a new
+      # runner failed to get the lock.  If so, keep going.
+      if not os.listdir(queue.pending_dir):
+        break
+  finally:
+    lock_f.close()
+
+
+def SpawnHookRunner(queue_dir):
+  """Start a runner that outlives this CGI process."""
+  argv = [sys.executable, os.path.abspath(__file__), 'run-hooks', queue_dir]
+  with open(os.devnull) as null_f:
+    with open(os.path.join(queue_dir, 'runner.log'), 'a') as log_f:
+      # New session, so the web server doesn't kill it with the CGI process.
+      # stdout doesn't hold the HTTP response open.
+      subprocess.Popen(argv, stdin=null_f, stdout=log_f, stderr=log_f,
+                       close_fds=True, preexec_fn=os.setsid)
+
+
+def HookArgv(home_dir, hook_config, form):
   argv0 = hook_config['argv0']
   assert not os.path.isabs(argv0), argv0
 
   argv0_path = os.path.join(home_dir, argv0)
   argv_prefix = hook_config.get('argv_prefix', [])
 
-  argv = [argv0_path] + argv_prefix + GetMoreArgv(form)
+  return [argv0_path] + argv_prefix + GetMoreArgv(form)
 
-  p = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-  stdout, stderr = p.communicate()
 
-  status = p.wait()
-  if status == 0:
-    PrintStatusOk()
-  else:
-    PrintError500()
+def QueueHook(home_dir, hook_name, hook_config, form):
+  queue_dir = os.path.join(home_dir, HOOK_QUEUE_DIR)
+  queue = HookQueue(queue_dir)
+  queue.Init()
 
-  print('--- wwup.cgi run-hook ---')
-  print('hook %r' % hook_config)
-  print('argv %r' % argv)
-  print('')
+  argv = HookArgv(home_dir, hook_config, form)
+  job_id, coalesced = queue.Submit(hook_name, argv)
+  SpawnHookRunner(queue_dir)
 
-  print('')
-  print('--- STATUS: %d' % status)
-  print('')
+  return TextResponse([
+      '--- wwup.cgi run-hook ---',
+      'hook %r' % hook_name,
+      'argv %r' % argv,
+      'job_id %s' % job_id,
+      'coalesced %s' % coalesced,
+      '',
+      'Poll with hook-status=%s' % job_id,
+      '',
+  ])
 
-  print('--- STDOUT:')
-  print('')
-  print(stdout)
-  print('')
-  print('')
 
-  print('--- STDERR:')
-  print('')
-  print(stderr)
-  print('')
-  print('')
+def HookStatus(home_dir, job_id):
+  queue = HookQueue(os.path.join(home_dir, HOOK_QUEUE_DIR))
+  job = queue.ReadJob(job_id)
+  if job is None:
+    return Error400('Invalid job ID %r' % job_id)
+  return JsonResponse(job)
 
 
 def GetHomeDir():
@@ -465,17 +2925,76 @@ def GetHomeDir():
     return e.pw_dir
 
 
-def main(argv):
-  if 1:
-    cgitb.enable()  # Enable tracebacks
-  else:
-    # Dumps to file
-    cgitb.enable(display=0, logdir='/home/oils', format='text')
+def _FieldValue(form, name):
+  form_val = form.get(name)
+  if form_val is None or form_val.value is None:
+    return '-'
+  return form_val.value
+
+
+def HandlePost(environ, dest_base_dir, timer):
+  """Returns (status, headers, body_chunks)."""
+  timer.counts['content_length'] = int(environ.get('CONTENT_LENGTH') or 0)
+
+  timer.Begin('parse')
+  try:
+    form = ParseForm(environ, environ['wsgi.input'],
+                     UploadTmpDir(dest_base_dir, time.time()))
+  except RuntimeError as e:
+    timer.status = 400
+    return Error400(e)
+  timer.End()
+
+  timer.fields['payload_type'] = _FieldValue(form, 'payload-type')
 
-  method = os.getenv('REQUEST_METHOD', 'GET')
+  try:
+    if 'cgitb-test' in form:
+      # BUG
+      print(sys.argv[99])
+
+    elif 'run-hook' in form:
+      timer.fields['action'] = 'run-hook'
+      run_hook = form['run-hook'].value
+      home_dir = GetHomeDir()
+      hook_config = HOOKS.get(run_hook)
+      if hook_config is None:
+        raise RuntimeError('Invalid hook %r' % run_hook)
+      if 'sync' in form and form['sync'].value == '1':
+        echo = 'echo' in form and form['echo'].value == '1'
+        return RunHook(environ, home_dir, hook_config, form,
+                       hook_name=run_hook, echo=echo, timer=timer)
+      else:
+        timer.Begin('hook')
+        response = QueueHook(home_dir, run_hook, hook_config, form)
+        timer.End()
+        return response
+
+    elif 'hook-status' in form:
+      timer.fields['action'] = 'hook-status'
+      return HookStatus(GetHomeDir(), form['hook-status'].value)
+
+    elif 'dedup' in form:
+      timer.fields['action'] = 'dedup/%s' % form['dedup'].value
+      return DoDedup(environ, form, dest_base_dir, timer=timer)
+
+    elif 'upload-session' in form:
+      timer.fields['action'] = 'upload-session/%s' % form['upload-session'].value
+      return DoUploadSession(environ, form, dest_base_dir, timer=timer)
 
-  if method == 'GET':
-    print(r'''
+    else:
+      timer.fields['action'] = 'upload'
+      return Upload(environ, form, dest_base_dir, timer=timer)
+  except Conflict as e:
+    timer.status = 409
+    return TextResponse(['Conflict: %s' % e], status='409 Conflict')
+  except RuntimeError as e:
+    timer.status = 400
+    return Error400(e)
+  finally:
+    CleanupForm(form)
+
+
+USAGE = r'''
 wwup.cgi - HTTP uploader
 
 Example usage:
@@ -499,56 +3018,240 @@ Example usage:
       --form 'arg1=foo' \
       --form 'arg2=bar' \
       $URL
-''')
-    return
 
-  # Dumps info
-  #cgi.test()
+    # Large files can be uploaded in chunks, and resumed.  See
+    # 'Resumable uploads' in wwup.py.
+    curl \
+      --form 'upload-session=open' \
+      --form 'payload-type=github-jobs' --form 'subdir=1234' \
+      --form 'filename=wild.wwz' --form "size=$SIZE" --form "sha256=$SHA256" \
+      $URL
+
+    # Or send a manifest, and then only the members the server doesn't
+    # have.  See 'Deduplicating uploads' in wwup.py.
+    curl \
+      --form 'dedup=manifest' \
+      --form 'payload-type=github-jobs' --form 'subdir=1234' \
+      --form 'filename=wild.wwz' --form 'manifest=@wild.manifest' \
+      $URL
+
+    # Hooks are queued and run in the background, unless sync=1 is passed.
+    # Poll the job ID that's returned:
+    curl "$URL?hook-status=$JOB_ID"
+'''
+
+
+#
+# WSGI
+#
+# The handlers above return (status, headers, body_chunks).  WriteCgi() sends
+# that as CGI output, and App is a WSGI app for a persistent FastCGI process
+# that handles uploads in threads.
+
+# Uploads processed at once, in a persistent process.  Others wait for a slot.
+DEFAULT_MAX_UPLOADS = 4
+
+# Then they get 503 and should retry
+DEFAULT_UPLOAD_WAIT_SECS = 30
+
+
+class UploadSlots(object):
+  """Bounds the number of uploads processed at once."""
+
+  def __init__(self, max_uploads):
+    self.max_uploads = max_uploads
+    self.num_active = 0
+    self.cond = threading.Condition()
 
-  # TODO: We could throttle here, e.g. if there are too many files
+  def Acquire(self, timeout):
+    """Wait for a slot.  Returns False if there wasn't one within timeout."""
+    deadline = time.time() + timeout
+    with self.cond:
+      while self.num_active >= self.max_uploads:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          return False
+        self.cond.wait(remaining)
+      self.num_active += 1
+      return True
 
-  dest_base_dir = sys.argv[1]
+  def Release(self):
+    with self.cond:
+      self.num_active -= 1
+      self.cond.notify()
 
-  form = cgi.FieldStorage(fp=sys.stdin, environ=os.environ)
 
+class _ResponseBody(object):
+  """A WSGI body that calls on_close() when the server is done with it.
+
+  A sync hook's body runs the hook as it's iterated, so the upload slot and
+  the request log wait until then.  close() is called even if the body is
+  never iterated.
+  """
+
+  def __init__(self, chunks, on_close, trailer=()):
+    self.chunks = chunks
+    self.on_close = on_close
+    self.trailer = trailer
+
+  def __iter__(self):
+    for chunk in self.chunks:
+      yield chunk
+    for chunk in self.trailer:
+      yield chunk
+
+  def close(self):
+    try:
+      if hasattr(self.chunks, 'close'):
+        self.chunks.close()
+    finally:
+      self.on_close()
+
+
+class App(object):
+  """WSGI app for uploads and hooks.
+
+  In CGI mode it handles one request; in FastCGI mode it's shared by all
+  threads.
+  """
+
+  def __init__(self, dest_base_dir, max_uploads=DEFAULT_MAX_UPLOADS,
+               wait_secs=DEFAULT_UPLOAD_WAIT_SECS):
+    self.dest_base_dir = dest_base_dir
+    self.slots = UploadSlots(max_uploads)
+    self.wait_secs = wait_secs
+
+  def _Get(self, environ):
+    query = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+    if 'hook-status' in query:
+      return HookStatus(GetHomeDir(), query['hook-status'][0])
+    return '200 OK', list(TEXT_HEADERS), [USAGE]
+
+  def _Post(self, environ, timer):
+    if not self.slots.Acquire(self.wait_secs):
+      timer.status = 503
+      status, headers, chunks = TextResponse(
+          ['Too many uploads in progress.  Try again later.'],
+          status='503 Service Unavailable')
+      headers.append(('Retry-After', '5'))
+      return status, headers, _ResponseBody(
+          chunks, lambda: self._LogRequest(timer))
+
+    def OnClose():
+      self.slots.Release()
+      self._LogRequest(timer)
+
+    try:
+      status, headers, chunks = HandlePost(environ, self.dest_base_dir, timer)
+    except Exception:
+      timer.status = 500
+      OnClose()
+      raise
+
+    # Now run ~/bin/wwup-hooks/osh-runtime.sh
+    #
+    # Can be stored in soil/wwup-hooks/
+    # soil/web.sh deploy currently makes soil-web/, which should be turned
+    # into a wwup-hook.
+    #
+    # Policy:
+    # - Executables in the repo cannot generate HTML/JS/CSS web content.
+    # - Only executables we control and deploy manually.
+
+    trailer = []
+    if dict(headers).get('Content-Type', '').startswith('text/plain'):
+      trailer.append('--- wwup.cgi Done ---\n')
+    return status, headers, _ResponseBody(chunks, OnClose, trailer=trailer)
+
+  def _LogRequest(self, timer):
+    timer.End()
+    AppendUploadLog(GetHomeDir(), timer)
+
+  def Handle(self, environ):
+    """Returns (status, headers, body_chunks).  Errors are raised."""
+    if environ.get('REQUEST_METHOD', 'GET') == 'POST':
+      return self._Post(environ, PhaseTimer())
+    return self._Get(environ)
+
+  def __call__(self, environ, start_response):
+    try:
+      status, headers, body = self.Handle(environ)
+    except Exception:
+      # Show the traceback, like cgitb does
+      tb = traceback.format_exc()
+      log('wwup: %s', tb)
+      status, headers, body = Error500([tb])
+
+    start_response(status, headers)
+    return body
+
+
+def WriteCgi(status, headers, body, out_f):
+  """Write a handler's response as CGI output."""
+  out_f.write('Status: %s\n' % status)
+  for name, value in headers:
+    out_f.write('%s: %s\n' % (name, value))
+  out_f.write('\n')
+  out_f.flush()
   try:
-    if 'cgitb-test' in form:
-      # BUG
-      print(sys.argv[99])
+    for chunk in body:
+      out_f.write(chunk)
+      out_f.flush()  # a sync hook's output is streamed
+  finally:
+    if hasattr(body, 'close'):
+      body.close()
 
-    elif 'run-hook' in form:
-      run_hook = form['run-hook'].value
-      home_dir = GetHomeDir()
-      hook_config = HOOKS.get(run_hook)
-      if hook_config is None:
-        raise RuntimeError('Invalid hook %r' % run_hook)
-      RunHook(os.environ, home_dir, hook_config, form)
+
+def main(argv):
+  # Commands that aren't CGI
+  if len(argv) == 3 and argv[1] == 'run-hooks':
+    RunHookQueue(argv[2])
+    return
+
+  if len(argv) in (2, 3) and argv[1] == 'report':
+    if len(argv) == 3:
+      path = argv[2]
     else:
-      Upload(os.environ, form, dest_base_dir)
-  except RuntimeError as e:
-    PrintError400()
-    print('Status: 400 Bad Request')
-    print('Bad request: %s' % e)
-
-  # Logging
-  # - How long did it take to upload the file?
-  # - How big was it?
-  # - How long did it take to run the aggregation and HTML hooks?
-
-  # TODO:
-  # - Delete old files here, according to policy
-
-  # Now run ~/bin/wwup-hooks/osh-runtime.sh
-  #
-  # Can be stored in soil/wwup-hooks/
-  # soil/web.sh deploy currently makes soil-web/, which should be turned into
-  # a wwup-hook.
-  #
-  # Policy:
-  # - Executables in the repo cannot generate HTML/JS/CSS web content.
-  # - Only executables we control and deploy manually.
-
-  print('--- wwup.cgi Done ---')
+      path = os.path.join(GetHomeDir(), UPLOAD_LOG_PATH)
+    ReportUploadLog(path, sys.stdout)
+    return
+
+  if len(argv) == 4 and argv[1] == 'cleanup':
+    os.nice(10)  # deleting is low priority
+    deleted = RunRetention(argv[2], argv[3])
+    log('wwup: deleted %d dirs from %s', len(deleted), argv[3])
+
+    blob_dir = os.path.join(argv[2], BLOBS_DIR)
+    if os.path.isdir(blob_dir):
+      num_removed = BlobStore(blob_dir).Prune(time.time())
+      log('wwup: removed %d unused blobs', num_removed)
+    return
+
+  dest_base_dir = argv[1]
+
+  if os.getenv('FASTCGI'):
+    # e.g. WWUP_MAX_UPLOADS=2 on a small host
+    app = App(
+        dest_base_dir,
+        max_uploads=int(os.getenv('WWUP_MAX_UPLOADS',
+                                  str(DEFAULT_MAX_UPLOADS))),
+        wait_secs=float(os.getenv('WWUP_UPLOAD_WAIT_SECS',
+                                  str(DEFAULT_UPLOAD_WAIT_SECS))))
+
+    from flup.server.fcgi import WSGIServer
+    WSGIServer(app).run()
+
+  else:
+    if 1:
+      cgitb.enable()  # Enable tracebacks
+    else:
+      # Dumps to file
+      cgitb.enable(display=0, logdir='/home/oils', format='text')
+
+    environ = dict(os.environ)
+    environ['wsgi.input'] = sys.stdin
+    status, headers, body = App(dest_base_dir).Handle(environ)
+    WriteCgi(status, headers, body, sys.stdout)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,369 @@
+#!/usr/bin/env python2
+"""
+wwup_bench.py: Upload throughput and memory of wwup.py, without a server.
+
+Usage:
+    ./wwup_bench.py [-n REPS] [--sizes 10K,1M,29M] [--kinds wwz,tsv,json]
+                    [--modes inproc,cgi] [--home DIR] > results.tsv
+
+Each case generates a synthetic payload, wraps it in a multipart body, and
+uploads it as payload-type=wwup-bench to a temp dest dir.  We add that policy
+to wwup.PAYLOADS ourselves: it has the limits of github-jobs, without
+retention, so no cleanup process is spawned.
+
+- inproc: the WSGI App is called in a forked child, so the uploads are
+  isolated and each one has its own peak RSS.  This is the cost of a request
+  to a persistent FastCGI process.
+- cgi: wwup.py is run as a CGI subprocess, like dh_wwup.cgi does.  This adds
+  interpreter startup and imports.  The subprocess is this script with the
+  'cgi' command, which patches the policy and home dir, then calls
+  wwup.main().
+
+The output is TSV with one row per case, showing the median of REPS runs.
+Rows are in a fixed order and numbers have fixed precision, so the output of
+two commits can be diffed.
+
+Like any upload, each run appends a row to the request log.  It goes to
+.wwup/requests.tsv in a temp home dir, unless you pass --home DIR.  Then
+'wwup.py report DIR/.wwup/requests.tsv' shows where the time went.
+"""
+from __future__ import print_function
+
+import cStringIO
+import json
+import optparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import zipfile
+
+import wwup
+
+BOUNDARY = '----wwup-bench-boundary'
+
+PAYLOAD_TYPE = 'wwup-bench'
+
+# Bodies must fit under max_bytes of the wwup-bench policy, which is 30 MB
+DEFAULT_SIZES = '10K,100K,1M,10M,29M'
+DEFAULT_KINDS = 'wwz,tsv,json'
+DEFAULT_MODES = 'inproc,cgi'
+
+# Average size of a .wwz member.  29 MB is ~14K members, and the policy allows
+# 22K.
+WWZ_MEMBER_BYTES = 2000
+
+def _PatchWwup(home_dir):
+  """Add our policy, and log to home_dir instead of the real home dir."""
+  policy = dict(wwup.PAYLOADS['github-jobs'])
+  policy.pop('retention', None)
+  wwup.PAYLOADS[PAYLOAD_TYPE] = policy
+  wwup.GetHomeDir = lambda: home_dir
+
+
+COLUMNS = [
+    'kind', 'size', 'mode', 'status', 'payload_bytes', 'body_bytes',
+    'wall_secs', 'mb_per_sec', 'max_rss_kb', 'disk_bytes',
+]
+
+
+def ParseSize(s):
+  """'10K' -> 10000"""
+  units = {'K': 1000, 'M': 1000 * 1000}
+  if s[-1] in units:
+    return int(s[:-1]) * units[s[-1]]
+  return int(s)
+
+
+def _TsvText(rng, num_bytes):
+  """Benchmark-like TSV: a header, then rows of numbers."""
+  lines = ['host\tshell\ttask\telapsed_secs\tmax_rss_KiB']
+  n = len(lines[0])
+  while n < num_bytes:
+    line = '%s\t%s\ttask-%d\t%.3f\t%d' % (
+        rng.choice(['lenny', 'hoover']), rng.choice(['bash', 'dash', 'osh']),
+        rng.randint(0, 999), rng.random() * 10, rng.randint(1000, 99999))
+    lines.append(line)
+    n += len(line) + 1
+  return '\n'.join(lines)[:num_bytes]
+
+
+def _JsonText(rng, num_bytes):
+  rows = []
+  n = 0
+  while n < num_bytes:
+    row = {'job_id': rng.randint(0, 99999), 'status': rng.choice([0, 1]),
+           'elapsed': round(rng.random() * 100, 3)}
+    rows.append(row)
+    n += 50
+  return json.dumps(rows, indent=1)[:num_bytes]
+
+
+def _RandomBytes(rng, num_bytes):
+  n = rng.getrandbits(8 * num_bytes)
+  return ('%0*x' % (2 * num_bytes, n)).decode('hex')
+
+
+def MakeWwz(rng, num_bytes):
+  """A .wwz with the mix of a CI job: mostly text logs and TSV, some JSON, and
+  a few incompressible files like images.
+
+  num_bytes is the uncompressed size.
+  """
+  f = cStringIO.StringIO()
+  z = zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED)
+  num_members = max(1, num_bytes // WWZ_MEMBER_BYTES)
+  member_bytes = num_bytes // num_members
+  for i in xrange(num_members):
+    d = 'task-%d' % (i // 100)
+    r = i % 20
+    if r == 0:
+      z.writestr('%s/%d.png' % (d, i), _RandomBytes(rng, member_bytes))
+    elif r < 4:
+      z.writestr('%s/%d.json' % (d, i), _JsonText(rng, member_bytes))
+    elif r < 10:
+      z.writestr('%s/%d.tsv' % (d, i), _TsvText(rng, member_bytes))
+    else:
+      z.writestr('%s/%d.txt' % (d, i), _TsvText(rng, member_bytes))
+  z.close()
+  return f.getvalue()
+
+
+def MakePayload(kind, num_bytes, seed=42):
+  """Return (filename, contents)."""
+  rng = random.Random(seed)
+  if kind == 'wwz':
+    return 'bench.wwz', MakeWwz(rng, num_bytes)
+  if kind == 'tsv':
+    return 'bench.tsv', _TsvText(rng, num_bytes)
+  if kind == 'json':
+    return 'bench.json', _JsonText(rng, num_bytes)
+  raise AssertionError(kind)
+
+
+def WritePayload(kind, num_bytes, path):
+  """Generate a payload into a file, and return its name.
+
+  This is done in a child process, so the harness stays small.  Otherwise the
+  peak RSS of each upload would include the pages it inherits from us.
+  """
+  r, w = os.pipe()
+  pid = os.fork()
+  if pid == 0:  # child
+    os.close(r)
+    try:
+      filename, contents = MakePayload(kind, num_bytes)
+      with open(path, 'w') as f:
+        f.write(contents)
+      os.write(w, filename)
+    except Exception:
+      traceback.print_exc()
+    os._exit(0)
+
+  os.close(w)
+  os.waitpid(pid, 0)
+  filename = os.read(r, 100)
+  os.close(r)
+  if not filename:
+    raise RuntimeError("Couldn't generate %s payload" % kind)
+  return filename
+
+
+def WriteBody(path, subdir, filename, payload_path):
+  """Write a multipart/form-data body like curl --form sends."""
+  with open(path, 'w') as f:
+    for name, value in [('payload-type', PAYLOAD_TYPE), ('subdir', subdir)]:
+      f.write('--%s\r\n' % BOUNDARY)
+      f.write('Content-Disposition: form-data; name="%s"\r\n\r\n' % name)
+      f.write(value)
+      f.write('\r\n')
+    f.write('--%s\r\n' % BOUNDARY)
+    f.write('Content-Disposition: form-data; name="file1"; filename="%s"\r\n'
+            % filename)
+    f.write('Content-Type: application/octet-stream\r\n\r\n')
+    with open(payload_path) as payload_f:
+      shutil.copyfileobj(payload_f, f)
+    f.write('\r\n')
+    f.write('--%s--\r\n' % BOUNDARY)
+  return os.path.getsize(path)
+
+
+def _Environ(dest_dir, body_bytes):
+  return {
+      'REQUEST_METHOD': 'POST',
+      'CONTENT_TYPE': 'multipart/form-data; boundary=%s' % BOUNDARY,
+      'CONTENT_LENGTH': str(body_bytes),
+      'DOCUMENT_ROOT': dest_dir,
+      'HTTP_HOST': 'bench.example.com',
+  }
+
+
+def _WaitStatus(wait_status):
+  if os.WIFSIGNALED(wait_status):
+    return -os.WTERMSIG(wait_status)
+  return os.WEXITSTATUS(wait_status)
+
+
+def RunInProcess(home_dir, dest_dir, body_path, body_bytes):
+  """Call the WSGI app in a forked child.
+
+  Returns (HTTP status, wall secs, max RSS in KB).
+  """
+  r, w = os.pipe()
+  start_time = time.time()
+  pid = os.fork()
+  if pid == 0:  # child
+    os.close(r)
+    status = 0
+    try:
+      _PatchWwup(home_dir)
+      environ = _Environ(dest_dir, body_bytes)
+      started = []
+      def StartResponse(status, headers):
+        started.append(status)
+        return lambda s: None
+      with open(body_path) as f:
+        environ['wsgi.input'] = f
+        app = wwup.App(dest_dir)
+        body = app(environ, StartResponse)
+        for _ in body:
+          pass
+        body.close()
+      status = int(started[0].split()[0])
+    except Exception:
+      traceback.print_exc()
+    os.write(w, str(status))
+    os._exit(0)
+
+  os.close(w)
+  _, wait_status, rusage = os.wait4(pid, 0)
+  wall_secs = time.time() - start_time
+  status = int(os.read(r, 100) or '0')
+  os.close(r)
+  if _WaitStatus(wait_status) != 0:
+    status = 0
+  return status, wall_secs, rusage.ru_maxrss
+
+
+def RunCgi(home_dir, dest_dir, body_path, body_bytes):
+  """Run wwup.py as a CGI program, through CgiMain().
+
+  Returns (HTTP status, wall secs, max RSS in KB).
+  """
+  env = _Environ(dest_dir, body_bytes)
+  env['PATH'] = os.getenv('PATH', '')
+  argv = [sys.executable, os.path.abspath(__file__), 'cgi', home_dir, dest_dir]
+
+  start_time = time.time()
+  with open(body_path) as body_f:
+    p = subprocess.Popen(argv, stdin=body_f, stdout=subprocess.PIPE,
+                         env=env, close_fds=True)
+    out = p.stdout.read()
+    p.stdout.close()
+    _, wait_status, rusage = os.wait4(p.pid, 0)
+    p.returncode = _WaitStatus(wait_status)  # so Popen doesn't wait again
+  wall_secs = time.time() - start_time
+
+  status = 0
+  first_line = out.split('\n', 1)[0]
+  if first_line.startswith('Status:'):
+    status = int(first_line.split()[1])
+  return status, wall_secs, rusage.ru_maxrss
+
+
+def _DiskBytes(path):
+  total = 0
+  for dir_path, _, file_names in os.walk(path):
+    for name in file_names:
+      total += os.path.getsize(os.path.join(dir_path, name))
+  return total
+
+
+def _Median(values):
+  values = sorted(values)
+  return values[len(values) // 2]
+
+
+RUNNERS = {'inproc': RunInProcess, 'cgi': RunCgi}
+
+
+def RunCase(tmp_dir, home_dir, kind, size, mode, reps, filename,
+            payload_path):
+  """Upload one payload reps times, and return a row of medians."""
+  dest_dir = os.path.join(tmp_dir, 'dest')
+  body_path = os.path.join(tmp_dir, 'body')
+
+  results = []
+  for i in xrange(reps):
+    subdir = '%s-%s-%s-%d' % (kind, size, mode, i)
+    body_bytes = WriteBody(body_path, subdir, filename, payload_path)
+
+    status, wall_secs, max_rss_kb = RUNNERS[mode](home_dir, dest_dir,
+                                                  body_path, body_bytes)
+    disk_bytes = _DiskBytes(os.path.join(dest_dir, PAYLOAD_TYPE, subdir))
+    results.append((status, wall_secs, max_rss_kb, disk_bytes))
+  os.unlink(body_path)
+
+  # A failed upload shows up in the status column
+  statuses = set(r[0] for r in results)
+  status = statuses.pop() if len(statuses) == 1 else 0
+
+  wall_secs = _Median([r[1] for r in results])
+  return [
+      kind, size, mode, status, os.path.getsize(payload_path), body_bytes,
+      '%.3f' % wall_secs,
+      '%.2f' % (body_bytes / wall_secs / 1e6),
+      _Median([r[2] for r in results]),
+      _Median([r[3] for r in results]),
+  ]
+
+
+def CgiMain(argv):
+  """cgi HOME_DIR DEST_DIR: wwup.py as a CGI program, with our policy."""
+  _, _, home_dir, dest_dir = argv
+  _PatchWwup(home_dir)
+  wwup.main(['wwup.py', dest_dir])
+
+
+def main(argv):
+  if argv[1:2] == ['cgi']:
+    CgiMain(argv)
+    return
+
+  p = optparse.OptionParser(usage=__doc__.strip())
+  p.add_option('-n', dest='reps', type='int', default=3,
+               help='Runs of each case')
+  p.add_option('--sizes', default=DEFAULT_SIZES)
+  p.add_option('--kinds', default=DEFAULT_KINDS)
+  p.add_option('--modes', default=DEFAULT_MODES)
+  p.add_option('--home', default=None,
+               help='Dir for the request log (default: a temp dir)')
+  opts, _ = p.parse_args(argv[1:])
+
+  tmp_dir = tempfile.mkdtemp(prefix='wwup-bench-')
+  os.mkdir(os.path.join(tmp_dir, 'dest'))
+  # The in-process app and CGI processes log here, not to the real home dir
+  home_dir = os.path.abspath(opts.home or os.path.join(tmp_dir, 'home'))
+  try:
+    print('\t'.join(COLUMNS))
+    for kind in opts.kinds.split(','):
+      for size in opts.sizes.split(','):
+        payload_path = os.path.join(tmp_dir, 'payload')
+        filename = WritePayload(kind, ParseSize(size), payload_path)
+        for mode in opts.modes.split(','):
+          row = RunCase(tmp_dir, home_dir, kind, size, mode, opts.reps,
+                        filename, payload_path)
+          print('\t'.join(str(cell) for cell in row))
+          sys.stdout.flush()
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
+
+# vim: sw=2
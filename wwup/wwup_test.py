@@ -5,28 +5,191 @@ wwup_test.py: Tests for wwup.py
 from __future__ import print_function
 
 import cStringIO
+import fcntl
+import hashlib
+import json
+import marshal
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
+import zipfile
 
 import wwup  # module under test
 
+# wwz.py is deployed separately, but its log format is shared
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import wwz
+
 
 class _FormValue(object):
   def __init__(self, value):
     self.value = value
 
 
+BOUNDARY = '----wwup-test-boundary'
+
+
+def _MultipartBody(fields, files):
+  """
+  Args:
+    fields: list of (name, value)
+    files: list of (name, filename, contents)
+  """
+  parts = ['preamble']
+  for name, value in fields:
+    parts.append('--%s\r\n' % BOUNDARY)
+    parts.append('Content-Disposition: form-data; name="%s"\r\n\r\n' % name)
+    parts.append(value)
+    parts.append('\r\n')
+  for name, filename, contents in files:
+    parts.append('--%s\r\n' % BOUNDARY)
+    parts.append(
+        'Content-Disposition: form-data; name="%s"; filename="%s"\r\n' %
+        (name, filename))
+    parts.append('Content-Type: application/octet-stream\r\n\r\n')
+    parts.append(contents)
+    parts.append('\r\n')
+  parts.append('--%s--\r\n' % BOUNDARY)
+  return ''.join(parts)
+
+
+def _PostEnviron(body):
+  return {
+      'REQUEST_METHOD': 'POST',
+      'CONTENT_TYPE': 'multipart/form-data; boundary=%s' % BOUNDARY,
+      'CONTENT_LENGTH': str(len(body)),
+  }
+
+
+def _MakeWwz(files):
+  f = cStringIO.StringIO()
+  z = zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED)
+  for name, contents in files:
+    info = zipfile.ZipInfo(name, (2020, 1, 2, 3, 4, 6))
+    info.external_attr = 0o600 << 16
+    info.compress_type = zipfile.ZIP_DEFLATED
+    z.writestr(info, contents)
+  z.close()
+  return f.getvalue()
+
+
 class WwupTest(unittest.TestCase):
 
   def testRunHook(self):
     home_dir = wwup.GetHomeDir()
     hook_config = wwup.HOOKS.get('local-test')
-    wwup.RunHook({}, home_dir, hook_config, {})
+    status, _, body = wwup.RunHook({}, home_dir, hook_config, {})
+    print(''.join(body))
 
     params1 = {'arg1': _FormValue('one'), 'arg2': _FormValue('two')}
-    wwup.RunHook({}, home_dir, hook_config, params1)
+    status, _, body = wwup.RunHook({}, home_dir, hook_config, params1)
+    print(''.join(body))
 
     params2 = {'arg1': _FormValue('FAIL')}
-    wwup.RunHook({}, home_dir, hook_config, params2)
+    status, _, body = wwup.RunHook({}, home_dir, hook_config, params2)
+    print(''.join(body))
+
+    # With echo, the output is produced as the body is iterated
+    status, _, body = wwup.RunHook({}, home_dir, hook_config, params1,
+                                   echo=True)
+    self.assertEqual('200 OK', status)
+    chunks = list(body)
+    print(chunks)
+    self.assert_('wwup.cgi run-hook' in chunks[0])
+    self.assert_('--- STATUS: ' in chunks[-1])
+
+  def testHookQueue(self):
+    queue_dir = os.path.join(self.tmp_dir, 'hook-queue')
+    queue = wwup.HookQueue(queue_dir)
+    queue.Init()
+
+    argv = ['sh', '-c', 'echo hi; echo err >&2; exit 3']
+    job_id, coalesced = queue.Submit('local-test', argv)
+    self.assertEqual(False, coalesced)
+
+    # Identical pending job is coalesced
+    job_id2, coalesced = queue.Submit('local-test', argv)
+    self.assertEqual(job_id, job_id2)
+    self.assertEqual(True, coalesced)
+
+    # Different args
+    job_id3, coalesced = queue.Submit('local-test', ['true'])
+    self.assertNotEqual(job_id, job_id3)
+    self.assertEqual(False, coalesced)
+
+    self.assertEqual(2, len(queue.Pending()))
+    self.assertEqual('pending', queue.ReadJob(job_id)['state'])
+    self.assertEqual(None, queue.ReadJob('../../etc/passwd'))
+
+    # A job whose process died is interrupted; one that's still running, like
+    # a sync hook in another request, isn't
+    p = subprocess.Popen(['true'])
+    p.wait()
+    dead = queue.NewJob('local-test', ['dead'])
+    dead.update(state='running', pid=p.pid)
+    queue.WriteJob(dead)
+    sync = queue.NewJob('local-test', ['sync'])
+    sync.update(state='running', sync=True, pid=os.getpid())
+    queue.WriteJob(sync)
+
+    wwup.RunHookQueue(queue_dir, idle_secs=0)
+
+    self.assertEqual('interrupted', queue.ReadJob(dead['job_id'])['state'])
+    self.assertEqual('running', queue.ReadJob(sync['job_id'])['state'])
+
+    self.assertEqual([], queue.Pending())
+    job = queue.ReadJob(job_id)
+    print(job)
+    self.assertEqual('done', job['state'])
+    self.assertEqual(3, job['status'])
+    self.assert_('wall_secs' in job)
+    with open(queue.JobPath(job_id, '.log')) as f:
+      self.assertEqual('hi\nerr\n', f.read())
+    self.assertEqual(0, queue.ReadJob(job_id3)['status'])
+
+    # Submitting after it ran creates a new job
+    job_id4, coalesced = queue.Submit('local-test', argv)
+    self.assertNotEqual(job_id, job_id4)
+    self.assertEqual(False, coalesced)
+
+  def testRunHookProcess(self):
+    log_path = os.path.join(self.tmp_dir, 'hook.log')
+    echo_f = cStringIO.StringIO()
+    argv = ['sh', '-c', 'echo out; echo err >&2; exit 2']
+    result = wwup.RunHookProcess(argv, log_path, 1000, echo_f=echo_f)
+    print(result)
+    self.assertEqual(2, result['status'])
+    self.assertEqual(8, result['log_bytes'])
+    with open(log_path) as f:
+      self.assertEqual('out\nerr\n', f.read())
+    self.assertEqual('out\nerr\n', echo_f.getvalue())
+    for k in ['wall_secs', 'user_secs', 'sys_secs', 'max_rss_kb']:
+      self.assert_(k in result, k)
+
+    # Capped
+    argv = ['sh', '-c', 'for i in 1 2 3 4 5 6 7 8 9 10; do echo 123456789; done']
+    result = wwup.RunHookProcess(argv, log_path, 25)
+    print(result)
+    self.assertEqual(0, result['status'])
+    self.assertEqual(25, result['log_bytes'])
+    self.assertEqual(75, result['log_dropped_bytes'])
+    with open(log_path) as f:
+      contents = f.read()
+    print(repr(contents))
+    self.assert_(contents.startswith('123456789\n123456789\n12345\n'))
+    self.assert_('dropped 75 bytes' in contents)
+
+    # Killed by a signal
+    result = wwup.RunHookProcess(['sh', '-c', 'kill -9 $$'], log_path, 1000)
+    self.assertEqual(-9, result['status'])
+
+    # Doesn't exist
+    result = wwup.RunHookProcess(['/nonexistent'], log_path, 1000)
+    self.assertEqual(127, result['status'])
 
   def testAtomicRename(self):
     import os
@@ -65,6 +228,804 @@ class WwupTest(unittest.TestCase):
     self.assertEqual(None, wwup.ValidateSubdir('one/two', 2))
     self.assertEqual(None, wwup.ValidateSubdir('one/two/three', 3))
 
+  def testMatchGlobs(self):
+    globs = ['osh-runtime/*.tsv', 'host-id/*-*/*.txt', 'x[0-9]?', 'unused/*']
+    names = [
+        'osh-runtime/',  # directories are skipped
+        'osh-runtime/times.tsv',
+        'osh-runtime/sub/times.tsv',  # * doesn't match /
+        'host-id/lenny-1/cpuinfo.txt',
+        'host-id/lenny/cpuinfo.txt',
+        'x1a',
+        'x1/',
+        'xa1',
+    ]
+    unmatched_names, unmatched_globs = wwup.MatchGlobs(globs, names)
+    print(unmatched_names)
+    self.assertEqual(
+        ['osh-runtime/sub/times.tsv', 'host-id/lenny/cpuinfo.txt', 'xa1'],
+        unmatched_names)
+    self.assertEqual(['unused/*'], unmatched_globs)
+
+    # Compiled once
+    self.assert_(wwup.CompileGlobs(globs) is wwup.CompileGlobs(globs))
+
+    # Unmatched members and globs are reported, not rejected
+    policy = wwup.PAYLOADS['osh-runtime']
+    names = ['osh-runtime/times.tsv', 'shell-id/osh-1/version.txt']
+    self.assertEqual(([], ['host-id/*-*/*.txt']),
+                     wwup.CheckWwzNames(policy, names))
+    self.assertEqual((['extra.txt'], ['host-id/*-*/*.txt']),
+                     wwup.CheckWwzNames(policy, names + ['extra.txt']))
+
+    # Policies without globs report nothing
+    self.assertEqual(([], []), wwup.CheckWwzNames({}, ['extra.txt']))
+
+    # One pass over a big archive
+    names = ['osh-runtime/%d.tsv' % i for i in xrange(22000)]
+    start = time.time()
+    wwup.MatchGlobs(policy['globs'], names)
+    print('%.1f ms for %d names' % ((time.time() - start) * 1000, len(names)))
+
+  def testCheckWwzSizes(self):
+    policy = {
+        'max_uncompressed_bytes': 3 * 1000 * 1000,
+        'max_member_bytes': 2 * 1000 * 1000,
+        'max_compression_ratio': 50,
+    }
+
+    def Infolist(wwz):
+      return zipfile.ZipFile(cStringIO.StringIO(wwz)).infolist()
+
+    ok = _MakeWwz([('a.txt', 'a' * 1000), ('b.txt', os.urandom(1500 * 1000))])
+    wwup.CheckWwzSizes(policy, Infolist(ok))
+
+    CASES = [
+        # too big in total
+        [('a.bin', os.urandom(1500 * 1000)), ('b.bin', os.urandom(1600 * 1000))],
+        # one member too big
+        [('a.bin', os.urandom(2100 * 1000))],
+        # compresses too well
+        [('zeros.txt', '\0' * (1500 * 1000))],
+    ]
+    for files in CASES:
+      try:
+        wwup.CheckWwzSizes(policy, Infolist(_MakeWwz(files)))
+      except RuntimeError as e:
+        print(e)
+      else:
+        self.fail('Expected error for %s' % [name for name, _ in files])
+
+    # Defaults are relative to max_bytes
+    try:
+      wwup.CheckWwzSizes({'max_bytes': 1000}, Infolist(ok))
+    except RuntimeError as e:
+      print(e)
+    else:
+      self.fail('Expected error')
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def testParseForm(self):
+    contents = 'x\r\n--' + 'y' * 200 + '\r\n-'  # looks like a delimiter
+    body = _MultipartBody(
+        [('payload-type', 'testing'), ('subdir', 'git-123')],
+        [('file1', 'foo.txt', contents), ('file2', 'empty.txt', '')])
+
+    # Small chunks exercise delimiters that span reads
+    for chunk_size in (7, 64, wwup.CHUNK_SIZE):
+      old = wwup.CHUNK_SIZE
+      wwup.CHUNK_SIZE = chunk_size
+      try:
+        form = wwup.ParseForm(_PostEnviron(body), cStringIO.StringIO(body),
+                              self.tmp_dir)
+      finally:
+        wwup.CHUNK_SIZE = old
+
+      self.assertEqual('testing', form['payload-type'].value)
+      self.assertEqual('git-123', form['subdir'].value)
+      self.assertEqual('foo.txt', form['file1'].filename)
+      self.assertEqual(contents, form['file1'].file.read())
+      self.assertEqual('', form['file2'].file.read())
+
+      # Temp files are next to the destination
+      self.assertEqual(self.tmp_dir, os.path.dirname(form['file1'].tmp_path))
+      wwup.CleanupForm(form)
+      self.assertEqual([], os.listdir(self.tmp_dir))
+
+  def testUploadTmpDir(self):
+    now = time.time()
+    tmp_dir = wwup.UploadTmpDir(self.tmp_dir, now)
+    self.assertEqual(os.path.join(self.tmp_dir, '.wwup', 'tmp'), tmp_dir)
+
+    for name, age in [('.wwup-old', wwup.TMP_MAX_AGE_SECS + 60),
+                      ('.wwup-new', 60)]:
+      path = os.path.join(tmp_dir, name)
+      with open(path, 'w') as f:
+        f.write('x')
+      os.utime(path, (now - age, now - age))
+
+    # Temp files left by a killed request are removed
+    self.assertEqual(tmp_dir, wwup.UploadTmpDir(self.tmp_dir, now))
+    self.assertEqual(['.wwup-new'], os.listdir(tmp_dir))
+
+  def testParseFormLimits(self):
+    # only-3-bytes is parsed before the file
+    body = _MultipartBody([('payload-type', 'only-3-bytes')],
+                          [('file1', 'foo.txt', 'four')])
+    try:
+      wwup.ParseForm(_PostEnviron(body), cStringIO.StringIO(body), self.tmp_dir)
+    except RuntimeError as e:
+      print(e)
+    else:
+      self.fail('Expected error')
+    self.assertEqual([], os.listdir(self.tmp_dir))  # temp file removed
+
+    # A repeated name is an error, and both temp files are removed
+    body = _MultipartBody([('payload-type', 'testing')],
+                          [('file1', 'a.txt', 'a'), ('file1', 'b.txt', 'b')])
+    try:
+      wwup.ParseForm(_PostEnviron(body), cStringIO.StringIO(body), self.tmp_dir)
+    except RuntimeError as e:
+      print(e)
+    else:
+      self.fail('Expected error')
+    self.assertEqual([], os.listdir(self.tmp_dir))
+
+    # Too many fields, or too many bytes in all of them
+    for fields in [
+        [('f%d' % i, 'x') for i in xrange(wwup.MAX_FIELDS + 1)],
+        [('f%d' % i, 'x' * 60000) for i in xrange(5)],
+        ]:
+      body = _MultipartBody(fields, [])
+      try:
+        wwup.ParseForm(_PostEnviron(body), cStringIO.StringIO(body),
+                       self.tmp_dir)
+      except RuntimeError as e:
+        print(e)
+      else:
+        self.fail('Expected error')
+
+    # Truncated
+    body = _MultipartBody([('payload-type', 'testing')], [])
+    body = body[:-10]
+    self.assertRaises(
+        RuntimeError, wwup.ParseForm, _PostEnviron(body),
+        cStringIO.StringIO(body), self.tmp_dir)
+
+  def testRepackWwz(self):
+    in_path = os.path.join(self.tmp_dir, 'in.wwz')
+    out_path = os.path.join(self.tmp_dir, 'out.wwz')
+
+    z = zipfile.ZipFile(in_path, 'w')
+    # Deflated for nothing
+    z.writestr('b/image.png', os.urandom(5000), zipfile.ZIP_DEFLATED)
+    z.writestr('b/test.tar', 'x' * 10240, zipfile.ZIP_DEFLATED)
+    # Stored, but compresses well
+    z.writestr('a.html', '<p>hi</p>\n' * 100, zipfile.ZIP_STORED)
+    z.writestr('b/c/d.txt', 'd' * 5000, zipfile.ZIP_STORED)
+    z.writestr('b/c.txt', 'c', zipfile.ZIP_DEFLATED)  # tiny
+    z.writestr('b/e.txt', 'e' * 1000, zipfile.ZIP_DEFLATED)  # already small
+    z.close()
+
+    stats = wwup.RepackWwz(in_path, out_path)
+    print(stats)
+
+    out_z = zipfile.ZipFile(out_path)
+    self.assertEqual(None, out_z.testzip())
+    infos = out_z.infolist()
+    # Grouped by directory
+    self.assertEqual(['a.html', 'b/c.txt', 'b/e.txt', 'b/image.png',
+                      'b/test.tar', 'b/c/d.txt'],
+                     [info.filename for info in infos])
+    methods = dict((info.filename, info.compress_type) for info in infos)
+    self.assertEqual(zipfile.ZIP_STORED, methods['b/image.png'])
+    self.assertEqual(zipfile.ZIP_STORED, methods['b/test.tar'])
+    self.assertEqual(zipfile.ZIP_DEFLATED, methods['a.html'])
+    self.assertEqual(zipfile.ZIP_DEFLATED, methods['b/c/d.txt'])
+    self.assertEqual(zipfile.ZIP_STORED, methods['b/c.txt'])
+    self.assertEqual(zipfile.ZIP_DEFLATED, methods['b/e.txt'])
+
+    self.assertEqual(3, stats['num_stored'])
+    self.assertEqual(3, stats['num_deflated'])
+
+    # A deflated entry's size decides, without compressing it again
+    self.assertEqual(zipfile.ZIP_STORED,
+                     wwup._RepackMethod('a.txt', 'a' * 100, compressed_size=100))
+    self.assertEqual(zipfile.ZIP_DEFLATED,
+                     wwup._RepackMethod('a.txt', 'a' * 100))
+    self.assertEqual(os.path.getsize(in_path), stats['original_bytes'])
+    # Bigger, because the .tar is now stored
+    self.assertEqual(os.path.getsize(out_path), stats['repacked_bytes'])
+
+  def testRetention(self):
+    payload_dir = os.path.join(self.tmp_dir, 'test-retention')
+    now = 1700000000
+    day = 86400
+
+    # Existing dirs are found by the seed walk
+    for i in xrange(5):
+      d = os.path.join(payload_dir, str(100 + i))
+      os.makedirs(d)
+      with open(os.path.join(d, 'a.txt'), 'w') as f:
+        f.write('x' * 1000)
+      os.utime(d, (now - (10 - i) * day, now - (10 - i) * day))
+
+    # Like AfterUpload(), the first upload is recorded before the catalog is
+    # loaded.  Its dir isn't counted twice.
+    d = os.path.join(payload_dir, '200')
+    os.makedirs(d)
+    with open(os.path.join(d, 'a.txt'), 'w') as f:
+      f.write('x' * 500)
+    wwup.RecordUpload(payload_dir, 1, '200', 500, now - 2 * day)
+
+    live, num_lines = wwup.LoadCatalog(payload_dir, 1)
+    print(live)
+    self.assertEqual(6, num_lines)
+    self.assertEqual([now - 10 * day, 1000], live['100'])
+    self.assertEqual([now - 2 * day, 500], live['200'])
+
+    # Recorded uploads add up
+    wwup.RecordUpload(payload_dir, 1, '200', 700, now - 2 * day + 60)
+    wwup.RecordUpload(payload_dir, 1, '201', 500, now - 60)  # too new to delete
+    live, _ = wwup.LoadCatalog(payload_dir, 1)
+    self.assertEqual([now - 2 * day, 1200], live['200'])
+
+    CASES = [
+        ({'max_age_days': 7}, ['100', '101', '102']),
+        ({'max_jobs': 4}, ['100', '101', '102']),
+        ({'max_total_bytes': 2500}, ['100', '101', '102', '103', '104']),
+        ({'max_jobs': 0}, ['100', '101', '102', '103', '104', '200']),
+        ({}, []),
+    ]
+    for retention, expected in CASES:
+      self.assertEqual(expected, wwup.PlanRetention(live, retention, now))
+
+    # Production policies don't delete anything
+    for payload_type in ['github-jobs', 'sourcehut-jobs', 'osh-runtime']:
+      self.assert_('retention' not in wwup.PAYLOADS[payload_type])
+    self.assertNotEqual(id(wwup.PAYLOADS['github-jobs']),
+                        id(wwup.PAYLOADS['sourcehut-jobs']))
+
+    wwup.PAYLOADS['test-retention'] = {'retention': {'max_jobs': 4}}
+    sleeps = []
+    try:
+      deleted = wwup.RunRetention(self.tmp_dir, 'test-retention', now=now,
+                                  sleep=sleeps.append)
+    finally:
+      del wwup.PAYLOADS['test-retention']
+    self.assertEqual(['100', '101', '102'], deleted)
+    self.assertEqual(['103', '104', '200'], sorted(
+        name for name in os.listdir(payload_dir) if not name.startswith('.')))
+
+    live, _ = wwup.LoadCatalog(payload_dir, 1)
+    self.assertEqual(['103', '104', '200', '201'], sorted(live))
+
+    # Passes are rate limited
+    self.assertEqual(True, wwup._RetentionDue(payload_dir, now))
+    self.assertEqual(False, wwup._RetentionDue(payload_dir, now + 60))
+    self.assertEqual(True, wwup._RetentionDue(
+        payload_dir, now + wwup.RETENTION_INTERVAL_SECS))
+
+  def testAggregateTsv(self):
+    payload_dir = os.path.join(self.tmp_dir, 'osh-runtime')
+    os.makedirs(payload_dir)
+    globs = ['osh-runtime/*.tsv', 'bench.tsv']
+
+    def Summaries(subdir, wwz_files, tsv=None):
+      d = os.path.join(payload_dir, subdir)
+      os.makedirs(d)
+      wwz_path = os.path.join(d, 'foo.wwz')
+      with open(wwz_path, 'w') as f:
+        f.write(_MakeWwz(wwz_files))
+      summaries = [{'filename': 'foo.wwz', 'out_path': wwz_path}]
+      if tsv is not None:
+        tsv_path = os.path.join(d, 'bench.tsv')
+        with open(tsv_path, 'w') as f:
+          f.write(tsv)
+        summaries.append({'filename': 'bench.tsv', 'out_path': tsv_path})
+      return summaries
+
+    s1 = Summaries('git-1', [('osh-runtime/times.tsv', 'a\tb\n1\t2\n3\t4\n'),
+                             ('osh-runtime/other.txt', 'not merged')],
+                   tsv='x\n5\n')
+    messages = wwup.AggregateTsv(payload_dir, 'git-1', globs, s1)
+    print(messages)
+
+    # Retried upload isn't merged again
+    messages = wwup.AggregateTsv(payload_dir, 'git-1', globs, s1)
+    print(messages)
+    self.assert_('already merged' in messages[0])
+
+    s2 = Summaries('git-2', [('osh-runtime/times.tsv', 'a\tb\n5\t6\n')])
+    wwup.AggregateTsv(payload_dir, 'git-2', globs, s2)
+
+    # Header and column checks
+    s3 = Summaries('git-3', [('osh-runtime/times.tsv', 'a\tc\n7\t8\n')])
+    messages = wwup.AggregateTsv(payload_dir, 'git-3', globs, s3)
+    print(messages)
+    self.assert_('header' in messages[0])
+    s4 = Summaries('git-4', [('osh-runtime/times.tsv', 'a\tb\n7\n')])
+    messages = wwup.AggregateTsv(payload_dir, 'git-4', globs, s4)
+    print(messages)
+    self.assert_('columns' in messages[0])
+
+    agg_dir = os.path.join(payload_dir, wwup.AGGREGATE_DIR)
+    with open(os.path.join(agg_dir, 'merged/osh-runtime/times.tsv')) as f:
+      self.assertEqual(
+          'subdir\ta\tb\ngit-1\t1\t2\ngit-1\t3\t4\ngit-2\t5\t6\n', f.read())
+    with open(os.path.join(agg_dir, 'merged/bench.tsv')) as f:
+      self.assertEqual('subdir\tx\ngit-1\t5\n', f.read())
+    with open(os.path.join(agg_dir, 'manifest.tsv')) as f:
+      manifest = f.read()
+    print(manifest)
+    self.assertEqual(3, len(manifest.splitlines()))
+
+  def testUploadLog(self):
+    path = os.path.join(self.tmp_dir, 'requests.tsv')
+    log_file = wwup.AppendLogFile(wwup.UPLOAD_LOG_SCHEMA, path)
+
+    for i in xrange(3):
+      timer = wwup.PhaseTimer()
+      timer.fields['action'] = 'upload'
+      timer.fields['payload_type'] = 'bad\tvalue'
+      timer.Begin('parse')
+      timer.Begin('validate')
+      timer.End()
+      timer.millis['copy'] = 100.0 * i
+      timer.Add('num_bytes', 1000)
+      log_file.Append(timer.Row())
+
+    with open(path) as f:
+      lines = f.read().splitlines()
+    print('\n'.join(lines))
+    self.assertEqual(4, len(lines))  # one header
+    self.assertEqual([name for name, _ in wwup.UPLOAD_LOG_SCHEMA],
+                     lines[0].split('\t'))
+    self.assertEqual(len(wwup.UPLOAD_LOG_SCHEMA), len(lines[1].split('\t')))
+
+    out = cStringIO.StringIO()
+    wwup.ReportUploadLog(path, out)
+    report = out.getvalue()
+    print(report)
+    self.assert_('3 requests' in report)
+    # copy is the slowest phase
+    self.assertEqual('copy', report.splitlines()[3].split()[0])
+
+  def testUploadLogFormat(self):
+    # Same bytes as wwz.TabularLogFile
+    schema = [('timestamp', 'double'), ('action', 'string'),
+              ('num_bytes', 'integer')]
+    rows = [(1.5, 'upload', 1000), (2.25, 'run-hook', 0)]
+
+    path1 = os.path.join(self.tmp_dir, 'wwup.tsv')
+    for row in rows:
+      wwup.AppendLogFile(schema, path1).Append(row)
+
+    path2 = os.path.join(self.tmp_dir, 'wwz.tsv')
+    log_file = wwz.TabularLogFile(schema, path2)
+    for row in rows:
+      log_file.Append(row)
+    log_file.Flush()
+
+    with open(path1) as f1, open(path2) as f2:
+      self.assertEqual(f2.read(), f1.read())
+
+  def testUpload(self):
+    wwz = _MakeWwz([('osh-runtime/a.tsv', 'a\tb\n')])
+    body = _MultipartBody(
+        [('payload-type', 'testing'), ('subdir', 'git-123')],
+        [('file1', 'foo.wwz', wwz), ('file2', 'foo.tsv', 'x\ty\n')])
+    environ = _PostEnviron(body)
+    environ['DOCUMENT_ROOT'] = self.tmp_dir
+    environ['HTTP_HOST'] = 'example.com'
+
+    timer = wwup.PhaseTimer()
+    form = wwup.ParseForm(environ, cStringIO.StringIO(body), self.tmp_dir)
+    try:
+      status, headers, chunks = wwup.Upload(environ, form, self.tmp_dir,
+                                            timer=timer)
+    finally:
+      wwup.CleanupForm(form)
+    print(''.join(chunks))
+    self.assertEqual('200 OK', status)
+    print(timer.Row())
+    self.assertEqual(2, timer.counts['num_files'])
+    self.assertEqual(1, timer.counts['num_wwz_entries'])
+    self.assert_('validate' in timer.millis)
+    self.assert_('rename' in timer.millis)
+
+    out_dir = os.path.join(self.tmp_dir, 'testing', 'git-123')
+    self.assertEqual(['.foo.wwz.index', 'foo.tsv', 'foo.wwz'],
+                     sorted(os.listdir(out_dir)))
+    wwz_path = os.path.join(out_dir, 'foo.wwz')
+    with open(wwz_path) as f:
+      self.assertEqual(wwz, f.read())
+
+    # The serving index matches the renamed archive
+    with open(wwup.ServingIndexPath(wwz_path)) as f:
+      index = marshal.load(f)
+    print(index)
+    st = os.stat(wwz_path)
+    self.assertEqual(wwup.SERVING_INDEX_FORMAT, index['format'])
+    self.assertEqual(st.st_size, index['archive_size'])
+    self.assertEqual(st.st_mtime, index['archive_mtime'])
+    self.assertEqual('osh-runtime/a.tsv', index['names'])
+    # No temp files left over
+    self.assertEqual(['testing'], os.listdir(self.tmp_dir))
+
+  def testUploadManyFiles(self):
+    wwup.PAYLOADS['test-many'] = {'max_files': 5, 'max_bytes': 100000}
+
+    def Upload(subdir, files):
+      body = _MultipartBody(
+          [('payload-type', 'test-many'), ('subdir', subdir)], files)
+      environ = _PostEnviron(body)
+      environ['DOCUMENT_ROOT'] = self.tmp_dir
+      environ['HTTP_HOST'] = 'example.com'
+      timer = wwup.PhaseTimer()
+      form = wwup.ParseForm(environ, cStringIO.StringIO(body), self.tmp_dir)
+      try:
+        wwup.Upload(environ, form, self.tmp_dir, timer=timer)
+      finally:
+        wwup.CleanupForm(form)
+      return timer
+
+    try:
+      wwz = _MakeWwz([('a.txt', 'a')])
+      files = [('file%d' % i, 'f%d.tsv' % i, 'x\t%d\n' % i)
+               for i in xrange(1, 5)]
+      files.append(('file10', 'f.wwz', wwz))  # numbers needn't be contiguous
+
+      timer = Upload('ok', files)
+      self.assertEqual(5, timer.counts['num_files'])
+      self.assertEqual(1, timer.counts['num_wwz_entries'])
+      self.assert_('validate' in timer.millis)
+      out_dir = os.path.join(self.tmp_dir, 'test-many', 'ok')
+      self.assertEqual(
+          ['.f.wwz.index', 'f.wwz', 'f1.tsv', 'f2.tsv', 'f3.tsv', 'f4.tsv'],
+          sorted(os.listdir(out_dir)))
+
+      # One bad file means no files are saved
+      bad = files[:2] + [('file3', 'bad.wwz', 'not a zip')] + files[3:]
+      try:
+        Upload('bad', bad)
+      except RuntimeError as e:
+        print(e)
+        self.assert_('file3' in str(e))
+      else:
+        self.fail('Expected error')
+      out_dir = os.path.join(self.tmp_dir, 'test-many', 'bad')
+      self.assertEqual([], os.listdir(out_dir))
+
+      for case in [
+          files + [('file11', 'f11.tsv', 'x\n')],  # too many
+          files[:2] + [('file3', 'f1.tsv', 'x\n')],  # same name twice
+          ]:
+        try:
+          Upload('more', case)
+        except RuntimeError as e:
+          print(e)
+        else:
+          self.fail('Expected error')
+
+      # If a commit fails, the files that weren't committed are removed
+      real_commit = wwup.CommitFile
+      def FailingCommit(prepared, environ, timer=None):
+        if prepared.param_name == 'file2':
+          raise OSError('rename failed')
+        return real_commit(prepared, environ, timer=timer)
+      wwup.CommitFile = FailingCommit
+      try:
+        self.assertRaises(OSError, Upload, 'commit', files)
+      finally:
+        wwup.CommitFile = real_commit
+      out_dir = os.path.join(self.tmp_dir, 'test-many', 'commit')
+      self.assertEqual(['f1.tsv'], os.listdir(out_dir))
+    finally:
+      del wwup.PAYLOADS['test-many']
+
+  def _CallApp(self, app, environ):
+    """Call the WSGI app, and return (status, headers, body)."""
+    started = []
+    body_parts = []
+    def StartResponse(status, headers):
+      started.append((status, headers))
+      return body_parts.append
+    body = app(environ, StartResponse)
+    for chunk in body:
+      body_parts.append(chunk)
+    if hasattr(body, 'close'):
+      body.close()
+    self.assertEqual(1, len(started))
+    status, headers = started[0]
+    return status, dict(headers), ''.join(body_parts)
+
+  def testApp(self):
+    app = wwup.App(self.tmp_dir, max_uploads=1, wait_secs=0)
+
+    status, headers, body = self._CallApp(app, {'REQUEST_METHOD': 'GET'})
+    print(status, headers)
+    self.assertEqual('200 OK', status)
+    self.assertEqual('text/plain; charset=utf-8', headers['Content-Type'])
+    self.assert_('HTTP uploader' in body)
+
+    def Post(fields, files):
+      body = _MultipartBody(fields, files)
+      environ = _PostEnviron(body)
+      environ['DOCUMENT_ROOT'] = self.tmp_dir
+      environ['HTTP_HOST'] = 'example.com'
+      environ['wsgi.input'] = cStringIO.StringIO(body)
+      return self._CallApp(app, environ)
+
+    upload = ([('payload-type', 'testing'), ('subdir', 'git-123')],
+              [('file1', 'foo.tsv', 'x\ty\n')])
+    status, headers, body = Post(*upload)
+    print(body)
+    self.assertEqual('200 OK', status)
+    self.assert_('wwup.cgi Done' in body)
+    out_dir = os.path.join(self.tmp_dir, 'testing', 'git-123')
+    self.assertEqual(['foo.tsv'], os.listdir(out_dir))
+
+    status, headers, body = Post([('payload-type', 'bad')], [])
+    print(body)
+    self.assertEqual('400 Bad Request', status)
+    self.assert_(body.startswith('Bad request: '))
+    self.assert_('Status:' not in body)
+
+    status, headers, body = Post([('cgitb-test', '1')], [])
+    print(body)
+    self.assertEqual('500 Internal Server Error', status)
+    self.assert_('IndexError' in body)
+
+    # All upload slots are busy
+    self.assertEqual(True, app.slots.Acquire(0))
+    try:
+      status, headers, body = Post(*upload)
+    finally:
+      app.slots.Release()
+    self.assertEqual('503 Service Unavailable', status)
+    self.assertEqual('5', headers['Retry-After'])
+
+    # The slot is released when the server closes the body
+    status, headers, body = Post(*upload)
+    self.assertEqual('200 OK', status)
+    self.assertEqual(0, app.slots.num_active)
+
+    # Requests are logged
+    with open(os.path.join(wwup.GetHomeDir(), wwup.UPLOAD_LOG_PATH)) as f:
+      self.assert_(f.read())
+
+  def testWriteCgi(self):
+    closed = []
+    class Body(object):
+      def __iter__(self):
+        return iter(['a\n', 'b\n'])
+      def close(self):
+        closed.append(True)
+
+    out = cStringIO.StringIO()
+    wwup.WriteCgi('400 Bad Request',
+                  [('Content-Type', 'text/plain'), ('Retry-After', '5')],
+                  Body(), out)
+    print(out.getvalue())
+    self.assertEqual(
+        'Status: 400 Bad Request\nContent-Type: text/plain\n'
+        'Retry-After: 5\n\na\nb\n', out.getvalue())
+    self.assertEqual([True], closed)
+
+  def testUploadSlots(self):
+    slots = wwup.UploadSlots(2)
+    self.assertEqual(True, slots.Acquire(0))
+    self.assertEqual(True, slots.Acquire(0))
+    self.assertEqual(False, slots.Acquire(0.01))
+    slots.Release()
+    self.assertEqual(True, slots.Acquire(0))
+
+  def _Session(self, fields, files=None):
+    """Send an upload-session request, and return the output."""
+    form = {}
+    for name, value in fields:
+      form[name] = wwup.FormValue(name, value=str(value))
+    for name, contents in files or []:
+      fd, path = tempfile.mkstemp(dir=self.tmp_dir, prefix='.wwup-')
+      os.write(fd, contents)
+      os.close(fd)
+      form[name] = wwup.FormValue(name, filename='blob', tmp_path=path)
+
+    environ = {'DOCUMENT_ROOT': self.tmp_dir, 'HTTP_HOST': 'example.com'}
+    try:
+      _, _, chunks = wwup.DoUploadSession(environ, form, self.tmp_dir)
+    finally:
+      wwup.CleanupForm(form)
+    return ''.join(chunks)
+
+  def _SessionJson(self, fields):
+    out = self._Session(fields)
+    return json.loads(out[out.index('{'):])
+
+  def testUploadSession(self):
+    wwz = _MakeWwz([('osh-runtime/%d.tsv' % i, os.urandom(300))
+                    for i in xrange(5)])
+    print('%d bytes' % len(wwz))
+    chunk_size = 500
+    chunks = [wwz[i : i + chunk_size] for i in xrange(0, len(wwz), chunk_size)]
+
+    status = self._SessionJson([
+        ('upload-session', 'open'), ('payload-type', 'testing'),
+        ('subdir', 'git-123'), ('filename', 'foo.wwz'), ('size', len(wwz)),
+        ('sha256', hashlib.sha256(wwz).hexdigest()),
+        ('chunk-size', chunk_size)])
+    session_id = status['session_id']
+    self.assertEqual(len(chunks), status['num_chunks'])
+    self.assertEqual([], status['have_chunks'])
+
+    # Send all but the first, in any order
+    for i in reversed(xrange(1, len(chunks))):
+      self._Session([('upload-session', 'chunk'), ('session', session_id),
+                     ('index', i)], [('chunk', chunks[i])])
+
+    # Wrong size
+    self.assertRaises(RuntimeError, self._Session,
+        [('upload-session', 'chunk'), ('session', session_id), ('index', 0)],
+        [('chunk', 'short')])
+
+    # Commit fails
+    commit = [('upload-session', 'commit'), ('session', session_id)]
+    try:
+      self._Session(commit)
+    except RuntimeError as e:
+      print(e)
+      self.assert_('Missing chunks [0]' in str(e))
+    else:
+      self.fail('Expected error')
+
+    # Resume
+    status = self._SessionJson([('upload-session', 'status'),
+                                ('session', session_id)])
+    missing = set(xrange(status['num_chunks'])) - set(status['have_chunks'])
+    self.assertEqual(set([0]), missing)
+    self._Session([('upload-session', 'chunk'), ('session', session_id),
+                   ('index', 0)], [('chunk', chunks[0])])
+
+    # Another commit is in progress
+    session_dir = os.path.join(self.tmp_dir, wwup.SESSIONS_DIR, session_id)
+    with open(os.path.join(session_dir, 'commit.lock'), 'a') as lock_f:
+      fcntl.flock(lock_f, fcntl.LOCK_EX)
+      self.assertRaises(wwup.Conflict, self._Session, commit)
+
+    print(self._Session(commit))
+    out_path = os.path.join(self.tmp_dir, 'testing', 'git-123', 'foo.wwz')
+    with open(out_path) as f:
+      self.assertEqual(wwz, f.read())
+
+    # Session is removed
+    self.assertEqual([], os.listdir(
+        os.path.join(self.tmp_dir, wwup.SESSIONS_DIR)))
+    self.assertRaises(RuntimeError, self._Session,
+                      [('upload-session', 'status'), ('session', session_id)])
+
+  def _Dedup(self, fields, files=None):
+    form = {}
+    for name, value in fields:
+      form[name] = wwup.FormValue(name, value=str(value))
+    for name, contents in files or []:
+      fd, path = tempfile.mkstemp(dir=self.tmp_dir, prefix='.wwup-')
+      os.write(fd, contents)
+      os.close(fd)
+      form[name] = wwup.FormValue(name, filename='blob', tmp_path=path)
+
+    environ = {'DOCUMENT_ROOT': self.tmp_dir, 'HTTP_HOST': 'example.com'}
+    try:
+      _, _, chunks = wwup.DoDedup(environ, form, self.tmp_dir)
+    finally:
+      wwup.CleanupForm(form)
+    return ''.join(chunks)
+
+  def _DedupUpload(self, subdir, members, payload_type='testing'):
+    """Upload like a client would.  Returns the number of blobs sent."""
+    wwz = _MakeWwz(members)
+    manifest = wwup.MakeDedupManifest(zipfile.ZipFile(cStringIO.StringIO(wwz)))
+    out = self._Dedup([('dedup', 'manifest'), ('payload-type', payload_type),
+                       ('subdir', subdir), ('filename', 'foo.wwz')],
+                      [('manifest', manifest)])
+    status = json.loads(out[out.index('{'):])
+
+    by_hash = dict((hashlib.sha256(data).hexdigest(), data)
+                   for _, data in members)
+    blobs = [('blob%d' % i, by_hash[sha256])
+             for i, sha256 in enumerate(status['missing'])]
+    if blobs:
+      out = self._Dedup([('dedup', 'blobs'),
+                         ('session', status['session_id'])], blobs)
+      self.assertEqual([], json.loads(out[out.index('{'):])['missing'])
+
+    self._Dedup([('dedup', 'commit'), ('session', status['session_id'])])
+    return len(blobs)
+
+  def testDedup(self):
+    members = [('osh-runtime/%d.tsv' % i, os.urandom(200)) for i in xrange(5)]
+    self.assertEqual(5, self._DedupUpload('git-1', members))
+
+    # Only the changed member is sent
+    members[2] = ('osh-runtime/2.tsv', 'changed')
+    self.assertEqual(1, self._DedupUpload('git-2', members))
+
+    for subdir in ['git-1', 'git-2']:
+      path = os.path.join(self.tmp_dir, 'testing', subdir, 'foo.wwz')
+      z = zipfile.ZipFile(path)
+      self.assertEqual(None, z.testzip())
+      self.assertEqual(['osh-runtime/%d.tsv' % i for i in xrange(5)],
+                       z.namelist())
+    self.assertEqual('changed', z.read('osh-runtime/2.tsv'))
+    # Times come from the manifest
+    self.assertEqual((2020, 1, 2, 3, 4, 6),
+                     z.getinfo('osh-runtime/2.tsv').date_time)
+
+    # A blob that's pruned after the missing check is reported as missing
+    real_read = wwup.BlobStore.Read
+    def PruningRead(store, sha256):
+      os.unlink(store.Path(sha256))
+      return real_read(store, sha256)
+    wwup.BlobStore.Read = PruningRead
+    try:
+      self._DedupUpload('git-6', [('a.tsv', 'a')])
+    except RuntimeError as e:
+      print(e)
+      self.assert_('Missing 1 blobs' in str(e))
+    else:
+      self.fail('Expected error')
+    finally:
+      wwup.BlobStore.Read = real_read
+
+    # Validated like a normal upload
+    self.assertRaises(RuntimeError, self._DedupUpload, 'git-3',
+                      [('../x.tsv', 'x')])
+    self.assertRaises(RuntimeError, self._DedupUpload, 'git-3',
+                      [('x.html', 'x')])
+
+    # The assembled archive is checked against max_bytes
+    self.assertRaises(RuntimeError, self._DedupUpload, 'git-5',
+                      [('big.tsv', os.urandom(5000))],
+                      payload_type='only-2-files')
+    out_dir = os.path.join(self.tmp_dir, 'only-2-files', 'git-5')
+    self.assertEqual([], os.listdir(out_dir))
+
+    # Blobs not in the manifest are rejected
+    manifest = wwup.MakeDedupManifest(
+        zipfile.ZipFile(cStringIO.StringIO(_MakeWwz([('a.tsv', 'a')]))))
+    out = self._Dedup([('dedup', 'manifest'), ('payload-type', 'testing'),
+                       ('subdir', 'git-4'), ('filename', 'foo.wwz')],
+                      [('manifest', manifest)])
+    session_id = json.loads(out[out.index('{'):])['session_id']
+    self.assertRaises(RuntimeError, self._Dedup,
+        [('dedup', 'blobs'), ('session', session_id)], [('blob1', 'evil')])
+    self.assertRaises(RuntimeError, self._Dedup,
+        [('dedup', 'commit'), ('session', session_id)])
+
+  def testUploadSessionBadHash(self):
+    status = self._SessionJson([
+        ('upload-session', 'open'), ('payload-type', 'testing'),
+        ('subdir', 'git-123'), ('filename', 'foo.tsv'), ('size', 4),
+        ('sha256', hashlib.sha256('nope').hexdigest())])
+    session_id = status['session_id']
+    self._Session([('upload-session', 'chunk'), ('session', session_id),
+                   ('index', 0)], [('chunk', 'a\tb\n')])
+    self.assertRaises(RuntimeError, self._Session,
+                      [('upload-session', 'commit'), ('session', session_id)])
+
+    # Bad params
+    self.assertRaises(RuntimeError, self._Session,
+                      [('upload-session', 'status'), ('session', '../x')])
+    self.assertRaises(RuntimeError, self._Session, [
+        ('upload-session', 'open'), ('payload-type', 'testing'),
+        ('subdir', 'git-123'), ('filename', '../foo.tsv'), ('size', 4),
+        ('sha256', hashlib.sha256('nope').hexdigest())])
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -43,7 +43,8 @@ make-testdata() {
   rm -f $out
 
   pushd _wwz 
-  zip -r $out .
+  # Store .tar files uncompressed, so wwz can serve the files inside them
+  zip -r -n .tar $out .
   popd
   unzip -l $out
 }
@@ -94,7 +95,7 @@ verify-response() {
 cgi-test() {
   mkdir -p $TEST_DIR
 
-  rm -f _tmp/logs/*
+  rm -r -f _tmp/logs/*
 
   # TODO: assert HTTP status, headers, body
 
@@ -114,10 +115,17 @@ cgi-test() {
   run-wwz $PWD /testdata/test.wwz /dir/
   run-wwz $PWD /testdata/test.wwz /test.tar
 
+  # Files inside a STORED tar
+  run-wwz $PWD /testdata/test.wwz /test.tar/_wwz/foo.txt
+  run-wwz $PWD /testdata/test.wwz /test.tar/_wwz/dir/
+  run-wwz $PWD /testdata/test.wwz /test.tar/not-a-file
+
   # Should print an index of files
   run-wwz $PWD /testdata/test.wwz /-wwz-index
   run-wwz $PWD /testdata/test.wwz /dir/-wwz-index
   run-wwz $PWD /testdata/test.wwz /dir/dir2/-wwz-index
+  run-wwz $PWD /testdata/test.wwz /test.tar/-wwz-index
+  run-wwz $PWD /testdata/test.wwz /test.tar/_wwz/-wwz-index
 
   # Should redirect to wwz-index
   run-wwz $PWD /testdata/test.wwz /no-index/
@@ -136,6 +144,9 @@ cgi-test() {
   # trailing slash, but meh that's fine
   run-wwz $PWD /testdata/test.wwz /not-a-dir/
 
+  # Builds the search index on the first request
+  run-wwz $PWD /testdata/test.wwz /-wwz-search
+
   run-wwz $PWD /testdata/test.wwz /-wwz-status
   run-wwz $PWD /testdata/test.wwz /-wwz-css
 
@@ -7,24 +7,40 @@ wwz.py - Serve web content directly from a zip file.
 Dreamhost side.
 """
 
+import array
+import bisect
 import cgi
+import collections
+import errno
+import fcntl
+import fnmatch
+import hashlib
+import json
+import marshal
+import math
 import os
 import re
+import socket
+import SocketServer
+import struct
+import subprocess
 import sys
 import time
 import threading
 import traceback
+import urllib
+import urlparse
+import wsgiref.handlers
+from cStringIO import StringIO
 from email.utils import formatdate  # for HTTP header
-# NOTE: this is not the full 'zipfile' module (in Python), but it has the
-# functionality we need (in C).  We only want to extract zip files, and this is
-# faster.
-import zipimport 
-# Performance note: with 40K files in a 61 MB zip file, this is even slower
+import zlib
+# NOTE: We used to use zipimport, which is faster than the 'zipfile' module.
+# Performance note: with 40K files in a 61 MB zip file, zipfile is even slower
 # than zipimport!  ~700 ms vs. ~450 ms.
 #
-# import zipfile
-# with zipfile.ZipFile(wwz_abs_path) as z:
-#   body = z.read(rel_path)
+# But both keep a Python object per entry, which is tens of MB per archive in
+# a long-lived process.  Now we parse the central directory into ZipIndex,
+# which uses a few flat arrays.
 
 
 # To find out if a zip file is cached, you have to join request log and.
@@ -47,6 +63,8 @@ REQUEST_LOG_SCHEMA = [
     ('thread_name', 'string'),
     ('timestamp', 'double'),
     ('request_uri', 'string'),
+    # So we can map request_uri back to a .wwz file, e.g. for warming up
+    ('document_root', 'string'),
 ]
 
 TRACE_SCHEMA = [
@@ -175,6 +193,20 @@ def NotFound(start_response, msg, *args):
   return [body]
 
 
+def ServerError(start_response, msg, *args):
+  """
+  Usage: return ServerError(start_response, 'message %r', arg)
+  """
+  if args:
+    msg = msg % args
+  start_response('500 Internal Server Error', [HTML_UTF8])
+  body = """\
+<h1>wwz: 500 Internal Server Error</h1>
+<p>%s</p>
+""" % cgi.escape(msg)
+  return [body]
+
+
 # Don't print unsanitized request path to header, which would allow header
 # injection.
 # flup doesn't appear to take care of this!
@@ -233,6 +265,96 @@ def _MakeListing(page_data, rel_paths, dir_prefix):
   page_data['dirs'].extend(sorted(dirs))
 
 
+# Listings are paginated with -wwz-index?after=NAME&limit=N
+LISTING_PAGE_SIZE = 1000
+MAX_LISTING_PAGE_SIZE = 10000
+
+# Listings are streamed in chunks of about this size
+LISTING_CHUNK_BYTES = 16 * 1024
+
+
+def _DirEnd(dir_path):
+  """Return the smallest string greater than all paths under dir_path/."""
+  assert dir_path.endswith('/'), dir_path
+  return dir_path[:-1] + chr(ord('/') + 1)
+
+
+def _ListPage(names, dir_prefix, after, limit):
+  """Like _MakeListing(), but returns one page of entries after 'after'.
+
+  names must be sorted, so the entries of a dir are contiguous, and so are the
+  entries of each subdir.  Subdirs are skipped by bisection, so a page takes
+  O(limit log n) time, no matter how big the dir is.
+
+  Returns:
+    (files, dirs, next_after).  next_after is None on the last page.
+  """
+  if not after:
+    i = bisect.bisect_left(names, dir_prefix)
+  elif after.endswith('/'):
+    i = bisect.bisect_left(names, dir_prefix + _DirEnd(after))
+  else:
+    i = bisect.bisect_right(names, dir_prefix + after)
+
+  files = []
+  dirs = []
+  last = None
+  n = len(names)
+  while i < n:
+    name = names[i]
+    if not name.startswith(dir_prefix):
+      break
+    entry = name[len(dir_prefix):]
+    if not entry:  # don't list yourself
+      i += 1
+      continue
+
+    if len(files) + len(dirs) == limit:
+      return files, dirs, last
+
+    slash1 = entry.find('/')
+    if slash1 == -1:
+      files.append(entry)
+      i += 1
+    else:
+      entry = entry[:slash1+1]  # include /
+      dirs.append(entry)
+      i = bisect.bisect_left(names, dir_prefix + _DirEnd(entry), i)
+    last = entry
+
+  return files, dirs, None
+
+
+def _HasName(names, name):
+  i = bisect.bisect_left(names, name)
+  return i < len(names) and names[i] == name
+
+
+def _PageParams(environ):
+  """Return (after, limit) from the query string.  Raises ValueError."""
+  query = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+  after = query.get('after', [''])[0]
+  limit = int(query.get('limit', [LISTING_PAGE_SIZE])[0])
+  if not (1 <= limit <= MAX_LISTING_PAGE_SIZE):
+    raise ValueError('limit should be between 1 and %d' % MAX_LISTING_PAGE_SIZE)
+  return after, limit
+
+
+def _Batched(chunks, num_bytes=LISTING_CHUNK_BYTES):
+  """Join small chunks, so the server doesn't write each line separately."""
+  buf = []
+  n = 0
+  for chunk in chunks:
+    buf.append(chunk)
+    n += len(chunk)
+    if n >= num_bytes:
+      yield ''.join(buf)
+      buf = []
+      n = 0
+  if buf:
+    yield ''.join(buf)
+
+
 def _MakeCrumb2(crumb2, wwz_name, dir_prefix):
 
   parts = [p for p in dir_prefix.split('/') if p]
@@ -291,34 +413,1291 @@ def _Breadcrumb(crumb, last_slash=False):
   yield '</div>\n\n'
 
 
-def _EntriesHtml(heading, entries, url_suffix=''):
+def _EntriesHtml(heading, entries, url_suffix='', browsable=None):
+  """
+  browsable: if set, a function of an entry that returns whether it's a tar
+    we can browse
+  """
   yield '<h1>%s</h1>\n' % cgi.escape(heading)
 
   if len(entries):
     for entry in entries:
       escaped = cgi.escape(entry, quote=True)
-      yield '<a href="%s">%s</a> <br/>\n' % (escaped + url_suffix, escaped)
+      if browsable and browsable(entry):
+        # Files inside a STORED tar can be served individually
+        yield '<a href="%s">%s</a> <a href="%s/-wwz-index">(browse)</a> <br/>\n' % (
+            escaped + url_suffix, escaped, escaped)
+      else:
+        yield '<a href="%s">%s</a> <br/>\n' % (escaped + url_suffix, escaped)
   else:
     yield '<p><i>(no entries)</i></p>\n'
 
   yield '\n'
 
 
+#
+# On-disk cache of derived data, like the search index
+#
+
+# Bump this when the format of any cached structure changes.
+CACHE_FORMAT = 1
+
+
+def _CachePath(cache_dir, wwz_abs_path, kind):
+  """Cached data for /home/andy/dir/foo.wwz lives in a flat dir.
+
+  The name is a hash of the archive path, so we don't have to mirror the
+  directory structure.
+  """
+  h = hashlib.md5(wwz_abs_path).hexdigest()
+  return os.path.join(cache_dir, '%s.%s' % (h, kind))
+
+
+def _LoadCache(path, version):
+  """Return the cached payload, or None if it's missing or stale.
+
+  version: (size, mtime) of the archive.  If the archive was replaced, the
+  cache entry is ignored.
+  """
+  try:
+    with open(path, 'rb') as f:
+      d = marshal.load(f)
+  except (IOError, EOFError, ValueError, TypeError):
+    return None
+
+  if not isinstance(d, dict):
+    return None
+  if d.get('format') != CACHE_FORMAT or d.get('version') != version:
+    return None
+  return d.get('payload')
+
+
+def _SaveCache(path, version, payload):
+  """Atomically write a cache entry."""
+  d = {'format': CACHE_FORMAT, 'version': version, 'payload': payload}
+
+  cache_dir = os.path.dirname(path)
+  try:
+    os.makedirs(cache_dir)
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+
+  tmp_path = '%s.tmp-%d-%d' % (path, os.getpid(), threading.current_thread().ident)
+  with open(tmp_path, 'wb') as f:
+    marshal.dump(d, f)
+  os.rename(tmp_path, path)
+
+
+#
+# Full-text search
+#
+
+# Members that are worth indexing.  Everything else is binary or too big.
+SEARCH_EXTENSIONS = (
+    '.html', '.htm', '.txt', '.tsv', '.csv', '.json', '.sh', '.py', '.md',
+    '.css', '.js', '.log')
+SEARCH_MAX_MEMBER_BYTES = 2 * 1000 * 1000
+
+# We record the first few positions of each token in each member, for snippets.
+SEARCH_MAX_POSITIONS = 4
+
+_TOKEN_RE = re.compile(r'[a-zA-Z0-9_]{2,}')
+_TAG_RE = re.compile(r'<[^>]*>')
+
+
+def _SearchText(rel_path, data):
+  """Return the text we index.  Positions are offsets into this string."""
+  if rel_path.endswith('.html') or rel_path.endswith('.htm'):
+    # Replace tags with spaces, so offsets stay close to the source.
+    data = _TAG_RE.sub(' ', data)
+  return data
+
+
+def _Tokenize(text):
+  """Yield (lowercase token, offset) pairs."""
+  for m in _TOKEN_RE.finditer(text):
+    yield m.group(0).lower(), m.start()
+
+
+class SearchIndex(object):
+  """Inverted index over the text members of an archive.
+
+  names: list of member names; a member ID is an index into it
+  postings: token -> list of (member ID, term frequency, positions)
+  """
+
+  def __init__(self, names, postings):
+    self.names = names
+    self.postings = postings
+
+  @staticmethod
+  def Build(z):
+    """
+    Args:
+      z: ZipIndex.  The archive is opened once, and members are read without
+         going through the member cache.
+    """
+    names = []
+    postings = {}
+
+    f = open(z.path, 'rb')
+    try:
+      for i in xrange(len(z)):
+        rel_path = z.names[i]
+        if rel_path.endswith('/'):
+          continue
+        if not rel_path.endswith(SEARCH_EXTENSIONS):
+          continue
+        if z.sizes[i] > SEARCH_MAX_MEMBER_BYTES:
+          continue
+
+        names.append(rel_path)
+        SearchIndex._AddPostings(postings, len(names) - 1, rel_path,
+                                 z.Inflate(i, z.ReadRaw(f, i)))
+    finally:
+      f.close()
+
+    return SearchIndex(names, postings)
+
+  @staticmethod
+  def _AddPostings(postings, member_id, rel_path, data):
+    # token -> [term frequency, positions]
+    counts = {}
+    for token, pos in _Tokenize(_SearchText(rel_path, data)):
+      c = counts.get(token)
+      if c is None:
+        counts[token] = [1, [pos]]
+      else:
+        c[0] += 1
+        if len(c[1]) < SEARCH_MAX_POSITIONS:
+          c[1].append(pos)
+
+    for token, (tf, positions) in counts.iteritems():
+      entry = (member_id, tf, tuple(positions))
+      try:
+        postings[token].append(entry)
+      except KeyError:
+        postings[token] = [entry]
+
+  def ToPayload(self):
+    return {'names': self.names, 'postings': self.postings}
+
+  @staticmethod
+  def FromPayload(payload):
+    return SearchIndex(payload['names'], payload['postings'])
+
+  def Query(self, q, dir_prefix='', limit=20):
+    """Return a ranked list of (score, member ID, first position).
+
+    All query terms must appear in a member.  The score is TF-IDF, with a
+    boost for terms in the member name.
+    """
+    tokens = sorted(set(token for token, _ in _Tokenize(q)))
+    if not tokens:
+      return []
+
+    # Intersect the rarest lists first.
+    lists = []
+    for token in tokens:
+      p = self.postings.get(token)
+      if not p:
+        return []
+      lists.append((len(p), token, p))
+    lists.sort()
+
+    n = float(len(self.names))
+    scores = None  # member ID -> [score, position of rarest token]
+    for df, token, p in lists:
+      idf = math.log(1.0 + n / df)
+      if scores is None:
+        scores = {}
+        for member_id, tf, positions in p:
+          if self.names[member_id].startswith(dir_prefix):
+            scores[member_id] = [(1.0 + math.log(tf)) * idf, positions[0]]
+      else:
+        next_scores = {}
+        for member_id, tf, _ in p:
+          s = scores.get(member_id)
+          if s is not None:
+            s[0] += (1.0 + math.log(tf)) * idf
+            next_scores[member_id] = s
+        scores = next_scores
+      if not scores:
+        return []
+
+    for member_id, s in scores.iteritems():
+      name = self.names[member_id].lower()
+      for token in tokens:
+        if token in name:
+          s[0] += 1.0
+
+    ranked = sorted(
+        ((s[0], member_id, s[1]) for member_id, s in scores.iteritems()),
+        key=lambda r: (-r[0], self.names[r[1]]))
+    return ranked[:limit]
+
+
+SNIPPET_BEFORE = 60
+SNIPPET_AFTER = 140
+
+
+def _SnippetHtml(text, pos, q):
+  """Escaped text around the given position, with query terms in bold."""
+  start = max(0, pos - SNIPPET_BEFORE)
+  end = pos + SNIPPET_AFTER
+  snippet = ' '.join(text[start:end].split())  # collapse whitespace
+  snippet = cgi.escape(snippet)
+
+  tokens = set(token for token, _ in _Tokenize(q))
+  pat = re.compile(
+      r'\b(%s)\b' % '|'.join(re.escape(t) for t in sorted(tokens)),
+      re.IGNORECASE)
+  snippet = pat.sub(r'<b>\1</b>', snippet)
+
+  prefix = '... ' if start > 0 else ''
+  suffix = ' ...' if end < len(text) else ''
+  return prefix + snippet + suffix
+
+
+class _SearchBuild(object):
+  """Builds or loads the search index for one archive version in a thread."""
+
+  def __init__(self, z, wwz_abs_path, version, cache_dir):
+    self.z = z  # ZipIndex
+    self.wwz_abs_path = wwz_abs_path
+    self.version = version
+    self.cache_dir = cache_dir
+
+    self.index = None
+    self.error = None
+    self.done = threading.Event()
+    self.build_secs = -1.0
+
+  def Start(self):
+    # Not a daemon thread: under CGI, the process waits for the index to be
+    # persisted before exiting, so the next request can load it.
+    t = threading.Thread(target=self._Run, name='wwz-search-index')
+    t.start()
+
+  def _Run(self):
+    start_time = time.time()
+    try:
+      cache_path = None
+      if self.cache_dir:
+        cache_path = _CachePath(self.cache_dir, self.wwz_abs_path, 'search')
+        payload = _LoadCache(cache_path, self.version)
+        if payload is not None:
+          self.index = SearchIndex.FromPayload(payload)
+          return
+
+      index = SearchIndex.Build(self.z)
+
+      if cache_path:
+        _SaveCache(cache_path, self.version, index.ToPayload())
+      self.index = index
+
+    except Exception as e:
+      log('Error building search index for %r: %s', self.wwz_abs_path, e)
+      self.error = str(e)
+
+    finally:
+      self.build_secs = time.time() - start_time
+      self.done.set()
+
+
+# How long a search request waits for a cold index before telling the client
+# to come back.
+SEARCH_WAIT_SECS = 2.0
+SEARCH_MAX_RESULTS = 100
+
+
+# Remember which (archive, version, member) has which content, so a repeated
+# request doesn't have to read and hash the compressed bytes again.
+MAX_MEMBER_ALIASES = 100 * 1000
+
+
+class MemberCache(object):
+  """LRU cache of decompressed zip members, with a budget in bytes.
+
+  Members are keyed by content, i.e. (crc, size, compressed size, method), so
+  a CSS file that's in every job's archive is inflated and stored once.  The
+  SHA-256 of the compressed bytes is checked before sharing a body, since
+  CRCs collide.
+  """
+
+  def __init__(self, max_bytes, max_member_bytes):
+    self.max_bytes = max_bytes
+    self.max_member_bytes = max_member_bytes
+
+    self.entries = collections.OrderedDict()  # key -> body, oldest first
+    self.digests = {}  # content key -> digest of compressed bytes
+    # location -> (content key, digest).  The digest is compared on lookup,
+    # since a colliding member may have replaced the body of the content key.
+    self.aliases = collections.OrderedDict()
+    self.num_bytes = 0
+    self.lock = threading.Lock()
+
+    # for monitoring
+    self.hits = 0
+    self.misses = 0
+    self.dedup_hits = 0  # a copy inflated for another archive or member
+    self.dedup_bytes = 0
+    self.collisions = 0  # same content key, different bytes
+
+  def Get(self, key):
+    with self.lock:
+      body = self.entries.pop(key, None)
+      if body is None:
+        self.misses += 1
+        return None
+      self.entries[key] = body  # now the most recent
+      self.hits += 1
+      return body
+
+  def Put(self, key, body):
+    n = len(body)
+    if n > self.max_member_bytes or n > self.max_bytes:
+      return
+    with self.lock:
+      old = self.entries.pop(key, None)
+      if old is not None:
+        self.num_bytes -= len(old)
+      self.entries[key] = body
+      self.num_bytes += n
+
+      while self.num_bytes > self.max_bytes:
+        evicted_key, evicted = self.entries.popitem(last=False)
+        self.num_bytes -= len(evicted)
+        self.digests.pop(evicted_key, None)
+
+  def _AddAlias(self, location, content_key, digest):
+    self.aliases.pop(location, None)
+    self.aliases[location] = (content_key, digest)
+    if len(self.aliases) > MAX_MEMBER_ALIASES:
+      self.aliases.popitem(last=False)
+
+  def GetAliased(self, location, content_key):
+    """Return the body if this location was already verified to have this
+    content, or None."""
+    with self.lock:
+      alias = self.aliases.get(location)
+      if alias is None or alias[0] != content_key:
+        return None
+      if self.digests.get(content_key) != alias[1]:
+        return None  # replaced by a colliding member
+      body = self.entries.pop(content_key, None)
+      if body is None:
+        return None
+      self.entries[content_key] = body
+      self.hits += 1
+      return body
+
+  def GetVerified(self, location, content_key, digest):
+    """Return the body if it's cached with the same digest, or None."""
+    with self.lock:
+      body = self.entries.pop(content_key, None)
+      if body is None:
+        self.misses += 1
+        return None
+      self.entries[content_key] = body
+      if self.digests.get(content_key) != digest:
+        self.collisions += 1
+        self.misses += 1
+        return None
+      self.dedup_hits += 1
+      self.dedup_bytes += len(body)
+      self._AddAlias(location, content_key, digest)
+      return body
+
+  def PutVerified(self, location, content_key, digest, body):
+    self.Put(content_key, body)
+    with self.lock:
+      if content_key in self.entries:
+        self.digests[content_key] = digest
+        self._AddAlias(location, content_key, digest)
+
+
+def _ContentType(rel_path):
+  """Return (content type, is_binary) based on the file extension."""
+  if rel_path.endswith('.html'):
+    return 'text/html', False
+  if rel_path.endswith('.css'):
+    return 'text/css', False
+  if rel_path.endswith('.js'):
+    return 'application/javascript', False
+  if rel_path.endswith('.json'):
+    return 'application/json', False
+  if rel_path.endswith('.png'):
+    return 'image/png', True
+  if rel_path.endswith('.tar'):  # for _release/oil.tar
+    # https://developer.mozilla.org/en-US/docs/Web/HTTP/Basics_of_HTTP/MIME_types/Common_types
+    return 'application/x-tar', True
+  return 'text/plain', False  # default
+
+
+#
+# HTTP caching and compression
+#
+
+JSON_UTF8 = ('Content-Type', 'application/json; charset=utf-8')
+
+
+def _AcceptsGzip(environ):
+  """Does the client accept Content-Encoding: gzip?"""
+  for part in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+    fields = [f.strip() for f in part.split(';')]
+    if fields[0].lower() != 'gzip':
+      continue
+    q = 1.0
+    for f in fields[1:]:
+      if f.startswith('q='):
+        try:
+          q = float(f[2:])
+        except ValueError:
+          q = 0.0
+    return q > 0
+  return False
+
+
+def _Gzip(data):
+  c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip header
+  return c.compress(data) + c.flush()
+
+
+# STORED members of these types are gzipped for clients that accept it
+GZIP_EXTENSIONS = ('.html', '.css', '.js', '.json', '.txt', '.tsv')
+GZIP_MIN_BYTES = 256
+# Bigger members are sent as is, rather than compressed in the request
+GZIP_MAX_BYTES = 1000 * 1000
+
+
+def _MakeEtag(version, gzipped):
+  """A strong ETag for a representation of the archive at this version."""
+  size, mtime = version
+  return '"%x-%x%s"' % (size, int(mtime * 1000000), '-gzip' if gzipped else '')
+
+
+def _EtagMatches(if_none_match, etag):
+  """Weak comparison, as If-None-Match requires."""
+  if not if_none_match:
+    return False
+  if if_none_match.strip() == '*':
+    return True
+  for tag in if_none_match.split(','):
+    tag = tag.strip()
+    if tag.startswith('W/'):
+      tag = tag[2:]
+    if tag == etag:
+      return True
+  return False
+
+
+def _MemberJson(z, i):
+  name = z.names[i]
+  return {
+      'name': name,
+      'size': z.sizes[i],
+      'compressed_size': z.compressed_sizes[i],
+      'crc32': '%08x' % z.crcs[i],
+      'type': _ContentType(name)[0],
+  }
+
+
+def _ManifestJson(z, wwz_name):
+  """Every file in the archive, for tools that sync or diff job outputs."""
+  files = [_MemberJson(z, i) for i in xrange(len(z.names))
+           if not z.names[i].endswith('/')]
+  return json.dumps({'archive': wwz_name, 'files': files}, sort_keys=True)
+
+
+def _HasDir(names, dir_prefix):
+  """Does a dir exist, either as an entry or as the prefix of a name?"""
+  if not dir_prefix:
+    return True
+  i = bisect.bisect_left(names, dir_prefix)
+  return i < len(names) and names[i].startswith(dir_prefix)
+
+
+def _DirJson(z, wwz_name, dir_prefix):
+  """The files and subdirs of one dir, which must exist."""
+  files, dirs, _ = _ListPage(z.names, dir_prefix, '', len(z.names))
+  return json.dumps({
+      'archive': wwz_name,
+      'dir': dir_prefix,
+      'files': [_MemberJson(z, z.Find(dir_prefix + f)) for f in files],
+      'dirs': dirs,
+  }, sort_keys=True)
+
+
+#
+# Compact zip index
+#
+
+class BadZip(IOError):
+  pass
+
+
+# End of central directory: signature, disk number, disk with central
+# directory, entries on this disk, total entries, size of central directory,
+# offset of central directory, comment length
+_ZIP_END = struct.Struct('<4s4H2LH')
+
+# Central directory entry: signature, version made by, version needed, flags,
+# method, time, date, crc, compressed size, uncompressed size, name length,
+# extra length, comment length, disk start, internal attrs, external attrs,
+# local header offset
+_ZIP_CENTRAL = struct.Struct('<4s6H3L5H2L')
+
+# Local file header: signature, version, flags, method, time, date, crc,
+# compressed size, uncompressed size, name length, extra length
+_ZIP_LOCAL_HEADER = struct.Struct('<4sHHHHHLLLHH')
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+
+def _ZipDataOffset(f, header_offset):
+  """Given the offset of a local file header, return the offset of the data."""
+  f.seek(header_offset)
+  fields = _ZIP_LOCAL_HEADER.unpack(f.read(_ZIP_LOCAL_HEADER.size))
+  if fields[0] != 'PK\x03\x04':
+    raise BadZip('Bad local file header at offset %d' % header_offset)
+  name_len, extra_len = fields[9], fields[10]
+  return header_offset + _ZIP_LOCAL_HEADER.size + name_len + extra_len
+
+
+# wwup.py writes a serving index next to each uploaded archive, so we don't
+# have to parse the central directory.  See WriteServingIndex() in wwup.py.
+SERVING_INDEX_FORMAT = 'wwz-serving-index-1'
+
+
+def ServingIndexPath(wwz_abs_path):
+  """foo.wwz -> .foo.wwz.index, which is hidden from directory listings."""
+  d, name = os.path.split(wwz_abs_path)
+  return os.path.join(d, '.%s.index' % name)
+
+
+class _NameList(object):
+  """Sequence view of the names in a ZipIndex, so bisect works on it."""
+
+  def __init__(self, blob, starts):
+    self.blob = blob
+    self.starts = starts
+
+  def __len__(self):
+    return len(self.starts) - 1
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += len(self)
+    if not (0 <= i < len(self)):
+      raise IndexError(i)
+    return self.blob[self.starts[i] : self.starts[i+1]]
+
+
+class _PrefixedNames(object):
+  """Sequence view of sorted names with a prefix, e.g. the files in a tar as
+  test.tar/a/b.  Like _NameList, it lets _ListPage() bisect without building
+  a list of every name."""
+
+  def __init__(self, prefix, names):
+    self.prefix = prefix
+    self.names = names
+
+  def __len__(self):
+    return len(self.names)
+
+  def __getitem__(self, i):
+    return self.prefix + self.names[i]
+
+
+class ZipIndex(object):
+  """Central directory of a zip file, stored in a few flat arrays.
+
+  Members are sorted by name.  Member i has name names[i], and its metadata
+  is in column i of the arrays.  Lookup is by bisection.
+  """
+
+  def __init__(self, path, blob, name_starts, header_offsets, compressed_sizes,
+               sizes, crcs, methods):
+    self.path = path
+
+    self.blob = blob  # all names concatenated
+    self.name_starts = name_starts  # array('I'), with a sentinel at the end
+    self.names = _NameList(blob, name_starts)
+
+    self.header_offsets = header_offsets  # array('I')
+    self.compressed_sizes = compressed_sizes  # array('I')
+    self.sizes = sizes  # array('I')
+    self.crcs = crcs  # array('I')
+    self.methods = methods  # array('B')
+
+  @staticmethod
+  def Open(path):
+    """Parse the central directory of a zip file.
+
+    Raises BadZip.
+    """
+    with open(path, 'rb') as f:
+      f.seek(0, os.SEEK_END)
+      file_size = f.tell()
+
+      # The end record is followed by a comment of at most 64 KiB
+      tail_size = min(file_size, _ZIP_END.size + 0xFFFF)
+      f.seek(file_size - tail_size)
+      tail = f.read(tail_size)
+      pos = tail.rfind('PK\x05\x06')
+      if pos == -1 or pos + _ZIP_END.size > len(tail):
+        raise BadZip('%r is not a zip file' % path)
+
+      _, _, _, _, num_entries, cd_size, cd_offset, _ = _ZIP_END.unpack_from(
+          tail, pos)
+      if num_entries == 0xFFFF or cd_offset == 0xFFFFFFFF:
+        raise BadZip('%r is a zip64 file, which is not supported' % path)
+
+      f.seek(cd_offset)
+      cd = f.read(cd_size)
+
+    entries = []
+    pos = 0
+    for _ in xrange(num_entries):
+      if pos + _ZIP_CENTRAL.size > len(cd):
+        raise BadZip('Truncated central directory in %r' % path)
+      (sig, _, _, _, method, _, _, crc, compressed_size, size, name_len,
+       extra_len, comment_len, _, _, _, header_offset) = _ZIP_CENTRAL.unpack_from(cd, pos)
+      if sig != 'PK\x01\x02':
+        raise BadZip('Bad central directory entry in %r' % path)
+
+      name_pos = pos + _ZIP_CENTRAL.size
+      name = cd[name_pos : name_pos + name_len]
+      entries.append(
+          (name, header_offset, compressed_size, size, crc, method))
+
+      pos = name_pos + name_len + extra_len + comment_len
+
+    entries.sort()
+    return ZipIndex.FromEntries(path, entries)
+
+  @staticmethod
+  def LoadServingIndex(path, version):
+    """Load the index that wwup.py wrote at upload time.
+
+    Returns None if it's missing, or stale because the archive's (size, mtime)
+    doesn't match.
+    """
+    try:
+      with open(ServingIndexPath(path), 'rb') as f:
+        d = marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+      return None
+
+    if not isinstance(d, dict) or d.get('format') != SERVING_INDEX_FORMAT:
+      return None
+    if (d.get('archive_size'), d.get('archive_mtime')) != version:
+      return None
+
+    columns = []
+    try:
+      for name, typecode in _SERVING_INDEX_COLUMNS:
+        a = array.array(typecode)
+        a.fromstring(d[name])
+        if sys.byteorder == 'big':
+          a.byteswap()  # stored little endian
+        columns.append(a)
+      names = d['names']
+    except (KeyError, TypeError, ValueError):
+      return None
+
+    if len(columns[0]) != len(columns[1]) + 1:  # sentinel in name_starts
+      return None
+    return ZipIndex(path, names, *columns)
+
+  @staticmethod
+  def FromEntries(path, entries):
+    """
+    Args:
+      entries: sorted list of
+        (name, header offset, compressed size, size, crc, method)
+    """
+    name_starts = array.array('I')
+    header_offsets = array.array('I')
+    compressed_sizes = array.array('I')
+    sizes = array.array('I')
+    crcs = array.array('I')
+    methods = array.array('B')
+
+    parts = []
+    n = 0
+    for name, header_offset, compressed_size, size, crc, method in entries:
+      name_starts.append(n)
+      parts.append(name)
+      n += len(name)
+
+      header_offsets.append(header_offset)
+      compressed_sizes.append(compressed_size)
+      sizes.append(size)
+      crcs.append(crc)
+      methods.append(method)
+    name_starts.append(n)  # sentinel
+
+    return ZipIndex(path, ''.join(parts), name_starts, header_offsets,
+                    compressed_sizes, sizes, crcs, methods)
+
+  def __len__(self):
+    return len(self.header_offsets)
+
+  def Find(self, name):
+    """Return the index of a member, or -1."""
+    i = bisect.bisect_left(self.names, name)
+    if i < len(self.names) and self.names[i] == name:
+      return i
+    return -1
+
+  def __contains__(self, name):
+    return self.Find(name) != -1
+
+  def ReadRaw(self, f, i):
+    """Return the compressed bytes of member i, from an open file."""
+    f.seek(_ZipDataOffset(f, self.header_offsets[i]))
+    return f.read(self.compressed_sizes[i])
+
+  def Read(self, name):
+    """Return the contents of a member, like zipimporter.get_data().
+
+    Raises IOError if it doesn't exist.
+    """
+    i = self.Find(name)
+    if i == -1:
+      raise IOError('%r not found in %r' % (name, self.path))
+
+    with open(self.path, 'rb') as f:
+      raw = self.ReadRaw(f, i)
+    return self.Inflate(i, raw)
+
+  def Inflate(self, i, raw):
+    """Decompress the raw bytes of member i, and check its CRC."""
+    name = self.names[i]
+    method = self.methods[i]
+    if method == ZIP_STORED:
+      body = raw
+    elif method == ZIP_DEFLATED:
+      size = self.sizes[i]
+      d = zlib.decompressobj(-15)
+      # Don't inflate more than the central directory says, e.g. zip bombs
+      try:
+        body = d.decompress(raw, size + 1)
+      except zlib.error as e:
+        raise BadZip('Error inflating %r in %r: %s' % (name, self.path, e))
+      if len(body) != size or d.unconsumed_tail:
+        raise BadZip('%r has the wrong size in %r' % (name, self.path))
+    else:
+      raise BadZip('%r uses unsupported compression method %d' % (name, method))
+
+    if zlib.crc32(body) & 0xFFFFFFFF != self.crcs[i]:
+      raise BadZip('%r has a bad CRC in %r' % (name, self.path))
+    return body
+
+  def MemoryBytes(self):
+    """Approximate memory used by the index."""
+    n = len(self.blob)
+    for a in (self.name_starts, self.header_offsets, self.compressed_sizes,
+              self.sizes, self.crcs, self.methods):
+      n += a.itemsize * len(a)
+    return n
+
+
+# Array columns in the serving index, in the order of ZipIndex.__init__()
+_SERVING_INDEX_COLUMNS = [
+    ('name_starts', 'I'),
+    ('header_offsets', 'I'),
+    ('compressed_sizes', 'I'),
+    ('sizes', 'I'),
+    ('crcs', 'I'),
+    ('methods', 'B'),
+]
+
+
+#
+# Serving files inside a .tar member
+#
+
+class TarError(Exception):
+  pass
+
+
+def _FindTarMember(z, rel_path):
+  """
+  test.tar/a/b -> ('test.tar', 'a/b')
+  test.tar/    -> ('test.tar', '')
+  foo.html     -> (None, None)
+
+  The tar must be a file in the zip.  A zip dir can also be named foo.tar/,
+  and its paths are served from the zip.
+  """
+  i = rel_path.find('.tar/')
+  while i != -1:
+    tar_member = rel_path[:i+4]
+    if tar_member in z:
+      return tar_member, rel_path[i+5:]
+    i = rel_path.find('.tar/', i+1)
+  return None, None
+
+
+def _TarNumber(field):
+  if field and ord(field[0]) & 0x80:  # GNU base-256 encoding
+    n = ord(field[0]) & 0x7f
+    for c in field[1:]:
+      n = (n << 8) | ord(c)
+    return n
+  field = field.strip(' \0')
+  return int(field, 8) if field else 0
+
+
+def _TarString(field):
+  return field.split('\0', 1)[0]
+
+
+def _PaxPath(data):
+  """Return the 'path' record of a pax extended header, or None."""
+  pos = 0
+  path = None
+  while pos < len(data):
+    space = data.find(' ', pos)
+    if space == -1:
+      break
+    length = int(data[pos:space])
+    record = data[space+1 : pos+length-1]  # remove trailing newline
+    key, _, value = record.partition('=')
+    if key == 'path':
+      path = value
+    pos += length
+  return path
+
+
+class TarIndex(object):
+  """Offsets of the files in a tar, relative to the start of the .wwz file.
+
+  names: sorted list of names.  Directories end with /.
+  offsets, sizes: parallel lists.  Directories have size 0.
+  """
+
+  def __init__(self, names, offsets, sizes):
+    self.names = names
+    self.offsets = offsets
+    self.sizes = sizes
+    self.lookup = dict((name, i) for i, name in enumerate(names))
+
+  @staticmethod
+  def Build(f, start, length):
+    """Read tar headers from an open .wwz file.
+
+    Args:
+      start: offset of the STORED tar data
+      length: size of the tar data
+    """
+    entries = []
+    pos = 0
+    long_name = None  # from GNU 'L' or pax 'x' headers
+
+    # Malformed number fields raise ValueError
+    try:
+      while pos + 512 <= length:
+        f.seek(start + pos)
+        header = f.read(512)
+        if len(header) != 512:
+          raise TarError('Truncated tar header at offset %d' % pos)
+        if header == '\0' * 512:
+          break  # end of archive
+
+        name = _TarString(header[0:100])
+        size = _TarNumber(header[124:136])
+        typeflag = header[156]
+        if header[257:262] == 'ustar':
+          prefix = _TarString(header[345:500])
+          if prefix:
+            name = prefix + '/' + name
+
+        data_pos = pos + 512
+        if data_pos + size > length:
+          raise TarError('Tar member %r at offset %d extends past the end' %
+                         (name, pos))
+        pos = data_pos + (size + 511) // 512 * 512
+
+        if typeflag == 'L':
+          f.seek(start + data_pos)
+          long_name = _TarString(f.read(size))
+          continue
+        if typeflag == 'x':
+          f.seek(start + data_pos)
+          long_name = _PaxPath(f.read(size)) or long_name
+          continue
+        if typeflag == 'g':
+          continue
+
+        if long_name is not None:
+          name = long_name
+          long_name = None
+
+        if name.startswith('./'):
+          name = name[2:]
+        if not name or name.startswith('/'):
+          continue
+
+        if typeflag == '5':
+          if not name.endswith('/'):
+            name += '/'
+          entries.append((name, start + data_pos, 0))
+        elif typeflag in ('0', '\0', '7'):  # regular file
+          entries.append((name, start + data_pos, size))
+        # Skip links and devices
+    except ValueError as e:
+      raise TarError('Invalid tar header: %s' % e)
+
+    entries.sort()
+    return TarIndex([e[0] for e in entries], [e[1] for e in entries],
+                    [e[2] for e in entries])
+
+  def ToPayload(self):
+    return {'names': self.names, 'offsets': self.offsets, 'sizes': self.sizes}
+
+  @staticmethod
+  def FromPayload(payload):
+    return TarIndex(payload['names'], payload['offsets'], payload['sizes'])
+
+  def Read(self, f, name):
+    """Return the contents of a file, or None if it's not in the tar."""
+    i = self.lookup.get(name)
+    if i is None or name.endswith('/'):
+      return None
+    f.seek(self.offsets[i])
+    return f.read(self.sizes[i])
+
+
+#
+# Virtual views: many archives presented as one tree
+#
+# A .wwzv file is a config file with a glob like */benchmarks.wwz, relative to
+# its dir.  The view serves jobs.wwzv/<job>/<member>, where <job> is the text
+# matched by the wildcards.
+#
+
+# Rescan the dirs at most this often.  A rescan only stats the dirs whose
+# parent changed, since that's where new jobs appear.  Dirs whose mtime hasn't
+# changed aren't listed again.
+VIEW_RESCAN_SECS = 5.0
+# Stat every dir this often, to find archives added to an existing dir.
+VIEW_FULL_RESCAN_SECS = 60.0
+
+
+def _IsWildcard(part):
+  return any(c in part for c in '*?[')
+
+
+def ParseViewConfig(contents):
+  """Return the glob in a .wwzv file.  Raises ValueError.
+
+  Blank lines and lines starting with # are ignored.
+  """
+  lines = [line.strip() for line in contents.splitlines()]
+  lines = [line for line in lines if line and not line.startswith('#')]
+  if len(lines) != 1:
+    raise ValueError('Expected 1 glob, got %d lines' % len(lines))
+  glob = lines[0]
+
+  parts = glob.split('/')
+  if glob.startswith('/') or '' in parts or '.' in parts or '..' in parts:
+    raise ValueError('Glob %r should be a relative path, without . or ..' %
+                     glob)
+  if not any(_IsWildcard(part) for part in parts):
+    raise ValueError('Glob %r has no wildcards' % glob)
+  return glob
+
+
+class VirtualView(object):
+  """A combined index of the archives matching a glob.
+
+  It maps job names to archive paths.  The archives themselves are opened
+  lazily, and cached like any other archive.
+  """
+
+  def __init__(self, base_dir, glob):
+    self.base_dir = base_dir
+    self.parts = glob.split('/')
+
+    # dir -> (mtime, sorted names).  A new archive changes the mtime of its
+    # dir, so only those dirs are listed again.
+    self.listings = {}
+    self.jobs = {}  # job name -> archive path
+    self.names = []  # sorted 'job/' entries, for _ListPage()
+    self.mtime = 0.0  # newest dir mtime, for Last-Modified
+    # job name -> archive paths that got the same name, and aren't served
+    self.collisions = {}
+
+    self.last_scan = 0.0
+    self.last_full_scan = 0.0
+    self.num_scans = 0
+    self.lock = threading.Lock()
+
+  @staticmethod
+  def Load(config_path):
+    """Raises IOError or ValueError."""
+    with open(config_path) as f:
+      glob = ParseViewConfig(f.read())
+    return VirtualView(os.path.dirname(config_path), glob)
+
+  def _ListDir(self, dir_path, listings, check):
+    """Return (sorted names in a dir, whether they changed).
+
+    If check is false and the dir was listed before, the old names are
+    returned without a stat().  A dir that doesn't exist has no names.
+    """
+    entry = self.listings.get(dir_path)
+    if entry is not None and not check:
+      listings[dir_path] = entry
+      return entry[1], False
+    try:
+      mtime = os.stat(dir_path).st_mtime
+    except OSError:
+      return [], True
+    changed = entry is None or entry[0] != mtime
+    if changed:
+      try:
+        names = sorted(os.listdir(dir_path))
+      except OSError:
+        return [], True
+      entry = (mtime, names)
+    listings[dir_path] = entry
+    return entry[1], changed
+
+  def _Scan(self, full):
+    listings = {}
+    # (path, texts matched by wildcards, whether to stat it).  The base dir is
+    # always checked, and a dir is checked when its parent changed.
+    matches = [(self.base_dir, (), True)]
+    for part in self.parts:
+      next_matches = []
+      for path, keys, check in matches:
+        names, changed = self._ListDir(path, listings, full or check)
+        if _IsWildcard(part):
+          for name in fnmatch.filter(names, part):
+            if not name.startswith('.'):  # e.g. temp files from wwup
+              next_matches.append(
+                  (os.path.join(path, name), keys + (name,), changed))
+        elif _HasName(names, part):
+          next_matches.append((os.path.join(path, part), keys, changed))
+      matches = next_matches
+
+    # Two matches can join to the same name, like a-b/c and a/b-c.  Neither
+    # is served, since which one wins would depend on the scan order.
+    paths = {}
+    for path, keys, _ in matches:
+      paths.setdefault('-'.join(keys), []).append(path)
+    jobs = {}
+    collisions = {}
+    for job, job_paths in paths.iteritems():
+      if len(job_paths) == 1:
+        jobs[job] = job_paths[0]
+      else:
+        collisions[job] = job_paths
+        if job not in self.collisions:
+          log('wwz: view %s has %d archives for job %r: %s', self.base_dir,
+              len(job_paths), job, ' '.join(job_paths))
+
+    self.listings = listings
+    self.jobs = jobs
+    self.collisions = collisions
+    self.names = sorted(job + '/' for job in jobs)
+    self.mtime = max(mtime for mtime, _ in listings.itervalues()) \
+        if listings else 0.0
+    self.num_scans += 1
+
+  def MaybeRescan(self, max_age_secs=VIEW_RESCAN_SECS,
+                  full_age_secs=VIEW_FULL_RESCAN_SECS):
+    with self.lock:
+      now = time.time()
+      if now - self.last_scan >= max_age_secs:
+        full = now - self.last_full_scan >= full_age_secs
+        self._Scan(full)
+        self.last_scan = now
+        if full:
+          self.last_full_scan = now
+
+  def Lookup(self, job):
+    """Return the archive path for a job, or None."""
+    return self.jobs.get(job)
+
+
+#
+# Warming caches from recent request logs
+#
+
+def _RecentRequestLogs(log_dir, n):
+  """Return the n most recent request logs.  The names start with a
+  timestamp, so they sort chronologically."""
+  try:
+    names = os.listdir(log_dir)
+  except OSError:
+    return []
+  logs = sorted(name for name in names if name.endswith('.request.log'))
+  return [os.path.join(log_dir, name) for name in logs[-n:]]
+
+
+def _CountHits(log_paths):
+  """Rank archives by hit count in request logs.
+
+  Returns:
+    archive abs path -> {member rel path -> hit count}
+  """
+  hits = {}
+  for path in log_paths:
+    with open(path) as f:
+      header = f.readline().rstrip('\n').split('\t')
+      try:
+        uri_col = header.index('request_uri')
+        root_col = header.index('document_root')
+      except ValueError:
+        continue  # old log without document_root
+
+      for line in f:
+        row = line.rstrip('\n').split('\t')
+        if len(row) != len(header):
+          continue
+        request_uri = row[uri_col].split('?', 1)[0]
+        doc_root = row[root_col]
+
+        # Like the rewrite rule in wwz.htaccess, which is greedy
+        i = request_uri.rfind('.wwz/')
+        if i == -1 or doc_root == '-':
+          continue
+        wwz_base_url = request_uri[:i+4]
+        rel_path = request_uri[i+5:]
+
+        if rel_path.startswith('-wwz-') or '/-wwz-' in rel_path:
+          continue
+        if rel_path == '' or rel_path.endswith('/'):
+          rel_path += 'index.html'
+
+        wwz_abs_path = os.path.join(doc_root, wwz_base_url[1:])
+        members = hits.setdefault(wwz_abs_path, {})
+        members[rel_path] = members.get(rel_path, 0) + 1
+  return hits
+
+
+def _TopN(counts, n):
+  """Return the n keys with the highest counts."""
+  ranked = sorted(counts.iteritems(), key=lambda pair: (-pair[1], pair[0]))
+  return [key for key, _ in ranked[:n]]
+
+
+class WarmUp(object):
+  """Pre-open the hottest archives, and pre-load their hottest members.
+
+  Runs in a thread while the server is accepting requests.
+  """
+
+  def __init__(self, app, num_logs, num_archives, num_members):
+    self.app = app
+    self.num_logs = num_logs
+    self.num_archives = num_archives
+    self.num_members = num_members
+
+    # for the status page
+    self.state = 'not started'
+    self.archives_done = 0
+    self.archives_total = 0
+    self.members_loaded = 0
+    self.bytes_loaded = 0
+    self.start_time = None
+    self.elapsed = 0.0
+
+  def Start(self):
+    t = threading.Thread(target=self._Run, name='wwz-warm-up')
+    t.daemon = True  # don't keep the process alive
+    t.start()
+
+  def _Run(self):
+    self.start_time = time.time()
+    self.state = 'reading logs'
+    try:
+      log_paths = _RecentRequestLogs(self.app.log_dir, self.num_logs)
+      hits = _CountHits(log_paths)
+
+      archive_hits = dict(
+          (path, sum(members.itervalues())) for path, members in hits.iteritems())
+      top_archives = _TopN(archive_hits, self.num_archives)
+
+      self.archives_total = len(top_archives)
+      self.state = 'loading'
+
+      tracer = RequestTracer()  # not recorded anywhere
+      for wwz_abs_path in top_archives:
+        self._LoadArchive(wwz_abs_path, hits[wwz_abs_path], tracer)
+        self.archives_done += 1
+
+      self.state = 'done'
+    except Exception as e:
+      log('Error warming up: %s', e)
+      self.state = 'error: %s' % e
+    finally:
+      self.elapsed = time.time() - self.start_time
+
+  def _LoadArchive(self, wwz_abs_path, member_hits, tracer):
+    try:
+      st = os.stat(wwz_abs_path)
+    except OSError:
+      return  # deleted since it was logged
+    version = (st.st_size, st.st_mtime)
+
+    z = self.app._GetZip(wwz_abs_path, version, tracer)
+    if z is None:
+      return
+
+    for rel_path in _TopN(member_hits, self.num_members):
+      try:
+        body = self.app._ReadMember(z, wwz_abs_path, version, rel_path)
+      except IOError:
+        continue  # not in the archive anymore, or inside a tar
+      self.members_loaded += 1
+      self.bytes_loaded += len(body)
+
+
 class App(object):
-  def __init__(self, request_log, trace_log, log_dir, pid):
+  def __init__(self, request_log, trace_log, log_dir, pid, cache_dir=None):
     self.traces = []
 
     self.request_log = request_log
     self.trace_log = trace_log
     self.log_dir = log_dir
+    self.cache_dir = cache_dir  # for derived data like search indices
 
-    # path -> zipimporter instance.  They are assumed to be immutable.  If you
-    # mutate one, you have to restart the FastCGI process.
-
-    # TODO: Need to lock this
+    # path -> (version, ZipIndex).  If an archive is replaced, its index is
+    # rebuilt on the next request.
     self.zip_files = {}
     self.zip_files_lock = threading.Lock()  # multiple threads may access state
 
+    # path -> _SearchBuild.  Like zip_files, these are replaced when the
+    # archive's (size, mtime) changes.
+    self.search_builds = {}
+    self.search_lock = threading.Lock()
+
+    # (path, tar member) -> (version, TarIndex)
+    self.tar_indexes = {}
+    self.tar_lock = threading.Lock()
+
+    # .wwzv path -> (version, VirtualView).  The view is rebuilt if its config
+    # changes.
+    self.views = {}
+    self.views_lock = threading.Lock()
+
+    # Decompressed members.  Replaced in main() to change the budget.
+    self.member_cache = MemberCache(0, 0)
+    # Gzipped variants of STORED text members, by location.  Also replaced.
+    self.gzip_cache = MemberCache(0, 0)
+    # Encoded JSON listings, so they don't evict members.  Also replaced.
+    self.json_cache = MemberCache(0, 0)
+    self.warm_up = None  # WarmUp instance
+
     # for monitoring
     self.pid = pid
     self.request_counter = 0
@@ -349,8 +1728,61 @@ class App(object):
     yield '<p>num requests = %d</p>' % self.request_counter
 
     yield '<h3>zip files open</h3>'
-    for name in self.zip_files:  # is this thread safe?
-      yield '<p>%s</p>' % cgi.escape(name)
+    total_bytes = 0
+    for name, (_, z) in self.zip_files.items():
+      n = z.MemoryBytes()
+      total_bytes += n
+      yield '<p>%s - %d members, %d bytes of index</p>' % (
+          cgi.escape(name), len(z), n)
+    yield '<p>total = %d bytes of index</p>' % total_bytes
+
+    c = self.member_cache
+    yield '<h3>member cache</h3>'
+    yield '<p>%d members, %d / %d bytes, %d hits, %d misses</p>' % (
+        len(c.entries), c.num_bytes, c.max_bytes, c.hits, c.misses)
+    lookups = c.hits + c.dedup_hits + c.misses
+    yield ('<p>%d dedup hits (%.1f%% of lookups), %d bytes not inflated again, '
+           '%d locations, %d CRC collisions</p>') % (
+        c.dedup_hits, 100.0 * c.dedup_hits / lookups if lookups else 0.0,
+        c.dedup_bytes, len(c.aliases), c.collisions)
+
+    c = self.gzip_cache
+    yield '<h3>gzip cache</h3>'
+    yield '<p>%d variants, %d / %d bytes, %d hits, %d misses</p>' % (
+        len(c.entries), c.num_bytes, c.max_bytes, c.hits, c.misses)
+
+    c = self.json_cache
+    yield '<h3>JSON cache</h3>'
+    yield '<p>%d listings, %d / %d bytes, %d hits, %d misses</p>' % (
+        len(c.entries), c.num_bytes, c.max_bytes, c.hits, c.misses)
+
+    w = self.warm_up
+    if w:
+      yield '<h3>warm-up</h3>'
+      elapsed = (time.time() - w.start_time) if w.state == 'loading' else w.elapsed
+      yield '<p>%s - %d / %d archives, %d members, %d bytes (%.1f s)</p>' % (
+          cgi.escape(w.state), w.archives_done, w.archives_total,
+          w.members_loaded, w.bytes_loaded, elapsed)
+
+    yield '<h3>virtual views</h3>'
+    for name, (_, view) in self.views.items():
+      yield '<p>%s - %d archives, %d dirs, %d scans</p>' % (
+          cgi.escape(name), len(view.jobs), len(view.listings), view.num_scans)
+      for job, paths in sorted(view.collisions.items()):
+        yield '<p>job %s has %d archives: %s</p>' % (
+            cgi.escape(job), len(paths), cgi.escape(' '.join(paths)))
+
+    yield '<h3>search indices</h3>'
+    for name, build in self.search_builds.items():
+      if build.index:
+        state = '%d members, %d tokens' % (
+            len(build.index.names), len(build.index.postings))
+      elif build.error:
+        state = 'error: %s' % build.error
+      else:
+        state = 'building'
+      yield '<p>%s - %s (%.1f s)</p>' % (
+          cgi.escape(name), cgi.escape(state), build.build_secs)
 
     yield '<h3>traces</h3>'
     for trace in self.traces:  # is this thread safe?
@@ -369,15 +1801,17 @@ class App(object):
     yield _HtmlFooter()
 
   def IndexListing(self, start_response, http_host, wwz_base_url, wwz_abs_path,
-                   rel_path, dir_prefix, last_modified):
+                   rel_path, dir_prefix, last_modified, names,
+                   after='', limit=LISTING_PAGE_SIZE, search=True,
+                   browsable=None):
     """
     wwz_base_url: /dir/foo.wwz
     wwz_abspath: /home/andy/dir/foo.wwz
+    names: sorted members of the zip, or files in a tar
+    after, limit: which page of entries to show
+    search: whether to link to the search page
+    browsable: which files get a (browse) link.  See _EntriesHtml().
     """
-    # 2024-05: Use zipfile module, not zipimport, because it can list files
-    import zipfile
-    z = zipfile.ZipFile(wwz_abs_path)
-
     start_response('200 OK', [HTML_UTF8, last_modified])
 
     if DEBUG:
@@ -404,11 +1838,12 @@ class App(object):
     title = '%s : %s' % (cgi.escape(wwz_name), cgi.escape(dir_prefix))
     yield _HtmlHeader(title, wwz_base_url + '/-wwz-css')
 
+    search_link = '<a href="-wwz-search">Search</a> | ' if search else ''
     yield '''
     <div style="text-align: right">
-      <a href="%s">wwz Status</a>
+      %s<a href="%s">wwz Status</a>
     </div>
-    ''' % (wwz_base_url + '/-wwz-status')
+    ''' % (search_link, wwz_base_url + '/-wwz-status')
 
     page_data = {
       'files': [], 'dirs': [], 
@@ -422,7 +1857,10 @@ class App(object):
       'index_html': False
       }
 
-    _MakeListing(page_data, z.namelist(), dir_prefix)
+    files, dirs, next_after = _ListPage(names, dir_prefix, after, limit)
+    page_data['files'] = files
+    page_data['dirs'] = dirs
+    page_data['index_html'] = _HasName(names, dir_prefix + 'index.html')
 
     n_inside = _MakeCrumb2(page_data['crumb2'], wwz_name, dir_prefix)
 
@@ -441,18 +1879,231 @@ class App(object):
     for chunk in _Breadcrumb(page_data['crumb2']):
       yield chunk
 
-    for chunk in _EntriesHtml('Files', page_data['files']):
+    for chunk in _EntriesHtml('Files', page_data['files'], browsable=browsable):
       yield chunk
 
     for chunk in _EntriesHtml('Dirs', page_data['dirs'], url_suffix='-wwz-index'):
       yield chunk
 
+    if after or next_after is not None:
+      yield '<p>\n'
+      if after:
+        yield '<a href="-wwz-index?limit=%d">First page</a>\n' % limit
+      if next_after is not None:
+        query = urllib.urlencode([('after', next_after), ('limit', limit)])
+        yield '<a href="-wwz-index?%s">Next page</a>\n' % cgi.escape(query,
+                                                                    quote=True)
+      yield '</p>\n'
+
     if page_data['index_html']:
       yield '<hr />\n'
       yield '<p><a href=".">View index.html</a></p>\n'
 
     yield _HtmlFooter()
 
+  def _GetZip(self, wwz_abs_path, version, tracer):
+    """Return a cached ZipIndex, or None if the file isn't a zip."""
+
+    # NOTE: We are doing coarse-grained locking here.  Technically, we could
+    # try not to lock when reading the zip file, but it's more complex.  We
+    # don't know if two cold hits in a row go to the same zip file.  We don't
+    # want to concurrent create duplicate objects.
+    with self.zip_files_lock: 
+      entry = self.zip_files.get(wwz_abs_path)
+      if entry and entry[0] == version:
+        return entry[1]
+
+      tracer.Event('open-zip')
+      z = ZipIndex.LoadServingIndex(wwz_abs_path, version)
+      if z is None:
+        try:
+          z = ZipIndex.Open(wwz_abs_path)
+        except (IOError, struct.error) as e:
+          return None
+      else:
+        tracer.Event('serving-index')
+      self.zip_files[wwz_abs_path] = (version, z)
+      tracer.Event('cached-zip')
+    return z
+
+  def _GetView(self, view_abs_path, version, tracer):
+    """Return a VirtualView, rescanned if it's stale.
+
+    Raises IOError or ValueError if the config is invalid.
+    """
+    with self.views_lock:
+      entry = self.views.get(view_abs_path)
+      if entry and entry[0] == version:
+        view = entry[1]
+      else:
+        view = VirtualView.Load(view_abs_path)
+        self.views[view_abs_path] = (version, view)
+        tracer.Event('load-view')
+
+    view.MaybeRescan()
+    tracer.Event('view-scanned')
+    return view
+
+  def _ReadMember(self, z, wwz_abs_path, version, rel_path):
+    """Like z.Read(), but uses the member cache.
+
+    Raises IOError if the member doesn't exist.
+    """
+    c = self.member_cache
+    if c.max_bytes == 0:  # e.g. CGI
+      return z.Read(rel_path)
+
+    i = z.Find(rel_path)
+    if i == -1:
+      raise IOError('%r not found in %r' % (rel_path, wwz_abs_path))
+
+    location = (wwz_abs_path, version, rel_path)
+    content_key = (z.crcs[i], z.sizes[i], z.compressed_sizes[i], z.methods[i])
+    body = c.GetAliased(location, content_key)
+    if body is not None:
+      return body
+
+    with open(wwz_abs_path, 'rb') as f:
+      raw = z.ReadRaw(f, i)
+    digest = hashlib.sha256(raw).digest()
+
+    body = c.GetVerified(location, content_key, digest)
+    if body is None:
+      body = z.Inflate(i, raw)
+      c.PutVerified(location, content_key, digest, body)
+    return body
+
+  def _GetTarIndex(self, z, wwz_abs_path, version, tar_member):
+    """Return the TarIndex for a STORED .tar member, building it once per
+    archive version.
+
+    Raises TarError if the member can't be indexed.
+    """
+    key = (wwz_abs_path, tar_member)
+    with self.tar_lock:
+      entry = self.tar_indexes.get(key)
+      if entry and entry[0] == version:
+        return entry[1]
+
+      cache_path = None
+      index = None
+      if self.cache_dir:
+        cache_path = _CachePath(self.cache_dir, '%s/%s' % key, 'tar')
+        payload = _LoadCache(cache_path, version)
+        if payload is not None:
+          index = TarIndex.FromPayload(payload)
+
+      if index is None:
+        i = z.Find(tar_member)
+        if z.methods[i] != ZIP_STORED:
+          raise TarError(
+              "%r is compressed in the archive; only STORED tars can be browsed" %
+              tar_member)
+        with open(wwz_abs_path, 'rb') as f:
+          start = _ZipDataOffset(f, z.header_offsets[i])
+          index = TarIndex.Build(f, start, z.compressed_sizes[i])
+        if cache_path:
+          _SaveCache(cache_path, version, index.ToPayload())
+
+      self.tar_indexes[key] = (version, index)
+      return index
+
+  def _GetSearchIndex(self, z, wwz_abs_path, version, timeout):
+    """Return the _SearchBuild, waiting up to timeout for it to finish.
+
+    The first request for an archive starts building the index in a thread.
+    A failed build is kept until the archive changes, so a bad archive isn't
+    indexed again on every request.
+    """
+    with self.search_lock:
+      build = self.search_builds.get(wwz_abs_path)
+      if build is None or build.version != version:
+        build = _SearchBuild(z, wwz_abs_path, version, self.cache_dir)
+        self.search_builds[wwz_abs_path] = build
+        build.Start()
+
+    build.done.wait(timeout)
+    return build
+
+  def SearchPage(self, start_response, environ, z, wwz_base_url, wwz_abs_path,
+                 version, dir_prefix, last_modified):
+    """Serve -wwz-search?q="""
+    start_time = time.time()
+
+    params = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+    q = params.get('q', [''])[0]
+    try:
+      limit = int(params.get('limit', ['20'])[0])
+    except ValueError:
+      limit = 20
+    limit = max(1, min(limit, SEARCH_MAX_RESULTS))
+
+    build = self._GetSearchIndex(z, wwz_abs_path, version, SEARCH_WAIT_SECS)
+    index = build.index
+
+    wwz_name = os.path.basename(wwz_abs_path)
+    title = 'Search %s : %s' % (wwz_name, dir_prefix)
+
+    if index is None:
+      if build.error:
+        start_response('500 Internal Server Error', [HTML_UTF8])
+        msg = 'Error building search index: %s' % build.error
+        extra = ''
+      else:
+        # The client should come back when the index is ready.
+        start_response('503 Service Unavailable',
+                       [HTML_UTF8, ('Retry-After', '2')])
+        msg = 'Building search index for %s.  Try again in a few seconds.' % wwz_name
+        extra = '<meta http-equiv="refresh" content="2">\n'
+      yield _HtmlHeader(title, wwz_base_url + '/-wwz-css')
+      yield extra
+      yield '<p>%s</p>\n' % cgi.escape(msg)
+      yield _HtmlFooter()
+      return
+
+    start_response('200 OK', [HTML_UTF8, last_modified])
+
+    yield _HtmlHeader(title, wwz_base_url + '/-wwz-css')
+    yield '''
+    <div style="text-align: right">
+      <a href="-wwz-index">wwz Index</a>
+    </div>
+    '''
+    yield '<h1>%s</h1>\n' % cgi.escape(title)
+    yield '''
+    <form action="-wwz-search" method="GET">
+      <input type="text" name="q" value="%s" />
+      <input type="submit" value="Search" />
+    </form>
+    ''' % cgi.escape(q, quote=True)
+
+    if not q:
+      yield _HtmlFooter()
+      return
+
+    results = index.Query(q, dir_prefix=dir_prefix, limit=limit)
+
+    # Only read the members we show, for snippets
+    for score, member_id, pos in results:
+      rel_path = index.names[member_id]
+      try:
+        data = self._ReadMember(z, wwz_abs_path, version, rel_path)
+      except IOError:
+        continue  # the index is from a cache that doesn't match
+      text = _SearchText(rel_path, data)
+      url = '%s/%s' % (wwz_base_url, rel_path)
+      yield '<p><a href="%s">%s</a><br/>\n' % (
+          cgi.escape(url, quote=True), cgi.escape(rel_path))
+      yield '<span class="snippet">%s</span></p>\n' % _SnippetHtml(text, pos, q)
+
+    if not results:
+      yield '<p><i>(no results)</i></p>\n'
+
+    elapsed_ms = (time.time() - start_time) * 1000
+    yield '<hr/>\n'
+    yield '<p>%d results in %.1f ms</p>\n' % (len(results), elapsed_ms)
+    yield _HtmlFooter()
+
   def _LogException(self, unique_id, request_uri, exc_type, e, tb):
     # For now, create a file for each exception.  Use a simple name and a
     # simple format.  Eventually it might be nice to revive my simple UDP
@@ -489,7 +2140,8 @@ class App(object):
       request_counter = self.request_counter  # copy it into this thread for later
 
       th = threading.current_thread()  # new thread for every request
-      entry = (unique_id, request_counter, th.getName(), time.time(), request_uri)
+      entry = (unique_id, request_counter, th.getName(), time.time(), request_uri,
+               environ.get('DOCUMENT_ROOT', '-'))
       self.request_log.Append(entry)
 
       try:
@@ -528,7 +2180,8 @@ class App(object):
         REQUEST_URI = /wwz-test/foo.wwz/a/b/c
         DOCUMENT_ROOT = /home/chubot/chubot.org
     """
-    request_uri = environ['REQUEST_URI']
+    # REQUEST_URI includes the query string, e.g. for -wwz-search?q=foo
+    request_uri = environ['REQUEST_URI'].split('?', 1)[0]
     path_info = environ.get('PATH_INFO', '')
 
     # PATH_INFO may be unset if you visit http://example.com/cgi-bin/wwz.py with
@@ -549,21 +2202,90 @@ class App(object):
     n = len(path_info)
     wwz_base_url = request_uri[:-n]   # /dir/foo.wwz
     wwz_abs_path = os.path.join(doc_root, wwz_base_url[1:])
+    rel_path = path_info[1:]  # remove leading /
+
+    if wwz_abs_path.endswith('.wwzv'):
+      return self.RespondView(environ, start_response, tracer, wwz_base_url,
+                              wwz_abs_path, rel_path)
+    return self.RespondArchive(environ, start_response, tracer, wwz_base_url,
+                               wwz_abs_path, rel_path)
+
+  def RespondView(self, environ, start_response, tracer, view_base_url,
+                  view_abs_path, rel_path):
+    """Serve jobs.wwzv/<job>/<member> from the archive of <job>.
 
+    The root of the view lists the jobs.
+    """
+    # The stylesheet and status page of the root listing
+    if rel_path in ('-wwz-css', '-wwz-status'):
+      return self.RespondArchive(environ, start_response, tracer,
+                                 view_base_url, view_abs_path, rel_path)
+
+    try:
+      st = os.stat(view_abs_path)
+    except OSError as e:
+      return NotFound(start_response, "Couldn't open wwzv path %r",
+                      view_abs_path)
+    try:
+      view = self._GetView(view_abs_path, (st.st_size, st.st_mtime), tracer)
+    except (IOError, ValueError) as e:
+      return BadRequest(start_response, 'Invalid view %r: %s', view_abs_path,
+                        e)
+
+    if rel_path == '':
+      return Redirect(start_response, '-wwz-index')
+
+    if rel_path == '-wwz-index':
+      try:
+        after, limit = _PageParams(environ)
+      except ValueError as e:
+        return BadRequest(start_response, 'Invalid page: %s', e)
+
+      last_modified = (
+          'Last-Modified', formatdate(view.mtime, localtime=False, usegmt=True))
+      return _Batched(self.IndexListing(
+        start_response, environ.get('HTTP_HOST', 'HOST'),
+        view_base_url, view_abs_path,
+        rel_path, '', last_modified, view.names,
+        after=after, limit=limit, search=False))
+
+    job, slash, member_path = rel_path.partition('/')
+    wwz_abs_path = view.Lookup(job)
+    if wwz_abs_path is None:
+      return NotFound(start_response, 'Job %r not found in view', job)
+
+    if not slash:  # jobs.wwzv/123 -> jobs.wwzv/123/ (RELATIVE URL)
+      if REDIRECT_RE.match(job):
+        return Redirect(start_response, job + '/')
+      else:
+        return BadRequest(start_response, 'Invalid job %r' % job)
+
+    # Relative links in the archive's pages work under the job's URL
+    return self.RespondArchive(environ, start_response, tracer,
+                               view_base_url + '/' + job, wwz_abs_path,
+                               member_path)
+
+  def RespondArchive(self, environ, start_response, tracer, wwz_base_url,
+                     wwz_abs_path, rel_path):
+    """Serve rel_path from the archive at wwz_abs_path.
+
+    wwz_base_url: the URL of the archive, e.g. /dir/foo.wwz or
+    /dir/jobs.wwzv/123
+    """
     # Use the timestamp on the whole .zip file as the Last-Modified header.  If
     # ANY file in the .zip is modified, consider the whole thing modified.  I
     # think that is fine.
     try:
-      mtime = os.path.getmtime(wwz_abs_path)
+      st = os.stat(wwz_abs_path)
     except OSError as e:
       return NotFound(start_response, "Couldn't open wwz path %r", wwz_abs_path)
+    mtime = st.st_mtime
+    version = (st.st_size, mtime)  # for invalidating derived data
 
     # https://stackoverflow.com/questions/225086/rfc-1123-date-representation-in-python
     last_modified = (
         'Last-Modified', formatdate(mtime, localtime=False, usegmt=True))
 
-    rel_path = path_info[1:]  # remove leading /
-
     if rel_path == '-wwz-css':
       with open('wwz.css') as f:
         body = f.read()
@@ -573,45 +2295,91 @@ class App(object):
     if rel_path == '-wwz-status':
       return list(self.StatusPage(environ, start_response))
 
-    if rel_path == '-wwz-index' or rel_path.endswith('/-wwz-index'):
-      dir_prefix = rel_path[:-len('-wwz-index')]
+    tracer.Event('zip-begin')
 
-      return list(self.IndexListing(
-        start_response, environ.get('HTTP_HOST', 'HOST'),
-        wwz_base_url, wwz_abs_path,
-        rel_path, dir_prefix, last_modified))
+    z = self._GetZip(wwz_abs_path, version, tracer)
+    if z is None:
+      return NotFound(start_response, "Couldn't open wwz path %r", wwz_abs_path)
 
+    tracer.Event('zip-end')
 
-    tracer.Event('zip-begin')
+    if rel_path == '-wwz-search' or rel_path.endswith('/-wwz-search'):
+      dir_prefix = rel_path[:-len('-wwz-search')]
+      chunks = list(self.SearchPage(
+        start_response, environ, z, wwz_base_url, wwz_abs_path, version,
+        dir_prefix, last_modified))
+      tracer.Event('search-end')
+      return chunks
 
-    # NOTE: We are doing coarse-grained locking here.  Technically, we could
-    # try not to lock when reading the zip file, but it's more complex.  We
-    # don't know if two cold hits in a row go to the same zip file.  We don't
-    # want to concurrent create duplicate objects.
-    with self.zip_files_lock: 
-      try:
-        z = self.zip_files[wwz_abs_path]
-      except KeyError:
-        tracer.Event('open-zip')
-        try:
-          z = zipimport.zipimporter(wwz_abs_path)
-        except zipimport.ZipImportError as e:
-          return NotFound(start_response, "Couldn't open wwz path %r", wwz_abs_path)
-        self.zip_files[wwz_abs_path] = z
-        tracer.Event('cached-zip')
+    # Machine-readable listings
+    wwz_name = os.path.basename(wwz_abs_path)
+    if rel_path == '-wwz-manifest.json':
+      return self._ServeJson(
+          start_response, environ, wwz_abs_path, version, rel_path,
+          last_modified, lambda: _ManifestJson(z, wwz_name))
+
+    if rel_path == '-wwz-index.json' or rel_path.endswith('/-wwz-index.json'):
+      dir_prefix = rel_path[:-len('-wwz-index.json')]
+      # Before the ETag is compared, so a missing dir is never a 304
+      if not _HasDir(z.names, dir_prefix):
+        return NotFound(start_response, 'Dir %r not found in wwz archive',
+                        dir_prefix)
+      return self._ServeJson(
+          start_response, environ, wwz_abs_path, version, rel_path,
+          last_modified, lambda: _DirJson(z, wwz_name, dir_prefix))
 
-    tracer.Event('zip-end')
+    if rel_path == '-wwz-index' or rel_path.endswith('/-wwz-index'):
+      try:
+        after, limit = _PageParams(environ)
+      except ValueError as e:
+        return BadRequest(start_response, 'Invalid page: %s', e)
+
+      # Listings are streamed as they're rendered
+      tar_member, _ = _FindTarMember(z, rel_path)
+      if tar_member is None:
+        dir_prefix = rel_path[:-len('-wwz-index')]
+
+        def IsStoredTar(entry):
+          if not entry.endswith('.tar'):
+            return False
+          i = z.Find(dir_prefix + entry)
+          return i != -1 and z.methods[i] == ZIP_STORED
+
+        return _Batched(self.IndexListing(
+          start_response, environ.get('HTTP_HOST', 'HOST'),
+          wwz_base_url, wwz_abs_path,
+          rel_path, dir_prefix, last_modified, z.names,
+          after=after, limit=limit, browsable=IsStoredTar))
+
+      # Listing inside a tar, e.g. test.tar/-wwz-index
+      try:
+        tar_index = self._GetTarIndex(z, wwz_abs_path, version, tar_member)
+      except TarError as e:
+        return BadRequest(start_response, str(e))
 
-    # It's a file
-    is_binary = False
+      dir_prefix = rel_path[:-len('-wwz-index')]
+      names = _PrefixedNames(tar_member + '/', tar_index.names)
+      return _Batched(self.IndexListing(
+        start_response, environ.get('HTTP_HOST', 'HOST'),
+        wwz_base_url, wwz_abs_path,
+        rel_path, dir_prefix, last_modified, names=names,
+        after=after, limit=limit))
 
-    # The zipimporter has directory entries.  But we don't want to serve empty
+    # The zip has directory entries.  But we don't want to serve empty
     # files!
     if rel_path == '' or rel_path.endswith('/'):
       index_html = rel_path + 'index.html'
       try:
-        body = z.get_data(index_html)
+        body = self._ReadMember(z, wwz_abs_path, version, index_html)
+      except BadZip as e:
+        return ServerError(start_response, 'Error reading %r: %s', index_html, e)
       except IOError as e:
+        tar_member, _ = _FindTarMember(z, rel_path)
+        if tar_member is not None:
+          return self._ServeTarMember(
+              start_response, z, wwz_abs_path, version, tar_member,
+              index_html, last_modified, tracer)
+
         # No index.html - redirect to -wwz-index (RELATIVE URL)
         if REDIRECT_RE.match(rel_path):
           return Redirect(start_response, '-wwz-index')
@@ -619,29 +2387,26 @@ class App(object):
           return BadRequest(start_response, 'Invalid path %r' % rel_path)
 
       headers = [HTML_UTF8, last_modified]
+      body = self._MaybeGzip(environ, z, wwz_abs_path, version, index_html,
+                             body, headers)
       return Ok(start_response, headers, body)
 
-    if rel_path.endswith('.html'):
-      content_type = 'text/html'
-    elif rel_path.endswith('.css'):
-      content_type = 'text/css'
-    elif rel_path.endswith('.js'):
-      content_type = 'application/javascript'
-    elif rel_path.endswith('.json'):
-      content_type = 'application/json'
-    elif rel_path.endswith('.png'):
-      content_type = 'image/png'
-      is_binary = True
-    elif rel_path.endswith('.tar'):  # for _release/oil.tar
-      # https://developer.mozilla.org/en-US/docs/Web/HTTP/Basics_of_HTTP/MIME_types/Common_types
-      content_type = 'application/x-tar'
-      is_binary = True
-    else:
-      content_type = 'text/plain'  # default
+    # It's a file
+    content_type, is_binary = _ContentType(rel_path)
 
     try:
-      body = z.get_data(rel_path)
+      body = self._ReadMember(z, wwz_abs_path, version, rel_path)
+    except BadZip as e:
+      # The member exists, but is corrupt or compressed in a way we don't
+      # support
+      return ServerError(start_response, 'Error reading %r: %s', rel_path, e)
     except IOError as e:
+      # Maybe it's a file inside a tar, like test.tar/a/b
+      tar_member, _ = _FindTarMember(z, rel_path)
+      if tar_member is not None:
+        return self._ServeTarMember(
+            start_response, z, wwz_abs_path, version, tar_member, rel_path,
+            last_modified, tracer)
       return NotFound(start_response, 'Path %r not found in wwz archive', rel_path)
 
     tracer.Event('data-read')
@@ -656,16 +2421,312 @@ class App(object):
     # this?
     #print 'ETag: %s' % hash(rel_path)
     headers = [('Content-Type', content_type), last_modified]
+    body = self._MaybeGzip(environ, z, wwz_abs_path, version, rel_path, body,
+                           headers)
 
     chunks = Ok(start_response, headers, body)
     tracer.Event('request-end')
 
     return chunks
 
+  def _GzipVariant(self, wwz_abs_path, version, rel_path, body):
+    """Return the gzipped body, or None if it doesn't compress."""
+    c = self.gzip_cache
+    key = (wwz_abs_path, version, rel_path)
+    gz = c.Get(key)
+    if gz is None:
+      gz = _Gzip(body)
+      if len(gz) >= len(body):
+        gz = ''  # remember not to try again
+      c.Put(key, gz)
+    return gz or None
+
+  def _MaybeGzip(self, environ, z, wwz_abs_path, version, rel_path, body,
+                 headers):
+    """Gzip a STORED text member if the client accepts it.
+
+    Members that are DEFLATED in the zip were compressed by the uploader, and
+    only the GZIP_EXTENSIONS types are worth compressing.  Without a gzip
+    cache, e.g. under CGI, nothing is gzipped, since every request would pay
+    for it.
+
+    Returns the body to send, and appends to headers.
+    """
+    if not self.gzip_cache.max_bytes:
+      return body
+    if not rel_path.endswith(GZIP_EXTENSIONS):
+      return body
+    if not GZIP_MIN_BYTES <= len(body) <= GZIP_MAX_BYTES:
+      return body
+    i = z.Find(rel_path)
+    if i == -1 or z.methods[i] != ZIP_STORED:
+      return body
+
+    headers.append(('Vary', 'Accept-Encoding'))
+    if not _AcceptsGzip(environ):
+      return body
+    gz = self._GzipVariant(wwz_abs_path, version, rel_path, body)
+    if gz is None:
+      return body
+    headers.append(('Content-Encoding', 'gzip'))
+    return gz
+
+  def _ServeJson(self, start_response, environ, wwz_abs_path, version,
+                 rel_path, last_modified, make_json):
+    """Serve JSON derived from the archive index, with an ETag and gzip.
+
+    The encoded body is cached in its own LRU cache, until the archive
+    changes.
+    """
+    gzipped = _AcceptsGzip(environ)
+    etag = _MakeEtag(version, gzipped)
+    headers = [('ETag', etag), ('Vary', 'Accept-Encoding'), last_modified]
+
+    if _EtagMatches(environ.get('HTTP_IF_NONE_MATCH'), etag):
+      start_response('304 Not Modified', headers)
+      return []
+
+    key = (wwz_abs_path, version, rel_path, gzipped)
+    body = self.json_cache.Get(key)
+    if body is None:
+      body = make_json()
+      if gzipped:
+        body = _Gzip(body)
+      self.json_cache.Put(key, body)
+
+    headers.append(JSON_UTF8)
+    if gzipped:
+      headers.append(('Content-Encoding', 'gzip'))
+    return Ok(start_response, headers, body)
+
+  def _ServeTarMember(self, start_response, z, wwz_abs_path, version,
+                      tar_member, rel_path, last_modified, tracer):
+    """Serve test.tar/a/b by reading just its byte range."""
+    try:
+      tar_index = self._GetTarIndex(z, wwz_abs_path, version, tar_member)
+    except TarError as e:
+      return BadRequest(start_response, str(e))
+    tracer.Event('tar-index')
+
+    inner_path = rel_path[len(tar_member)+1:]
+    with open(wwz_abs_path, 'rb') as f:
+      body = tar_index.Read(f, inner_path)
+
+    if body is None:
+      if rel_path.endswith('/index.html'):
+        # Like a dir in the zip: redirect to -wwz-index (RELATIVE URL)
+        if REDIRECT_RE.match(rel_path):
+          return Redirect(start_response, '-wwz-index')
+        else:
+          return BadRequest(start_response, 'Invalid path %r' % rel_path)
+      return NotFound(start_response, 'Path %r not found in %r', inner_path,
+                      tar_member)
+    tracer.Event('data-read')
+
+    content_type, is_binary = _ContentType(inner_path)
+    if not is_binary:
+      content_type = '%s; charset=utf-8' % content_type
+    headers = [('Content-Type', content_type), last_modified]
+    return Ok(start_response, headers, body)
+
+
+#
+# Resident worker, for hosts that only run CGI
+#
+# A CGI invocation of wwz.py forwards the request over a Unix domain socket to
+# a long-lived wwz.py process, which has warm caches.  The worker writes a
+# CGI-style response, which the CGI process copies to stdout.
+#
+
+# Request: 4 byte length, then marshal of {'environ': ..., 'body': ...}
+_LENGTH = struct.Struct('!I')
+
+# Seconds to wait for a newly started worker to listen
+WORKER_START_SECS = 1.0
+
+# The worker exits after being idle this long
+WORKER_IDLE_SECS = 3600
+
+
+class _WorkerCGIHandler(wsgiref.handlers.BaseCGIHandler):
+  # Like CGIHandler: the worker's own environment must not leak into requests
+  os_environ = {}
+
+
+class _WorkerRequestHandler(SocketServer.StreamRequestHandler):
+
+  def handle(self):
+    header = self.rfile.read(_LENGTH.size)
+    if len(header) != _LENGTH.size:
+      return
+    n, = _LENGTH.unpack(header)
+    request = marshal.loads(self.rfile.read(n))
+
+    server = self.server
+    with server.lock:
+      server.num_active += 1
+    try:
+      handler = _WorkerCGIHandler(
+          StringIO(request['body']), self.wfile, sys.stderr,
+          request['environ'], multithread=True, multiprocess=False)
+      handler.run(server.app)
+    finally:
+      with server.lock:
+        server.num_active -= 1
+        server.last_request_time = time.time()
+
+
+class WorkerServer(SocketServer.ThreadingMixIn,
+                   SocketServer.UnixStreamServer):
+  daemon_threads = True
+
+  def __init__(self, app, sock_path):
+    SocketServer.UnixStreamServer.__init__(self, sock_path,
+                                           _WorkerRequestHandler)
+    self.app = app
+    self.lock = threading.Lock()
+    self.num_active = 0
+    self.last_request_time = time.time()
+
+  def IsIdle(self, idle_secs):
+    with self.lock:
+      return (self.num_active == 0 and
+              time.time() - self.last_request_time > idle_secs)
+
+
+def ServeWorker(app, sock_path, idle_secs):
+  """Run the resident worker until it's idle for idle_secs."""
+
+  # Only one worker per socket.  CGI processes may race to start it.
+  lock_f = open(sock_path + '.lock', 'a')
+  try:
+    fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+  except IOError:
+    log('wwz worker: another worker owns %r', sock_path)
+    return
+
+  # Remove the socket of a worker that died
+  try:
+    os.unlink(sock_path)
+  except OSError as e:
+    if e.errno != errno.ENOENT:
+      raise
+
+  old_umask = os.umask(0o077)  # only our user can connect
+  try:
+    server = WorkerServer(app, sock_path)
+  finally:
+    os.umask(old_umask)
+
+  log('wwz worker %d listening on %r', os.getpid(), sock_path)
+  server.timeout = min(idle_secs, 60)
+  try:
+    while not server.IsIdle(idle_secs):
+      server.handle_request()
+  finally:
+    os.unlink(sock_path)
+    server.server_close()
+    lock_f.close()
+  log('wwz worker %d exiting after %d idle seconds', os.getpid(), idle_secs)
+
+
+def _ForwardRequest(sock_path, environ, body, out_f):
+  """Send a request to the worker and copy its response to out_f.
+
+  Returns False if the worker couldn't be reached before any output was
+  written, so the caller can fall back.
+  """
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    try:
+      sock.connect(sock_path)
+      request = marshal.dumps({'environ': environ, 'body': body})
+      sock.sendall(_LENGTH.pack(len(request)) + request)
+      sock.shutdown(socket.SHUT_WR)
+
+      chunk = sock.recv(64 * 1024)
+    except socket.error:
+      return False
+    if not chunk:
+      return False  # worker died before responding
+
+    while chunk:
+      out_f.write(chunk)
+      chunk = sock.recv(64 * 1024)
+    out_f.flush()
+    return True
+  finally:
+    sock.close()
+
+
+def _StartWorker(argv, sock_path):
+  """Start a detached wwz.py worker process."""
+  log_dir = argv[1]
+
+  # Don't pass CGI variables from this request
+  env = dict(
+      (k, v) for k, v in os.environ.iteritems()
+      if k.startswith('WWZ_') or k in ('PATH', 'PYTHONPATH', 'HOME', 'LANG'))
+  env['WWZ_WORKER'] = '1'
+
+  devnull = open(os.devnull, 'r+')
+  err_f = open(os.path.join(log_dir, 'worker.log'), 'a')
+
+  # New session, so the web server doesn't kill it along with this process.
+  # It must not hold our stdout open, or the response would never finish.
+  subprocess.Popen(
+      [sys.executable, os.path.abspath(argv[0])] + argv[1:],
+      env=env, stdin=devnull, stdout=devnull, stderr=err_f, close_fds=True,
+      preexec_fn=os.setsid)
+
+  devnull.close()
+  err_f.close()
+
+
+def ForwardToWorker(argv, sock_path):
+  """Serve this CGI request with the worker, starting it if necessary.
+
+  Returns False if the worker can't be reached.
+  """
+  environ = dict(os.environ.items())
+  try:
+    content_length = int(environ.get('CONTENT_LENGTH') or '0')
+  except ValueError:
+    content_length = 0
+  body = sys.stdin.read(content_length) if content_length else ''
+
+  if _ForwardRequest(sock_path, environ, body, sys.stdout):
+    return True
+
+  try:
+    _StartWorker(argv, sock_path)
+  except (OSError, IOError) as e:
+    log("wwz: couldn't start worker: %s", e)
+    return False
+
+  deadline = time.time() + WORKER_START_SECS
+  delay = 0.01
+  while time.time() < deadline:
+    time.sleep(delay)
+    if _ForwardRequest(sock_path, environ, body, sys.stdout):
+      return True
+    delay = min(delay * 2, 0.2)
+
+  log("wwz: couldn't reach worker at %r; serving in-process", sock_path)
+  return False
+
 
 def main(argv):
   log_dir = argv[1]  # for exceptions
 
+  # CGI stub: forward to the resident worker if one is configured
+  worker_socket = os.getenv('WWZ_WORKER_SOCKET')
+  is_worker = bool(os.getenv('WWZ_WORKER'))
+  if worker_socket and not is_worker and not os.getenv('FASTCGI'):
+    if ForwardToWorker(argv, worker_socket):
+      return
+    # else fall back to serving in-process
+
   pid = os.getpid()
   timestamp = time.strftime('%Y-%m-%d__%H-%M-%S')
 
@@ -683,10 +2744,40 @@ def main(argv):
   else:
     trace_log = NoLogFile()
 
-  # Global instance shared by all threads.
-  app = App(request_log, trace_log, log_dir, pid)
+  # Search indices are persisted here
+  cache_dir = os.getenv('WWZ_CACHE_DIR') or os.path.join(log_dir, 'cache')
 
-  if os.getenv('FASTCGI'):
+  # Global instance shared by all threads.
+  app = App(request_log, trace_log, log_dir, pid, cache_dir=cache_dir)
+
+  if os.getenv('FASTCGI') or is_worker:
+    # Only useful in a persistent process.  In CGI mode, the caches stay
+    # empty, so members aren't hashed for nothing.
+    cache_bytes = int(os.getenv('WWZ_MEMBER_CACHE_BYTES',
+                                str(32 * 1000 * 1000)))
+    app.member_cache = MemberCache(cache_bytes, 1000 * 1000)
+    gzip_bytes = int(os.getenv('WWZ_GZIP_CACHE_BYTES', str(8 * 1000 * 1000)))
+    app.gzip_cache = MemberCache(gzip_bytes, 1000 * 1000)
+    json_bytes = int(os.getenv('WWZ_JSON_CACHE_BYTES', str(4 * 1000 * 1000)))
+    app.json_cache = MemberCache(json_bytes, 1000 * 1000)
+
+    # e.g. WWZ_WARM_UP=10 pre-opens the 10 most requested archives
+    num_archives = int(os.getenv('WWZ_WARM_UP', '0'))
+    if num_archives:
+      app.warm_up = WarmUp(
+          app,
+          int(os.getenv('WWZ_WARM_UP_LOGS', '3')),
+          num_archives,
+          int(os.getenv('WWZ_WARM_UP_MEMBERS', '50')))
+      app.warm_up.Start()
+
+  if is_worker:
+    if not worker_socket:
+      raise RuntimeError('WWZ_WORKER requires WWZ_WORKER_SOCKET')
+    idle_secs = int(os.getenv('WWZ_WORKER_IDLE_SECS', str(WORKER_IDLE_SECS)))
+    ServeWorker(app, worker_socket, idle_secs)
+
+  elif os.getenv('FASTCGI'):
     from flup.server.fcgi import WSGIServer
     # OLD MODULE.  I tested this and it has the same 1.0 delay, which might be
     # cilent DNS or Dreamhost.
@@ -697,8 +2788,7 @@ def main(argv):
     #WSGIServer(app).run()
 
   else:
-    from wsgiref.handlers import CGIHandler
-    CGIHandler().run(app)
+    wsgiref.handlers.CGIHandler().run(app)
 
 
 if __name__ == '__main__':
@@ -5,17 +5,72 @@ wwz_test.py: Tests for wwz.py
 from __future__ import print_function
 
 from pprint import pformat
+import cStringIO
+import json
+import marshal
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
 import unittest
+import zipfile
+import zlib
 
 import wwz  # module under test
 
 
+def _MakeWwz(path, members, compression=zipfile.ZIP_STORED):
+  """
+  Args:
+    members: list of (name or ZipInfo, contents)
+  """
+  z = zipfile.ZipFile(path, 'w', compression)
+  for name, contents in members:
+    z.writestr(name, contents)
+  z.close()
+
+
+def _Environ(doc_root, url, **environ):
+  """CGI variables for a GET of a URL like /foo.wwz/a.txt?x=1.
+
+  PATH_INFO is the part after the .wwz archive or .wwzv view.
+  """
+  path, _, query = url.partition('?')
+  slash = path.find('/', path.index('.wwz'))
+  e = {
+      'REQUEST_URI': url,
+      'PATH_INFO': path[slash:] if slash != -1 else '',
+      'DOCUMENT_ROOT': doc_root,
+  }
+  if query:
+    e['QUERY_STRING'] = query
+  e.update(environ)
+  return e
+
+
 class WwzTest(unittest.TestCase):
   def setUp(self):
-    pass
+    self.tmp_dir = tempfile.mkdtemp()
+    self.app = wwz.App(wwz.NoLogFile(), wwz.NoLogFile(), self.tmp_dir, 1)
 
   def tearDown(self):
-    pass
+    shutil.rmtree(self.tmp_dir)
+
+  def _Get(self, url, **environ):
+    """GET a URL under self.tmp_dir from self.app.
+
+    Returns:
+      (status, headers dict, body)
+    """
+    started = []
+    def StartResponse(status, headers):
+      started.append((status, dict(headers)))
+    chunks = self.app.Respond(_Environ(self.tmp_dir, url, **environ),
+                              StartResponse, wwz.RequestTracer())
+    body = ''.join(chunks)
+    status, headers = started[0]
+    return status, headers, body
 
   def testMakeListing(self):
     print(wwz)
@@ -34,6 +89,711 @@ class WwzTest(unittest.TestCase):
       wwz._MakeListing(page_data, rel_paths, dir_prefix)
       print(pformat(page_data, indent=2))
 
+  def testListPage(self):
+    names = sorted(
+        ['a.txt', 'big/', 'dir-2/x', 'index.html', 'z.txt'] +
+        ['big/%05d.txt' % i for i in xrange(5000)])
+
+    # One page
+    files, dirs, next_after = wwz._ListPage(names, '', '', 100)
+    self.assertEqual(['a.txt', 'index.html', 'z.txt'], files)
+    self.assertEqual(['big/', 'dir-2/'], dirs)
+    self.assertEqual(None, next_after)
+    self.assertEqual(True, wwz._HasName(names, 'index.html'))
+    self.assertEqual(False, wwz._HasName(names, 'big/index.html'))
+
+    # Walk the pages, with a cursor after a dir
+    pages = []
+    after = ''
+    while True:
+      files, dirs, after = wwz._ListPage(names, '', after, 2)
+      pages.append((files, dirs))
+      if after is None:
+        break
+    print(pages)
+    self.assertEqual([(['a.txt'], ['big/']), (['index.html'], ['dir-2/']),
+                      (['z.txt'], [])], pages)
+
+    # Same entries as _MakeListing()
+    page_data = {'files': [], 'dirs': []}
+    wwz._MakeListing(page_data, names, 'big/')
+    entries = []
+    after = ''
+    while after is not None:
+      files, dirs, after = wwz._ListPage(names, 'big/', after, 777)
+      entries.extend(files + dirs)
+    self.assertEqual(page_data['files'] + page_data['dirs'], entries)
+
+    # Names in a tar are prefixed lazily, so a page reads only a few of them
+    class CountingList(list):
+      num_reads = 0
+      def __getitem__(self, i):
+        CountingList.num_reads += 1
+        return list.__getitem__(self, i)
+
+    tar_names = wwz._PrefixedNames('test.tar/', CountingList(names))
+    self.assertEqual('test.tar/a.txt', tar_names[0])
+    files, dirs, after = wwz._ListPage(tar_names, 'test.tar/big/', '02000', 10)
+    self.assertEqual(['%05d.txt' % i for i in xrange(2000, 2010)], files)
+    print('reads', CountingList.num_reads)
+    self.assert_(CountingList.num_reads < 100, CountingList.num_reads)
+
+  def testIndexListingPages(self):
+    _MakeWwz(os.path.join(self.tmp_dir, 'foo.wwz'),
+             [('dir/%d.txt' % i, 'x') for i in xrange(5)])
+
+    url = '/foo.wwz/dir/-wwz-index?limit=2'
+    chunks = self.app.Respond(_Environ(self.tmp_dir, url),
+                              lambda status, headers: None, wwz.RequestTracer())
+    self.assert_(not isinstance(chunks, list))  # streamed
+
+    status, _, body = self._Get(url)
+    self.assertEqual('200 OK', status)
+    self.assert_('1.txt' in body and '2.txt' not in body, body)
+    self.assert_('-wwz-index?after=1.txt&amp;limit=2' in body, body)
+
+    _, _, body = self._Get('/foo.wwz/dir/-wwz-index?after=3.txt&limit=2')
+    self.assert_('4.txt' in body and '3.txt' not in body, body)
+    self.assert_('Next page' not in body, body)
+    self.assert_('First page' in body, body)
+
+    status, _, _ = self._Get('/foo.wwz/dir/-wwz-index?limit=0')
+    self.assertEqual('400 Bad Request', status)
+
+  def testJsonListing(self):
+    _MakeWwz(os.path.join(self.tmp_dir, 'foo.wwz'), [
+        ('index.html', '<p>hi</p>'),
+        ('dir/a.json', '{}' * 100),
+        ('dir/sub/b.txt', 'b'),
+        ], zipfile.ZIP_DEFLATED)
+
+    self.app.member_cache = wwz.MemberCache(10000, 10000)
+    self.app.json_cache = wwz.MemberCache(10000, 10000)
+
+    def Get(rel_path, **environ):
+      return self._Get('/foo.wwz/' + rel_path, **environ)
+
+    status, headers, body = Get('dir/-wwz-index.json')
+    self.assertEqual('200 OK', status)
+    self.assertEqual('application/json; charset=utf-8',
+                     headers['Content-Type'])
+    listing = json.loads(body)
+    print(listing)
+    self.assertEqual(['sub/'], listing['dirs'])
+    a = listing['files'][0]
+    self.assertEqual('dir/a.json', a['name'])
+    self.assertEqual(200, a['size'])
+    self.assert_(a['compressed_size'] < 200)
+    self.assertEqual('%08x' % (zlib.crc32('{}' * 100) & 0xffffffff),
+                     a['crc32'])
+    self.assertEqual('application/json', a['type'])
+
+    status, _, _ = Get('nope/-wwz-index.json')
+    self.assertEqual('404 Not Found', status)
+
+    # Whole archive, gzipped
+    status, headers, body = Get('-wwz-manifest.json',
+                                HTTP_ACCEPT_ENCODING='deflate, gzip')
+    self.assertEqual('gzip', headers['Content-Encoding'])
+    self.assertEqual('Accept-Encoding', headers['Vary'])
+    manifest = json.loads(zlib.decompress(body, 16 + zlib.MAX_WBITS))
+    self.assertEqual(['dir/a.json', 'dir/sub/b.txt', 'index.html'],
+                     [f['name'] for f in manifest['files']])
+
+    status, _, body = Get('-wwz-manifest.json',
+                          HTTP_ACCEPT_ENCODING='gzip;q=0')
+    self.assertEqual(manifest, json.loads(body))
+
+    # Conditional GET
+    etag = headers['ETag']
+    status, headers, body = Get('-wwz-manifest.json',
+                                HTTP_ACCEPT_ENCODING='gzip',
+                                HTTP_IF_NONE_MATCH='"x", W/%s' % etag)
+    self.assertEqual('304 Not Modified', status)
+    self.assertEqual('', body)
+
+    # A missing dir is 404, even if the ETag matches
+    status, _, _ = Get('nope/-wwz-index.json', HTTP_ACCEPT_ENCODING='gzip',
+                       HTTP_IF_NONE_MATCH=etag)
+    self.assertEqual('404 Not Found', status)
+    status, _, _ = Get('di/-wwz-index.json')
+    self.assertEqual('404 Not Found', status)
+    status, _, _ = Get('dir/sub/-wwz-index.json', HTTP_ACCEPT_ENCODING='gzip',
+                       HTTP_IF_NONE_MATCH=etag)
+    self.assertEqual('304 Not Modified', status)
+
+    # Without gzip, it's a different representation
+    status, _, _ = Get('-wwz-manifest.json', HTTP_IF_NONE_MATCH=etag)
+    self.assertEqual('200 OK', status)
+
+    # Listings are cached apart from members
+    self.assertEqual(1, self.app.json_cache.hits)
+    self.assertEqual(3, len(self.app.json_cache.entries))
+    self.assertEqual(0, len(self.app.member_cache.entries))
+
+  def testGzipStored(self):
+    text = 'line of text\n' * 100
+    info = zipfile.ZipInfo('deflated.txt')
+    info.compress_type = zipfile.ZIP_DEFLATED
+    _MakeWwz(os.path.join(self.tmp_dir, 'foo.wwz'), [
+        ('a.txt', text),  # STORED
+        ('small.txt', 'small'),
+        ('c.png', text),
+        ('e.log', text),  # not a type we gzip
+        ('big.txt', 'x' * (wwz.GZIP_MAX_BYTES + 1)),
+        ('random.txt', os.urandom(1000)),
+        (zipfile.ZipInfo('d.txt'), text),
+        (info, text),
+        ])
+
+    self.app.gzip_cache = wwz.MemberCache(10000, 10000)
+
+    def Get(rel_path, accept='gzip'):
+      _, headers, body = self._Get('/foo.wwz/' + rel_path,
+                                   HTTP_ACCEPT_ENCODING=accept)
+      return headers, body
+
+    headers, body = Get('a.txt')
+    self.assertEqual('gzip', headers['Content-Encoding'])
+    self.assertEqual('Accept-Encoding', headers['Vary'])
+    self.assertEqual(text, zlib.decompress(body, 16 + zlib.MAX_WBITS))
+    self.assertEqual(1, self.app.gzip_cache.misses)
+
+    headers, body2 = Get('a.txt')
+    self.assertEqual(body, body2)
+    self.assertEqual(1, self.app.gzip_cache.hits)
+
+    headers, body = Get('a.txt', accept='identity')
+    self.assertEqual(text, body)
+    self.assertEqual('Accept-Encoding', headers['Vary'])
+    self.assert_('Content-Encoding' not in headers)
+
+    # Not gzipped
+    for rel_path in ['small.txt', 'c.png', 'e.log', 'big.txt',
+                     'random.txt', 'deflated.txt']:
+      headers, body = Get(rel_path)
+      print(rel_path, headers)
+      self.assert_('Content-Encoding' not in headers, rel_path)
+
+    # Incompressible bodies are remembered, and not compressed again
+    hits = self.app.gzip_cache.hits
+    headers, body = Get('random.txt')
+    self.assert_('Content-Encoding' not in headers)
+    self.assertEqual(hits + 1, self.app.gzip_cache.hits)
+
+    # Without a gzip cache, like CGI, nothing is gzipped
+    self.app.gzip_cache = wwz.MemberCache(0, 0)
+    headers, body = Get('a.txt')
+    self.assertEqual(text, body)
+    self.assert_('Content-Encoding' not in headers)
+
+  def testParseViewConfig(self):
+    self.assertEqual('*/benchmarks.wwz', wwz.ParseViewConfig(
+        '# comment\n\n*/benchmarks.wwz\n'))
+    for bad in ['', 'a\nb', '/abs/*.wwz', '../*.wwz', 'a//*.wwz',
+                'no-wildcard.wwz']:
+      self.assertRaises(ValueError, wwz.ParseViewConfig, bad)
+
+  def testVirtualView(self):
+    jobs_dir = os.path.join(self.tmp_dir, 'github-jobs')
+    def MakeJob(job_id):
+      job_dir = os.path.join(jobs_dir, job_id)
+      os.makedirs(job_dir)
+      _MakeWwz(os.path.join(job_dir, 'benchmarks.wwz'), [
+          ('index.html', '<p>job %s</p>' % job_id),
+          ('osh/times.tsv', 'job %s\n' % job_id),
+          ])
+
+    MakeJob('1')
+    MakeJob('2')
+    os.makedirs(os.path.join(jobs_dir, '3'))  # no archive yet
+    with open(os.path.join(jobs_dir, 'jobs.wwzv'), 'w') as f:
+      f.write('*/benchmarks.wwz\n')
+
+    def Get(rel_path):
+      status, _, body = self._Get('/github-jobs/jobs.wwzv/' + rel_path)
+      return status, body
+
+    status, body = Get('1/osh/times.tsv')
+    self.assertEqual('200 OK', status)
+    self.assertEqual('job 1\n', body)
+
+    status, body = Get('2/')
+    self.assertEqual('<p>job 2</p>', body)
+
+    status, body = Get('-wwz-index')
+    print(body)
+    self.assertEqual('200 OK', status)
+    self.assert_('1/-wwz-index' in body)
+    self.assert_('2/-wwz-index' in body)
+    self.assert_('3/-wwz-index' not in body)
+    self.assert_('-wwz-search' not in body)
+
+    status, body = Get('1/osh/-wwz-index')
+    self.assert_('times.tsv' in body)
+
+    self.assertEqual('302 Found', Get('')[0])
+    self.assertEqual('302 Found', Get('1')[0])
+    self.assertEqual('404 Not Found', Get('3/index.html')[0])
+    self.assertEqual('404 Not Found', Get('1/nope.txt')[0])
+
+    # A new archive shows up after a rescan, and only the changed dirs are
+    # listed again.
+    view_path = os.path.join(jobs_dir, 'jobs.wwzv')
+    _, view = self.app.views[view_path]
+    job1_listing = view.listings[os.path.join(jobs_dir, '1')]
+    root_listing = view.listings[jobs_dir]
+
+    MakeJob('4')
+    view.last_scan = 0.0
+
+    status, body = Get('4/osh/times.tsv')
+    self.assertEqual('job 4\n', body)
+    self.assertEqual(['1', '2', '4'], sorted(view.jobs))
+    self.assert_(view.listings[os.path.join(jobs_dir, '1')] is job1_listing)
+    self.assert_(view.listings[jobs_dir] is not root_listing)
+
+    # An archive added to an existing dir shows up after a full rescan.
+    # Job 3's dir didn't change, so it wasn't checked before.
+    _MakeWwz(os.path.join(jobs_dir, '3', 'benchmarks.wwz'),
+             [('index.html', '<p>job 3</p>')])
+    view.MaybeRescan(0)
+    self.assertEqual(None, view.Lookup('3'))
+    view.MaybeRescan(0, 0)
+    self.assertEqual(['1', '2', '3', '4'], sorted(view.jobs))
+
+    # Archives are shared with direct requests
+    self.assert_(os.path.join(jobs_dir, '4', 'benchmarks.wwz') in
+                 self.app.zip_files)
+
+    with open(view_path, 'w') as f:
+      f.write('no-wildcard\n')
+    os.utime(view_path, (0, 0))
+    self.assertEqual('400 Bad Request', Get('1/index.html')[0])
+
+  def testVirtualViewCollision(self):
+    for rel_path in ['a-b/c/out.wwz', 'a/b-c/out.wwz', 'd/e/out.wwz']:
+      path = os.path.join(self.tmp_dir, rel_path)
+      os.makedirs(os.path.dirname(path))
+      _MakeWwz(path, [('index.html', rel_path)])
+
+    view = wwz.VirtualView(self.tmp_dir, '*/*/out.wwz')
+    view.MaybeRescan()
+    # Neither a-b-c is served
+    self.assertEqual(['d-e'], sorted(view.jobs))
+    self.assertEqual(['a-b-c'], view.collisions.keys())
+    self.assertEqual(
+        [os.path.join(self.tmp_dir, 'a-b/c/out.wwz'),
+         os.path.join(self.tmp_dir, 'a/b-c/out.wwz')],
+        sorted(view.collisions['a-b-c']))
+
+  def testZipIndex(self):
+    path = os.path.join(self.tmp_dir, 'foo.wwz')
+    z = zipfile.ZipFile(path, 'w')
+    z.writestr('b.txt', 'stored', zipfile.ZIP_STORED)
+    z.writestr('a/c.html', '<p>deflated</p>' * 100, zipfile.ZIP_DEFLATED)
+    z.writestr('a/', '')
+    z.close()
+
+    index = wwz.ZipIndex.Open(path)
+    self.assertEqual(3, len(index))
+    self.assertEqual(['a/', 'a/c.html', 'b.txt'], list(index.names))
+
+    self.assertEqual('stored', index.Read('b.txt'))
+    self.assertEqual('<p>deflated</p>' * 100, index.Read('a/c.html'))
+    self.assertEqual('', index.Read('a/'))
+    self.assertRaises(IOError, index.Read, 'nope')
+
+    self.assertEqual(1, index.Find('a/c.html'))
+    self.assertEqual(-1, index.Find('a'))
+    self.assert_('b.txt' in index)
+    self.assertEqual(zipfile.ZIP_DEFLATED, index.methods[1])
+    self.assertEqual(zipfile.ZipFile(path).getinfo('b.txt').CRC,
+                     index.crcs[2])
+    print('MemoryBytes = %d' % index.MemoryBytes())
+
+    not_zip = os.path.join(self.tmp_dir, 'not.wwz')
+    with open(not_zip, 'w') as f:
+      f.write('not a zip')
+    self.assertRaises(wwz.BadZip, wwz.ZipIndex.Open, not_zip)
+
+  def testServingIndex(self):
+    path = os.path.join(self.tmp_dir, 'foo.wwz')
+    z = zipfile.ZipFile(path, 'w')
+    z.writestr('b.txt', 'stored', zipfile.ZIP_STORED)
+    z.writestr('a/c.html', '<p>deflated</p>' * 100, zipfile.ZIP_DEFLATED)
+    z.close()
+
+    st = os.stat(path)
+    version = (st.st_size, st.st_mtime)
+    # Missing
+    self.assertEqual(None, wwz.ZipIndex.LoadServingIndex(path, version))
+
+    # Write what wwup.py writes
+    parsed = wwz.ZipIndex.Open(path)
+    index = {
+        'format': wwz.SERVING_INDEX_FORMAT,
+        'archive_size': st.st_size,
+        'archive_mtime': st.st_mtime,
+        'names': parsed.names.blob,
+    }
+    for name, _ in wwz._SERVING_INDEX_COLUMNS:
+      index[name] = getattr(parsed, name).tostring()
+    with open(wwz.ServingIndexPath(path), 'wb') as f:
+      marshal.dump(index, f)
+    self.assert_(wwz.ServingIndexPath(path).endswith('/.foo.wwz.index'))
+
+    loaded = wwz.ZipIndex.LoadServingIndex(path, version)
+    self.assertEqual(['a/c.html', 'b.txt'], list(loaded.names))
+    self.assertEqual('<p>deflated</p>' * 100, loaded.Read('a/c.html'))
+    self.assertEqual('stored', loaded.Read('b.txt'))
+
+    # Stale
+    stale = (st.st_size + 1, st.st_mtime)
+    self.assertEqual(None, wwz.ZipIndex.LoadServingIndex(path, stale))
+
+  def testSearchIndex(self):
+    path = os.path.join(self.tmp_dir, 'foo.wwz')
+    _MakeWwz(path, [
+        ('a.html', '<p>Hello <b>shell</b> world</p>'),
+        ('dir/b.txt', 'shell shell shell scripts'),
+        ('dir/c.txt', 'nothing here'),
+        ('d.png', 'shell'),  # not indexed
+        ], zipfile.ZIP_DEFLATED)
+
+    index = wwz.SearchIndex.Build(wwz.ZipIndex.Open(path))
+    self.assertEqual(['a.html', 'dir/b.txt', 'dir/c.txt'], index.names)
+
+    results = index.Query('shell')
+    print(results)
+    # More occurrences ranks higher
+    self.assertEqual([1, 0], [member_id for _, member_id, _ in results])
+
+    # All terms must match
+    results = index.Query('shell world')
+    self.assertEqual([0], [member_id for _, member_id, _ in results])
+
+    # Restricted to a directory
+    results = index.Query('shell', dir_prefix='dir/')
+    self.assertEqual([1], [member_id for _, member_id, _ in results])
+
+    self.assertEqual([], index.Query('zzz'))
+    self.assertEqual([], index.Query(''))
+
+    # Survives serialization
+    index2 = wwz.SearchIndex.FromPayload(index.ToPayload())
+    self.assertEqual(index.Query('shell'), index2.Query('shell'))
+
+  def testSearchBuildFailure(self):
+    calls = []
+    def FailingBuild(z):
+      calls.append(z.path)
+      raise IOError('corrupt')
+
+    orig_build = wwz.SearchIndex.__dict__['Build']
+    wwz.SearchIndex.Build = staticmethod(FailingBuild)
+    try:
+      path = os.path.join(self.tmp_dir, 'foo.wwz')
+      _MakeWwz(path, [('a.txt', 'shell')])
+
+      def Search():
+        st = os.stat(path)
+        version = (st.st_size, st.st_mtime)
+        z = self.app._GetZip(path, version, wwz.RequestTracer())
+        return self.app._GetSearchIndex(z, path, version, 5.0)
+
+      self.assert_(Search().error)
+      self.assert_(Search().error)
+      # The failure is cached, not retried on every request
+      self.assertEqual(1, len(calls))
+
+      # A new version of the archive is indexed again
+      st = os.stat(path)
+      os.utime(path, (st.st_atime, st.st_mtime + 10))
+      self.assert_(Search().error)
+      self.assertEqual(2, len(calls))
+    finally:
+      wwz.SearchIndex.Build = orig_build
+
+  def testSnippetHtml(self):
+    text = wwz._SearchText('a.html', '<p>Hello <b>shell</b> & world</p>')
+    pos = text.find('shell')
+    html = wwz._SnippetHtml(text, pos, 'SHELL')
+    print(html)
+    self.assertEqual('Hello <b>shell</b> &amp; world', html)
+
+  def testFindTarMember(self):
+    z = set(['test.tar', '_release/oil.tar', 'dir.tar/inner.tar'])
+    self.assertEqual(('test.tar', 'a/b'), wwz._FindTarMember(z, 'test.tar/a/b'))
+    self.assertEqual(('_release/oil.tar', ''),
+                     wwz._FindTarMember(z, '_release/oil.tar/'))
+    self.assertEqual((None, None), wwz._FindTarMember(z, 'test.tar'))
+    self.assertEqual((None, None), wwz._FindTarMember(z, 'foo.html'))
+    # A zip dir named like a tar
+    self.assertEqual((None, None), wwz._FindTarMember(z, 'dir.tar/-wwz-index'))
+    self.assertEqual(('dir.tar/inner.tar', 'a'),
+                     wwz._FindTarMember(z, 'dir.tar/inner.tar/a'))
+
+  def testTarIndex(self):
+    long_name = 'long/' + 'x' * 120 + '.txt'
+
+    for fmt in (tarfile.GNU_FORMAT, tarfile.PAX_FORMAT, tarfile.USTAR_FORMAT):
+      f = cStringIO.StringIO()
+      f.write('PADDING')  # the tar doesn't start at offset 0 in a .wwz
+      t = tarfile.open(fileobj=f, mode='w', format=fmt)
+
+      files = [('a.txt', 'aaa'), ('dir/b.html', '<p>b</p>')]
+      if fmt != tarfile.USTAR_FORMAT:
+        files.append((long_name, 'long'))
+
+      info = tarfile.TarInfo('dir')
+      info.type = tarfile.DIRTYPE
+      t.addfile(info)
+      for name, contents in files:
+        info = tarfile.TarInfo(name)
+        info.size = len(contents)
+        t.addfile(info, cStringIO.StringIO(contents))
+      t.close()
+
+      length = f.tell() - len('PADDING')
+      index = wwz.TarIndex.Build(f, len('PADDING'), length)
+      print(index.names)
+
+      expected = sorted([name for name, _ in files] + ['dir/'])
+      self.assertEqual(expected, index.names)
+      for name, contents in files:
+        self.assertEqual(contents, index.Read(f, name))
+      self.assertEqual(None, index.Read(f, 'dir/'))
+      self.assertEqual(None, index.Read(f, 'nope'))
+
+      index2 = wwz.TarIndex.FromPayload(index.ToPayload())
+      self.assertEqual('aaa', index2.Read(f, 'a.txt'))
+
+  def testTarRoutes(self):
+    # The size field isn't octal
+    bad_header = 'x'.ljust(124, '\0') + 'zzzzzzzzzzz\0'
+    bad_tar = bad_header.ljust(512, '\0') + '\0' * 1024
+
+    # The size field says the member is bigger than the tar
+    f = cStringIO.StringIO()
+    t = tarfile.open(fileobj=f, mode='w')
+    info = tarfile.TarInfo('big.txt')
+    info.size = 100
+    t.addfile(info, cStringIO.StringIO('x' * 100))
+    t.close()
+    short_tar = f.getvalue()[:512 + 50]
+
+    f = cStringIO.StringIO()
+    t = tarfile.open(fileobj=f, mode='w')
+    info = tarfile.TarInfo('inner.tar')
+    info.size = 3
+    t.addfile(info, cStringIO.StringIO('abc'))
+    t.close()
+    good_tar = f.getvalue()
+
+    info = zipfile.ZipInfo('deflated.tar')
+    info.compress_type = zipfile.ZIP_DEFLATED
+    _MakeWwz(os.path.join(self.tmp_dir, 'foo.wwz'), [
+        ('dir.tar/a.txt', 'a'),  # a dir, not a tar
+        ('bad.tar', bad_tar),
+        ('short.tar', short_tar),
+        ('good.tar', good_tar),
+        (info, good_tar),
+        ])
+
+    def Get(rel_path):
+      status, _, body = self._Get('/foo.wwz/' + rel_path)
+      return status, body
+
+    status, body = Get('dir.tar/-wwz-index')
+    self.assertEqual('200 OK', status)
+    self.assert_('a.txt' in body)
+    self.assertEqual(('200 OK', 'a'), Get('dir.tar/a.txt'))
+
+    for rel_path in ['bad.tar/-wwz-index', 'bad.tar/x',
+                     'short.tar/-wwz-index']:
+      status, body = Get(rel_path)
+      print(body)
+      self.assertEqual('400 Bad Request', status)
+
+    # Only STORED tars in the zip can be browsed, not tars inside a tar
+    status, body = Get('-wwz-index')
+    self.assert_('"good.tar/-wwz-index">(browse)' in body)
+    self.assert_('deflated.tar/-wwz-index' not in body)
+    status, body = Get('good.tar/-wwz-index')
+    self.assert_('inner.tar' in body)
+    self.assert_('(browse)' not in body)
+
+  def testCorruptMember(self):
+    path = os.path.join(self.tmp_dir, 'foo.wwz')
+    _MakeWwz(path, [('a.txt', 'aaaa'), ('b.txt', 'bbbb')])
+
+    with open(path, 'rb') as f:
+      data = f.read()
+    # Change the contents of a.txt, so its CRC doesn't match
+    data = data.replace('aaaa', 'axaa', 1)
+    # Say b.txt uses bzip2 (12), in both headers
+    b_local = data.index('PK\x03\x04', data.index('axaa'))
+    b_central = data.rindex('PK\x01\x02')
+    for offset in [b_local + 8, b_central + 10]:
+      data = data[:offset] + '\x0c\x00' + data[offset+2:]
+    with open(path, 'wb') as f:
+      f.write(data)
+
+    index = wwz.ZipIndex.Open(path)
+    for name in ['a.txt', 'b.txt']:
+      try:
+        index.Read(name)
+      except wwz.BadZip as e:
+        print(e)
+      else:
+        self.fail('Expected BadZip')
+
+    # A server error, not 404
+    for rel_path in ['a.txt', 'b.txt']:
+      status, _, body = self._Get('/foo.wwz/' + rel_path)
+      print(body)
+      self.assertEqual('500 Internal Server Error', status)
+    self.assertEqual('404 Not Found', self._Get('/foo.wwz/c.txt')[0])
+
+  def testMemberCache(self):
+    c = wwz.MemberCache(10, 5)
+    c.Put('a', 'aaaa')
+    c.Put('b', 'bbbb')
+    c.Put('big', 'xxxxxx')  # bigger than a member can be
+    self.assertEqual(None, c.Get('big'))
+    self.assertEqual('aaaa', c.Get('a'))
+
+    c.Put('c', 'cccc')  # evicts b, the least recently used
+    self.assertEqual(None, c.Get('b'))
+    self.assertEqual('aaaa', c.Get('a'))
+    self.assertEqual('cccc', c.Get('c'))
+    self.assertEqual(8, c.num_bytes)
+
+  def testSharedMemberCache(self):
+    style = 'body { color: black; }\n' * 20
+    for name, extra in [('one.wwz', 'one'), ('two.wwz', 'two')]:
+      _MakeWwz(os.path.join(self.tmp_dir, name),
+               [('style.css', style), ('index.html', extra)],
+               zipfile.ZIP_DEFLATED)
+
+    c = wwz.MemberCache(10000, 1000)
+    self.app.member_cache = c
+
+    def Read(name, rel_path):
+      path = os.path.join(self.tmp_dir, name)
+      z = wwz.ZipIndex.Open(path)
+      return self.app._ReadMember(z, path, 1, rel_path)
+
+    self.assertEqual(style, Read('one.wwz', 'style.css'))
+    self.assertEqual(style, Read('two.wwz', 'style.css'))  # shared
+    self.assertEqual(style, Read('two.wwz', 'style.css'))  # aliased
+    self.assertEqual('one', Read('one.wwz', 'index.html'))
+    self.assertEqual('two', Read('two.wwz', 'index.html'))
+
+    print(c.hits, c.dedup_hits, c.misses)
+    self.assertEqual(1, c.hits)
+    self.assertEqual(1, c.dedup_hits)
+    self.assertEqual(len(style), c.dedup_bytes)
+    self.assertEqual(3, c.misses)
+    self.assertEqual(3, len(c.entries))  # one copy of style.css
+    self.assertEqual(4, len(c.aliases))
+
+    # Same content key but different bytes isn't shared
+    z = wwz.ZipIndex.Open(os.path.join(self.tmp_dir, 'one.wwz'))
+    i = z.Find('style.css')
+    key = (z.crcs[i], z.sizes[i], z.compressed_sizes[i], z.methods[i])
+    self.assertEqual(None, c.GetVerified(('x', 1, 'y'), key, 'bad digest'))
+    self.assertEqual(1, c.collisions)
+
+  def testMemberCacheCollision(self):
+    archives = {}
+    for name, body in [('a.wwz', 'plumless'), ('b.wwz', 'buckeroo')]:
+      path = os.path.join(self.tmp_dir, name)
+      _MakeWwz(path, [('data.txt', body)])  # STORED, so sizes are equal
+      archives[name] = (path, wwz.ZipIndex.Open(path))
+
+    # These have the same CRC-32, so both members have the same content key
+    _, za = archives['a.wwz']
+    _, zb = archives['b.wwz']
+    self.assertEqual(za.crcs[za.Find('data.txt')], zb.crcs[zb.Find('data.txt')])
+
+    c = wwz.MemberCache(10000, 1000)
+    self.app.member_cache = c
+
+    def Read(name):
+      path, z = archives[name]
+      return self.app._ReadMember(z, path, 1, 'data.txt')
+
+    self.assertEqual('plumless', Read('a.wwz'))
+    self.assertEqual('buckeroo', Read('b.wwz'))
+    # b.wwz replaced the body of the content key, so a.wwz's alias is stale
+    self.assertEqual('plumless', Read('a.wwz'))
+    self.assertEqual('buckeroo', Read('b.wwz'))
+    print(c.hits, c.dedup_hits, c.misses, c.collisions)
+    self.assert_(c.collisions >= 2)
+
+  def testWarmUp(self):
+    doc_root = os.path.join(self.tmp_dir, 'www')
+    os.mkdir(doc_root)
+    wwz_path = os.path.join(doc_root, 'foo.wwz')
+    _MakeWwz(wwz_path, [('index.html', 'index'), ('a.txt', 'aaa')])
+
+    log_path = os.path.join(self.tmp_dir, '2024-01-01__00-00-00.1.request.log')
+    log_file = wwz.TabularLogFile(wwz.REQUEST_LOG_SCHEMA, log_path)
+    for uri in ['/foo.wwz/a.txt', '/foo.wwz/', '/foo.wwz/a.txt?x=1',
+                '/foo.wwz/-wwz-index', '/foo.wwz/missing.txt', '/other.wwz/']:
+      log_file.Append(('-', 1, 'thread', 0.0, uri, doc_root))
+    log_file.Flush()
+
+    hits = wwz._CountHits([log_path])
+    print(hits)
+    self.assertEqual({'a.txt': 2, 'index.html': 1, 'missing.txt': 1},
+                     hits[wwz_path])
+
+    self.app.member_cache = wwz.MemberCache(1000, 100)
+    w = wwz.WarmUp(self.app, 3, 5, 2)
+    w._Run()  # synchronous
+
+    self.assertEqual('done', w.state)
+    self.assertEqual(2, w.archives_total)  # including other.wwz
+    self.assertEqual(2, w.members_loaded)
+    self.assertEqual(['a.txt', 'index.html'],
+                     sorted(loc[2] for loc in self.app.member_cache.aliases))
+
+  def testWorker(self):
+    wwz_path = os.path.join(self.tmp_dir, 'foo.wwz')
+    _MakeWwz(wwz_path, [('a.txt', 'aaa')])
+
+    sock_path = os.path.join(self.tmp_dir, 'wwz.sock')
+
+    # Nothing is listening yet
+    out_f = cStringIO.StringIO()
+    self.assertEqual(False, wwz._ForwardRequest(sock_path, {}, '', out_f))
+
+    server = wwz.WorkerServer(self.app, sock_path)
+    t = threading.Thread(target=server.handle_request)
+    t.start()
+
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        'REQUEST_URI': '/foo.wwz/a.txt',
+        'PATH_INFO': '/a.txt',
+        'DOCUMENT_ROOT': self.tmp_dir,
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+    }
+    ok = wwz._ForwardRequest(sock_path, environ, '', out_f)
+    t.join()
+    server.server_close()
+
+    self.assertEqual(True, ok)
+    response = out_f.getvalue()
+    print(response)
+    self.assert_(response.startswith('Status: 200 OK\r\n'), response)
+    self.assert_(response.endswith('\r\n\r\naaa'), response)
+
 
 if __name__ == '__main__':
   unittest.main()